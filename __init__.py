@@ -30,6 +30,8 @@ This program might, and would be buggy. Use it at your own risk.
 
 sDefaultRefPrefix = 'refs/heads/'
 
+sDefaultSocketPath = "/var/run/gitzilla/gitzillad.sock"
+
 sDefaultSeparator = "~.~.~.~.~.~.~.~.~.~.~.~.~.~.~.~."
 
 sDefaultFormatSpec = """
@@ -45,6 +47,36 @@ Commit Date %cD
 %b
 """
 
+iDefaultMaxCommentSize = 65535
+
+iDefaultCommentWorkers = 4
+
+iDefaultDrainRetries = 10
+
+iDefaultDrainBackoff = 30
+
+iDefaultBackfillBatchSize = 1000
+
+fDefaultDiffStatTimeout = 10.0
+
+iDefaultStatusCacheTTL = 300
+
+iDefaultStatusCacheSize = 10000
+
+iDefaultScanCacheSize = 100000
+
+fDefaultBZTimeout = 30.0
+
+iDefaultBZRetries = 2
+
+fDefaultBZBackoff = 0.5
+
+fDefaultBZDeadline = 60.0
+
+iDefaultCircuitThreshold = 5
+
+fDefaultCircuitCooldown = 60.0
+
 import re
 
 oDefaultBugRegex = re.compile(r"bug\s*(?:#|)\s*(?P<bug>\d+)",
@@ -0,0 +1,314 @@
+"""
+An asyncio based interface to the Bugzilla XMLRPC API.
+
+AsyncBugzillaWrapper has the same methods as bugwrap.BugzillaWrapper,
+but they are coroutines, so many requests can be in flight at once. It
+can be passed to the hooks as bz_wrap, which then issue their Bugzilla
+requests concurrently instead of one after the other.
+"""
+
+import os
+import ssl
+import asyncio
+import threading
+import weakref
+import xmlrpc.client
+from urllib.parse import urlsplit
+
+from gitzilla import fDefaultBZTimeout, iDefaultBZRetries, fDefaultBZBackoff, fDefaultBZDeadline
+from gitzilla.bugwrap import load_token, store_token
+from gitzilla.bugwrap import idempotent_methods, is_transient, BugzillaUnavailable, CircuitOpen
+from gitzilla.metrics import NullMetrics
+
+
+_local = threading.local()
+
+
+def resolve(result):
+    """Returns result, or what it evaluates to if it is a coroutine (as
+    returned by the methods of AsyncBugzillaWrapper), running it in a
+    private event loop. This lets callers drive both kinds of wrappers.
+
+    Each thread (of each process) keeps its private loop, so that the
+    connections the wrappers keep open in it serve the following calls."""
+    if not asyncio.iscoroutine(result):
+        return result
+    loop = getattr(_local, 'loop', None)
+    if loop is None or _local.pid != os.getpid():
+        # a loop inherited through a fork shares its selector with the
+        # parent, it is left alone.
+        loop = _local.loop = asyncio.new_event_loop()
+        _local.pid = os.getpid()
+    return loop.run_until_complete(result)
+
+
+class AsyncBugzillaWrapper(object):
+    """An asynchronous wrapper for the Bugzilla XMLRPC interface.
+
+    At most max_in_flight requests are sent at the same time, and each
+    request gives up if connecting or reading the answer takes longer
+    than timeout seconds. The connections are kept open (HTTP/1.1
+    keep-alive) for the next requests of the same event loop, so that
+    only the first requests pay for the TCP and TLS handshakes.
+    token_file, the retries of the idempotent calls and the circuit
+    breaker work like for BugzillaWrapper, and so do the login cookies of
+    Bugzillas older than 4.4.3.
+
+    An instance may be used from several event loops, one at a time or
+    concurrently (e.g. from different threads). Like for BugzillaWrapper,
+    the requests are timed and counted in metrics."""
+
+    metrics = NullMetrics()
+
+    def __init__(self, url, user, password, token_file=None, max_in_flight=8,
+                 timeout=fDefaultBZTimeout, retries=iDefaultBZRetries,
+                 backoff=fDefaultBZBackoff, deadline=fDefaultBZDeadline,
+                 circuit_file=None, circuit_threshold=None, circuit_cooldown=None):
+        self._url = url
+        self._user = user
+        self._password = password
+        self._token_file = token_file
+        self._max_in_flight = max_in_flight
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._deadline = deadline
+        self._breaker = None
+        if circuit_file is not None:
+            from gitzilla.breaker import CircuitBreaker
+            self._breaker = CircuitBreaker(circuit_file, url, circuit_threshold, circuit_cooldown)
+        self._authed = False
+        self._token_cached = False
+        # the login cookies, for Bugzillas which return no token
+        self._cookies = {}
+        # asyncio primitives belong to a loop, so they are kept per loop
+        self._loop_state = weakref.WeakKeyDictionary()
+
+        parts = urlsplit(url)
+        self._https = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._host_header = parts.netloc.rsplit('@', 1)[-1]
+        self._port = parts.port or (self._https and 443 or 80)
+        self._path = parts.path or '/'
+        if parts.query:
+            self._path += '?' + parts.query
+
+    def _state(self):
+        loop = asyncio.get_event_loop()
+        state = self._loop_state.get(loop)
+        if state is None:
+            # the semaphore, the login lock and the idle connections
+            state = self._loop_state[loop] = (asyncio.Semaphore(self._max_in_flight),
+                                              asyncio.Lock(), [])
+        return state
+
+    def reset_connections(self):
+        """Forgets the state kept for event loops, keeping the login.
+        Must be called in a child process after a fork."""
+        self._loop_state = weakref.WeakKeyDictionary()
+
+    async def _request(self, method, params):
+        """Makes the XMLRPC call method with params, retrying it if it is
+        idempotent and Bugzilla does not answer."""
+        idempotent = method in idempotent_methods
+        loop = asyncio.get_event_loop()
+        if self._deadline is not None:
+            deadline = loop.time() + self._deadline
+        attempt = 0
+        while True:
+            if self._breaker is not None and not self._breaker.allow():
+                self.metrics.count('circuit_open')
+                raise CircuitOpen("Bugzilla at %s is unavailable, not calling %s"
+                                  % (self._url, method))
+            timeout = self._timeout
+            if self._deadline is not None:
+                timeout = max(min(timeout, deadline - loop.time()), 0.001)
+            try:
+                result = await self._send(method, params, timeout)
+            except Exception as e:
+                if not (is_transient(e) or isinstance(e, asyncio.TimeoutError)):
+                    if self._breaker is not None:
+                        self._breaker.success()
+                    raise
+                wait = self._backoff * 2 ** attempt
+                if (not idempotent or attempt >= self._retries or
+                        (self._deadline is not None and loop.time() + wait >= deadline)):
+                    if self._breaker is not None:
+                        self._breaker.failure()
+                    raise BugzillaUnavailable("%s on %s failed: %r" % (method, self._url, e))
+                attempt += 1
+                self.metrics.count('retries')
+                await asyncio.sleep(wait)
+                continue
+            if self._breaker is not None:
+                self._breaker.success()
+            return result
+
+    async def _send(self, method, params, timeout):
+        body = xmlrpc.client.dumps((params,), method, allow_none=True).encode('utf-8')
+        header = ("POST %s HTTP/1.1\r\n"
+                  "Host: %s\r\n"
+                  "User-Agent: gitzilla\r\n"
+                  "Content-Type: text/xml\r\n"
+                  "Content-Length: %d\r\n" % (self._path, self._host_header, len(body)))
+        if self._cookies:
+            header += "Cookie: %s\r\n" % ('; '.join('%s=%s' % item for item in sorted(self._cookies.items())),)
+        header = (header + "\r\n").encode('ascii')
+
+        (semaphore, _, idle) = self._state()
+        self.metrics.count('bugzilla_requests')
+        async with semaphore:
+            with self.metrics.span('bugzilla.' + method):
+                while True:
+                    reused = bool(idle)
+                    if reused:
+                        connection = idle.pop()
+                    else:
+                        connection = await asyncio.wait_for(self._connect(), timeout)
+                    try:
+                        (code, status_line, payload, keep_alive) = await asyncio.wait_for(
+                            self._exchange(connection, header + body), timeout)
+                    except (ConnectionError, asyncio.IncompleteReadError) as e:
+                        connection[1].close()
+                        if reused and not getattr(e, 'partial', b''):
+                            # Bugzilla closed the idle connection, before
+                            # reading the request: as http.client does, it
+                            # is sent again on a new one.
+                            continue
+                        if isinstance(e, asyncio.IncompleteReadError):
+                            raise ConnectionResetError("Bugzilla closed the connection")
+                        raise
+                    except BaseException:
+                        connection[1].close()
+                        raise
+                    break
+                if keep_alive:
+                    idle.append(connection)
+                else:
+                    connection[1].close()
+
+        if code != 200:
+            raise xmlrpc.client.ProtocolError(self._url, code, status_line, {})
+        return xmlrpc.client.loads(payload)[0][0]
+
+    async def _connect(self):
+        ssl_context = None
+        if self._https:
+            ssl_context = ssl.create_default_context()
+        return await asyncio.open_connection(self._host, self._port, ssl=ssl_context)
+
+    async def _exchange(self, connection, request):
+        """Sends request on connection, and returns the status code, the
+        status line and the payload of the answer, and whether the
+        connection may be used again."""
+        (reader, writer) = connection
+        writer.write(request)
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode('latin-1').split("\r\n")
+        status_line = lines[0]
+        headers = {}
+        for line in lines[1:]:
+            (name, _, value) = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+            if name.strip().lower() == 'set-cookie':
+                self._set_cookie(value.strip())
+        status = status_line.split(None, 2)
+        code = len(status) > 1 and status[1].isdigit() and int(status[1]) or 0
+        keep_alive = (status_line.startswith('HTTP/1.1') and
+                      headers.get('connection', '').lower() != 'close')
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b';')[0], 16)
+                if not size:
+                    break
+                chunks.append((await reader.readexactly(size + 2))[:-2])
+            # the trailer, if any, up to the empty line
+            while await reader.readuntil(b"\r\n") != b"\r\n":
+                pass
+            payload = b"".join(chunks)
+        elif 'content-length' in headers:
+            payload = await reader.readexactly(int(headers['content-length']))
+        else:
+            payload = await reader.read()
+            keep_alive = False
+        return (code, status_line, payload, keep_alive)
+
+    def _set_cookie(self, header):
+        from http.cookies import SimpleCookie, CookieError
+        try:
+            cookie = SimpleCookie(header)
+        except CookieError:
+            return
+        for (name, morsel) in cookie.items():
+            self._cookies[name] = morsel.value
+
+    def _token_key(self):
+        return "%s %s" % (self._url, self._user)
+
+    async def _login(self):
+        response = await self._request('User.login', {'login': self._user,
+                                                      'password': self._password})
+        self._authed = True
+        self._token_cached = False
+        if 'token' in response:
+            self._bz_token = response['token']
+            if self._token_file is not None:
+                try:
+                    store_token(self._token_file, self._token_key(), self._bz_token)
+                except (IOError, OSError):
+                    pass
+
+    async def auth(self):
+        async with self._state()[1]:
+            if not self._authed:
+                token = None
+                if self._token_file is not None and self._user is not None:
+                    token = load_token(self._token_file, self._token_key())
+                if token is not None:
+                    self._bz_token = token
+                    self._authed = True
+                    self._token_cached = True
+                else:
+                    await self._login()
+
+    async def _call(self, method, params):
+        await self.auth()
+        token = getattr(self, '_bz_token', None)
+        call_params = dict(params)
+        if token is not None:
+            call_params['Bugzilla_token'] = token
+        try:
+            return await self._request(method, call_params)
+        except xmlrpc.client.Fault:
+            async with self._state()[1]:
+                if not self._token_cached:
+                    raise
+                if getattr(self, '_bz_token', None) == token:
+                    await self._login()
+            self.metrics.count('retries')
+            return await self._call(method, params)
+
+    async def bug_status(self, bugid):
+        return (await self.bug_statuses([bugid]))[bugid]
+
+    async def bug_statuses(self, bugids, chunk_size=200):
+        """Returns a dict mapping each of bugids to its status (None for
+        bugs which do not exist). The chunks of chunk_size ids are looked
+        up concurrently."""
+        statuses = dict((bugid, None) for bugid in bugids)
+        bugids = list(statuses)
+        await self.auth()
+        results = await asyncio.gather(*[
+            self._call('Bug.get', {'ids': bugids[i:i + chunk_size],
+                                   'include_fields': ['id', 'status'],
+                                   'permissive': True})
+            for i in range(0, len(bugids), chunk_size)])
+        for bugdat in results:
+            for bug in bugdat['bugs']:
+                statuses[int(bug['id'])] = bug['status']
+        return statuses
+
+    async def add_bug_comment(self, bugid, comment):
+        await self._call('Bug.add_comment', {'id': bugid, 'comment': comment})
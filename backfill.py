@@ -0,0 +1,233 @@
+
+"""
+backfill - comments the bugs referred to by the existing history.
+
+When a repository starting to use gitzilla already has a long history,
+its commits can be linked to their bugs with gitzilla-backfill. The
+commits are read from git as a stream, in batches; the messages of a
+batch are combined into one comment per bug (or a few, for bugs with a
+lot of commits), which are posted in parallel, at a limited rate.
+
+The progress is kept in the commit index (see index.py): a commit is
+recorded there as soon as the comments of all its bugs are posted, and
+the commits found there are skipped. An interrupted backfill therefore
+resumes where it stopped when run again, and the post-receive hook (with
+commit_index set) does not comment these commits again when they are
+pushed to another branch.
+
+"""
+
+import fcntl
+from collections import OrderedDict
+from gitzilla import sDefaultFormatSpec, iDefaultMaxCommentSize, iDefaultCommentWorkers
+from gitzilla import iDefaultBackfillBatchSize
+from gitzilla import NullLogger
+from gitzilla.bugrefs import get_scanner
+from gitzilla.metrics import NullMetrics
+from gitzilla.template import get_template
+from gitzilla.utils import get_commits, get_diffstat, split_comments, RateLimiter
+
+
+def backfill(asRevArgs, fnGetBZ, oIndex, oBugRegex=None, sFormatSpec=None, bIncludeDiffStat=True, iMaxCommentSize=None, iWorkers=None, fRate=None, iBatchSize=None, logger=None, oMetrics=None, bDryRun=False, oBugIndex=None, oTemplate=None):
+  """
+  comments the bugs referred to by the commits listed by 'git log
+  asRevArgs' (e.g. ['--all'] or ['v1.0..master']), oldest first, skipping
+  the commits recorded in oIndex (an index.CommitIndex) and recording
+  those which were processed. Must be run in the repository.
+
+  fnGetBZ() returns the Bugzilla wrapper to use. The commits are handled
+  iBatchSize at a time: the comments of a batch are posted by iWorkers
+  threads, at most fRate per second in all (no limit if None), each
+  thread posting all the comments of a bug in order. oBugRegex,
+  sFormatSpec, bIncludeDiffStat and iMaxCommentSize are the same as for
+  hooks.post_receive. The diffstat is only computed for the commits
+  which are commented.
+
+  With bDryRun, nothing is posted nor recorded: only the comments which
+  would be posted are counted.
+
+  If oBugIndex (an index.BugIndex) is given, the bugs of all the commits
+  (including those skipped because of oIndex) are recorded there, along
+  with the ref through which git reached each commit.
+
+  The comments are rendered by oTemplate (a template.CommentTemplate),
+  which defaults to the template of sFormatSpec.
+
+  Only one backfill may run at a time for an index, a second one exits
+  at once. Returns a (iCommits, iComments, iFailed) tuple: the number of
+  commits processed, of comments posted and of comments which could not
+  be posted (their commits are tried again by the next run), or None if
+  another backfill is running.
+  """
+  if sFormatSpec is None:
+    sFormatSpec = sDefaultFormatSpec
+
+  if iMaxCommentSize is None:
+    iMaxCommentSize = iDefaultMaxCommentSize
+
+  if iWorkers is None:
+    iWorkers = iDefaultCommentWorkers
+
+  if iBatchSize is None:
+    iBatchSize = iDefaultBackfillBatchSize
+
+  if logger is None:
+    logger = NullLogger
+
+  if oMetrics is None:
+    oMetrics = NullMetrics()
+
+  if oTemplate is None:
+    oTemplate = get_template(sFormatSpec, iMaxSize=iMaxCommentSize)
+
+  oScanner = get_scanner(oBugRegex)
+
+  oLockFile = open(oIndex.sPath + ".backfill.lock", "a")
+  try:
+    fcntl.flock(oLockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except (IOError, OSError):
+    oLockFile.close()
+    logger.info("%s is being backfilled by another process" % (oIndex.sPath,))
+    return None
+
+  from concurrent.futures import ThreadPoolExecutor, as_completed
+  from gitzilla.asyncbugwrap import resolve
+
+  oLimiter = RateLimiter(fRate)
+  oDiffStat = get_diffstat(bIncludeDiffStat)
+  aiResults = [0, 0, 0]
+  oBZ = None
+  oPool = None
+  if not bDryRun:
+    oBZ = fnGetBZ()
+    oBZ.metrics = oMetrics
+    oPool = ThreadPoolExecutor(max_workers=max(iWorkers, 1))
+
+  def post(iBugId, atComments):
+    # returns the shas of the comments posted, stopping at the first
+    # failure so that the comments of a bug stay in order.
+    aasPosted = []
+    for (sComment, asShas) in atComments:
+      oLimiter.wait()
+      try:
+        resolve(oBZ.add_bug_comment(iBugId, sComment))
+      except Exception:
+        logger.exception("Could not add comment to bug %d" % (iBugId,))
+        break
+      aasPosted.append(asShas)
+    return aasPosted
+
+  def run_batch(aoBatch):
+    # bug id -> (sha, comment) of its commits, in history order
+    dMessages = OrderedDict()
+    # sha -> the number of its comments still to be posted
+    diPending = {}
+    asDone = []
+    atLinks = []
+    for oCommit in aoBatch:
+      with oMetrics.span("scan"):
+        aiBugIds = oScanner.bug_ids(oCommit.message())
+      if aiBugIds:
+        atLinks.append((oCommit.sha, aiBugIds, oCommit.refs))
+        # the bugs commented by an earlier run, which failed on others
+        aiPosted = oIndex.posted(oCommit.sha)
+        aiBugIds = [x for x in aiBugIds if x not in aiPosted]
+      if not aiBugIds:
+        asDone.append(oCommit.sha)
+        continue
+      if oDiffStat is not None:
+        oCommit.diffstat = oDiffStat.get(oCommit)
+      if oTemplate.compiled:
+        oCommit.formatted = oTemplate.render(oCommit)
+      sComment = oTemplate.comment(oCommit)
+      for iBugId in aiBugIds:
+        dMessages.setdefault(iBugId, []).append((oCommit.sha, sComment))
+
+    dComments = OrderedDict((x, split_comments(y, iMaxCommentSize)) for (x, y) in dMessages.items())
+    for atComments in dComments.values():
+      for (sComment, asShas) in atComments:
+        for sSha in asShas:
+          diPending[sSha] = diPending.get(sSha, 0) + 1
+    oMetrics.count("bugs_referenced", len(dComments))
+
+    if oBugIndex is not None and not bDryRun:
+      oBugIndex.add(atLinks)
+
+    if bDryRun:
+      aiResults[0] += len(aoBatch)
+      aiResults[1] += sum(len(x) for x in dComments.values())
+      return
+
+    oIndex.add(asDone)
+    aiResults[0] += len(asDone)
+    aoFutures = dict((oPool.submit(post, x, y), (x, y)) for (x, y) in dComments.items())
+    aoRecorded = set()
+
+    def record(oFuture):
+      aoRecorded.add(oFuture)
+      (iBugId, atComments) = aoFutures[oFuture]
+      aasPosted = oFuture.result()
+      aiResults[1] += len(aasPosted)
+      aiResults[2] += len(atComments) - len(aasPosted)
+      # the commits are recorded as soon as all their comments are posted,
+      # the others remember which of their bugs are done.
+      asDone = []
+      atPartial = []
+      for asShas in aasPosted:
+        for sSha in asShas:
+          diPending[sSha] -= 1
+          if diPending[sSha]:
+            atPartial.append((sSha, iBugId))
+          else:
+            asDone.append(sSha)
+      oIndex.add_posted(atPartial)
+      oIndex.add(asDone)
+      aiResults[0] += len(asDone)
+
+    try:
+      for oFuture in as_completed(aoFutures):
+        record(oFuture)
+    except BaseException:
+      # interrupted: the bugs not started yet are left for the next run,
+      # the comments being posted are waited for and recorded.
+      for oFuture in aoFutures:
+        oFuture.cancel()
+      for oFuture in aoFutures:
+        if oFuture not in aoRecorded and not oFuture.cancelled():
+          record(oFuture)
+      raise
+
+  try:
+    aoBatch = []
+    atLinks = []
+    aoCommits = get_commits(asRevArgs, oTemplate.sGitFormatSpec, False, bSource=oBugIndex is not None)
+    for oCommit in oMetrics.timed(aoCommits, "git"):
+      oMetrics.count("commits_scanned")
+      if oIndex.contains(oCommit.sha):
+        oMetrics.count("commits_skipped")
+        if oBugIndex is not None and not bDryRun:
+          aiBugIds = oScanner.bug_ids(oCommit.message())
+          if aiBugIds:
+            atLinks.append((oCommit.sha, aiBugIds, oCommit.refs))
+          if len(atLinks) >= iBatchSize:
+            oBugIndex.add(atLinks)
+            atLinks = []
+        continue
+      aoBatch.append(oCommit)
+      if len(aoBatch) >= iBatchSize:
+        run_batch(aoBatch)
+        logger.info("backfill: %d commit(s) processed, %d comment(s) posted, %d failed" % tuple(aiResults))
+        aoBatch = []
+    if aoBatch:
+      run_batch(aoBatch)
+    if atLinks:
+      oBugIndex.add(atLinks)
+  finally:
+    if oPool is not None:
+      oPool.shutdown(wait=True)
+    if oDiffStat is not None:
+      oDiffStat.close()
+    oLockFile.close()
+
+  oMetrics.count("comments", aiResults[1])
+  return tuple(aiResults)
@@ -0,0 +1,447 @@
+
+"""
+benchmarks - performance measurements for gitzilla.
+
+Run as:
+
+    python -m gitzilla.benchmarks scanner [commits]
+    python -m gitzilla.benchmarks startup [repeat]
+    python -m gitzilla.benchmarks settings [repositories]
+    python -m gitzilla.benchmarks pipeline [commits [refs [latency_ms [failure_percent]]]]
+
+or as gitzilla-bench. With --json, the results are printed as JSON, to
+be kept and compared across versions.
+
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import contextlib
+import subprocess
+import tracemalloc
+import collections
+import socketserver
+import xmlrpc.client
+import xmlrpc.server
+import gitzilla
+from gitzilla import oDefaultBugRegex
+from gitzilla.bugrefs import BugScanner
+
+
+asWords = ["fix", "the", "frobnicator", "when", "parsing", "large", "inputs",
+           "refactor", "cleanup", "handle", "errors", "in", "module", "again"]
+
+
+def make_messages(iCommits, fBugDensity=0.7, iMessageSize=400, iSeed=0):
+  """
+  returns iCommits synthetic commit messages of about iMessageSize
+  characters. fBugDensity is the fraction of messages referring to bugs.
+  """
+  oRandom = random.Random(iSeed)
+  asMessages = []
+  for i in range(iCommits):
+    asBody = []
+    while sum(len(x) + 1 for x in asBody) < iMessageSize:
+      asBody.append(oRandom.choice(asWords))
+    if oRandom.random() < fBugDensity:
+      for j in range(oRandom.randint(1, 3)):
+        asBody.insert(oRandom.randint(0, len(asBody)),
+                      oRandom.choice(["bug %d", "Bug #%d", "Fixes: #%d",
+                                      "http://bugs/show_bug.cgi?id=%d"]) % (oRandom.randint(1, 99999),))
+    asMessages.append(" ".join(asBody))
+  return asMessages
+
+
+def _time(fnRun, iRepeat):
+  fBest = None
+  for i in range(iRepeat):
+    fStart = time.perf_counter()
+    fnRun()
+    fElapsed = time.perf_counter() - fStart
+    if fBest is None or fElapsed < fBest:
+      fBest = fElapsed
+  return fBest
+
+
+def bench_scanner(iCommits=20000, iRepeat=5):
+  """
+  compares the former double scan of each commit message (re.search, then
+  re.finditer) with bugrefs.BugScanner, for the default bug regex as well
+  as for three combined patterns. Returns a dict of the best timings, in
+  seconds.
+  """
+  asMessages = make_messages(iCommits)
+  aoPatterns = [oDefaultBugRegex,
+                re.compile(r"Fixes:\s*#(?P<bug>\d+)", oDefaultBugRegex.flags),
+                re.compile(r"show_bug\.cgi\?id=(?P<bug>\d+)", oDefaultBugRegex.flags)]
+
+  def double_scan(aoRegexes):
+    for sMessage in asMessages:
+      for oRegex in aoRegexes:
+        if re.search(oRegex, sMessage) is None:
+          continue
+        aiBugIds = []
+        for oMatch in re.finditer(oRegex, sMessage):
+          iBugId = int(oMatch.group("bug"))
+          if iBugId not in aiBugIds:
+            aiBugIds.append(iBugId)
+
+  def single_scan(oScanner):
+    for sMessage in asMessages:
+      oScanner.bug_ids(sMessage)
+
+  oDefaultScanner = BugScanner([oDefaultBugRegex])
+  oMultiScanner = BugScanner(aoPatterns)
+  return {
+    "commits": iCommits,
+    "double_scan_default": _time(lambda: double_scan(aoPatterns[:1]), iRepeat),
+    "scanner_default": _time(lambda: single_scan(oDefaultScanner), iRepeat),
+    "double_scan_3_patterns": _time(lambda: double_scan(aoPatterns), iRepeat),
+    "scanner_3_patterns": _time(lambda: single_scan(oMultiScanner), iRepeat),
+  }
+
+
+def bench_startup(iRepeat=20):
+  """
+  measures how long the hook scripts take to start (and, for refs which
+  are not processed, to finish), each in a fresh interpreter as git runs
+  them. A bare interpreter start is timed as the baseline. Returns a dict
+  of the best timings, in seconds, and of the number of modules loaded by
+  importing gitzilla.hookscripts.
+  """
+  dEnv = dict(os.environ)
+  dEnv["PYTHONPATH"] = os.pathsep.join([x for x in sys.path if x])
+
+  def run(sCode):
+    return subprocess.run([sys.executable, "-c", sCode], env=dEnv, check=True,
+                          input=b"", stdout=subprocess.PIPE).stdout
+
+  import shutil
+
+  # the settings cache too, so the runs leave nothing in ~/.cache
+  sDir = tempfile.mkdtemp(prefix="gitzilla-bench-")
+  try:
+    sConfigFile = os.path.join(sDir, "gitzillarc")
+    with open(sConfigFile, "w") as oFile:
+      # never contacted: none of these runs needs Bugzilla.
+      oFile.write("[DEFAULT]\nbugzilla_url: http://127.0.0.1:9/xmlrpc.cgi\n"
+                  "allowed_bug_states: NEW, ASSIGNED\n")
+
+    sSetup = ("import sys, gitzilla.hookscripts as h; h.sSiteConfigFile = %r; h.sSettingsCacheDir = %r; "
+              % (sConfigFile, os.path.join(sDir, "settings")))
+    sUpdate = sSetup + "sys.argv = ['update', 'refs/tags/v1', %r, %r]; h.update()" % ("0" * 40, "1" * 40)
+    sPostReceive = sSetup + "h.post_receive([(%r, %r, 'refs/tags/v1')])" % ("0" * 40, "1" * 40)
+    return {
+      "interpreter": _time(lambda: run("pass"), iRepeat),
+      "import_hookscripts": _time(lambda: run("import gitzilla.hookscripts"), iRepeat),
+      "update_ignored_ref": _time(lambda: run(sUpdate), iRepeat),
+      "post_receive_ignored_ref": _time(lambda: run(sPostReceive), iRepeat),
+      "modules_hookscripts": int(run("import sys; n = len(sys.modules); import gitzilla.hookscripts; print(len(sys.modules) - n)")),
+    }
+  finally:
+    shutil.rmtree(sDir)
+
+
+def bench_settings(iRepos=4000, iRepeat=5):
+  """
+  compares parsing a site configuration with a section for each of
+  iRepos repositories, as every hook run used to, with loading the
+  compiled settings of one repository. Returns a dict of the best
+  timings, in seconds.
+  """
+  import shutil
+  import gitzilla.hookscripts as hookscripts
+
+  sDir = tempfile.mkdtemp(prefix="gitzilla-bench-")
+  tSaved = (hookscripts.sSiteConfigFile, hookscripts.sUserConfigFile, hookscripts.sSettingsCacheDir)
+  try:
+    hookscripts.sSiteConfigFile = os.path.join(sDir, "gitzillarc")
+    hookscripts.sUserConfigFile = os.path.join(sDir, "user-gitzillarc")
+    hookscripts.sSettingsCacheDir = os.path.join(sDir, "settings")
+    with open(hookscripts.sSiteConfigFile, "w") as oFile:
+      oFile.write("[DEFAULT]\nuser_config: deny\nallowed_bug_states: NEW, ASSIGNED, REOPENED\n")
+      for i in range(iRepos):
+        oFile.write("\n[/srv/git/repo%d.git]\nbugzilla_url: https://bugs%d.example.com/xmlrpc.cgi\n"
+                    "bugzilla_user: git@example.com\nbugzilla_password: secret\n" % (i, i % 7))
+    sRepo = "/srv/git/repo%d.git" % (iRepos // 2,)
+
+    def parse():
+      hookscripts._tConfigs = None
+      (siteconfig, userconfig) = hookscripts.get_configs()
+      hookscripts.get_bz_data(siteconfig, userconfig, sRepo)
+
+    def load():
+      (siteconfig, userconfig) = hookscripts.get_repo_configs(sRepo)
+      hookscripts.get_bz_data(siteconfig, userconfig, sRepo)
+
+    load()
+    return {
+      "repositories": iRepos,
+      "parse_config": _time(parse, iRepeat),
+      "compiled_settings": _time(load, iRepeat),
+    }
+  finally:
+    (hookscripts.sSiteConfigFile, hookscripts.sUserConfigFile, hookscripts.sSettingsCacheDir) = tSaved
+    hookscripts._tConfigs = None
+    shutil.rmtree(sDir)
+
+
+class _XMLRPCServer(socketserver.ThreadingMixIn, xmlrpc.server.SimpleXMLRPCServer):
+  daemon_threads = True
+
+
+
+class FakeBugzilla(object):
+  """
+  a local stand-in for the Bugzilla XMLRPC API (User.login, Bug.get and
+  Bug.add_comment), served from a thread.
+
+  Every request takes fLatency seconds, and a fraction fFailureRate of the
+  Bug.get and Bug.add_comment requests fail with a Fault. Every bug
+  exists, and is NEW unless listed in dStatuses. dCalls counts the
+  requests by method, and dComments collects the comments by bug.
+  """
+
+  def __init__(self, fLatency=0.0, fFailureRate=0.0, dStatuses=None, iSeed=0):
+    self.fLatency = fLatency
+    self.fFailureRate = fFailureRate
+    self.dStatuses = dStatuses or {}
+    self._oRandom = random.Random(iSeed)
+    self._oLock = threading.Lock()
+    self.reset()
+
+    self._oServer = _XMLRPCServer(("127.0.0.1", 0), logRequests=False, allow_none=True)
+    self._oServer.RequestHandlerClass.rpc_paths = ("/xmlrpc.cgi",)
+    self._oServer.register_function(self._login, "User.login")
+    self._oServer.register_function(self._get, "Bug.get")
+    self._oServer.register_function(self._add_comment, "Bug.add_comment")
+    self.url = "http://127.0.0.1:%d/xmlrpc.cgi" % (self._oServer.server_address[1],)
+    self._oThread = threading.Thread(target=self._oServer.serve_forever)
+    self._oThread.daemon = True
+    self._oThread.start()
+
+
+  def reset(self):
+    self.dCalls = collections.Counter()
+    self.dComments = collections.defaultdict(list)
+
+
+  def _request(self, sMethod, bMayFail=True):
+    with self._oLock:
+      self.dCalls[sMethod] += 1
+      bFail = bMayFail and self._oRandom.random() < self.fFailureRate
+    time.sleep(self.fLatency)
+    if bFail:
+      self.dCalls["failed"] += 1
+      raise xmlrpc.client.Fault(1, "injected failure")
+
+
+  def _login(self, dParams):
+    self._request("User.login", False)
+    return {"id": 1, "token": "1-benchmark"}
+
+
+  def _get(self, dParams):
+    self._request("Bug.get")
+    return {"bugs": [{"id": int(x), "status": self.dStatuses.get(int(x), "NEW")} for x in dParams["ids"]],
+            "faults": []}
+
+
+  def _add_comment(self, dParams):
+    self._request("Bug.add_comment")
+    with self._oLock:
+      self.dComments[int(dParams["id"])].append(dParams["comment"])
+    return {"id": 1}
+
+
+  def close(self):
+    self._oServer.shutdown()
+    self._oServer.server_close()
+
+
+
+def make_repo(sDir, iCommits=2000, iRefs=10, fBugDensity=0.7, iMessageSize=400, iSeed=0):
+  """
+  creates a git repository in sDir with iCommits synthetic commits (see
+  make_messages), spread over iRefs branches forked from a common root.
+  The branches are kept outside of refs/heads/, so that they can be
+  pushed as new refs. Returns the pushes, as (sOldRev, sNewRev, sRefName)
+  tuples creating refs/heads/bench-N.
+  """
+  subprocess.check_call(["git", "init", "-q", sDir])
+  asMessages = make_messages(iCommits, fBugDensity, iMessageSize, iSeed)
+
+  def data(sText):
+    abText = sText.encode("utf-8")
+    return b"data %d\n%s\n" % (len(abText), abText)
+
+  aabInput = [b"commit refs/heads/main\nmark :1\ncommitter Bench <bench@example.com> 1500000000 +0000\n",
+              data("root"), b"M 100644 inline README\n", data("benchmark\n")]
+  for i in range(iCommits):
+    iRef = i % iRefs
+    asWords = asMessages[i].split(" ")
+    aabInput.append(b"commit refs/bench/%d\ncommitter Bench <bench@example.com> %d +0000\n" % (iRef, 1500000001 + i))
+    aabInput.append(data("%s\n\n%s" % (" ".join(asWords[:8]), " ".join(asWords[8:]))))
+    if i < iRefs:
+      aabInput.append(b"from :1\n")
+    aabInput.append(b"M 100644 inline dir%d/file%d\n" % (iRef, i % 50))
+    aabInput.append(data("%d\n" % (i,)))
+
+  subprocess.run(["git", "fast-import", "--quiet"], input=b"".join(aabInput),
+                 cwd=sDir, check=True)
+  sRefs = subprocess.check_output(["git", "for-each-ref", "--format=%(refname) %(objectname)", "refs/bench/"],
+                                  cwd=sDir).decode("utf-8")
+  aasPushes = []
+  for sLine in sRefs.splitlines():
+    (sRefName, sSha) = sLine.split(" ")
+    aasPushes.append(("0" * 40, sSha, "refs/heads/bench-%s" % (sRefName.rsplit("/", 1)[1],)))
+  return aasPushes
+
+
+def _make_git_counter(sDir):
+  """
+  puts a git wrapper counting its invocations in sDir. Returns the
+  (sBinDir, sLogFile) pair: sBinDir must come first in $PATH, and
+  sLogFile gets a line per git process.
+  """
+  sBinDir = os.path.join(sDir, "bin")
+  sLogFile = os.path.join(sDir, "git-calls")
+  os.mkdir(sBinDir)
+  sGit = os.path.join(sBinDir, "git")
+  with open(sGit, "w") as oFile:
+    oFile.write("#!/bin/sh\necho \"$1\" >> '%s'\nexec '%s' \"$@\"\n" % (sLogFile, shutil.which("git")))
+  os.chmod(sGit, 0o755)
+  return (sBinDir, sLogFile)
+
+
+def _measure(fnRun, oBZ, sGitLog):
+  """
+  runs fnRun, returning its wall time, the Bugzilla requests and the git
+  processes it made, and its peak (Python) memory use. The times include
+  the overhead of tracing the memory allocations.
+  """
+  oBZ.reset()
+  open(sGitLog, "w").close()
+  iStatus = 0
+  tracemalloc.start()
+  fStart = time.perf_counter()
+  try:
+    with contextlib.redirect_stdout(io.StringIO()):
+      fnRun()
+  except SystemExit as e:
+    iStatus = e.code
+  fElapsed = time.perf_counter() - fStart
+  iPeak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+
+  with open(sGitLog) as oFile:
+    asGitCalls = oFile.read().split()
+  return {
+    "seconds": fElapsed,
+    "exit_status": iStatus,
+    "bugzilla_requests": dict(oBZ.dCalls),
+    "bugs_commented": len(oBZ.dComments),
+    "git_processes": len(asGitCalls),
+    "git_commands": dict(collections.Counter(asGitCalls)),
+    "peak_memory_bytes": iPeak,
+  }
+
+
+def bench_pipeline(iCommits=2000, iRefs=10, iLatencyMs=20, iFailurePercent=0):
+  """
+  runs the post-receive, pre-receive and update hooks (the latter once per
+  pushed ref, as git does) end-to-end on a synthetic repository, against
+  a FakeBugzilla with iLatencyMs of latency per request and
+  iFailurePercent percent of failing requests. Returns a dict with the
+  measurements of each hook (see _measure) and the benchmark parameters.
+  """
+  import gitzilla.hooks
+  from gitzilla.bugwrap import BugzillaWrapper
+
+  sDir = tempfile.mkdtemp(prefix="gitzilla-bench-")
+  sCwd = os.getcwd()
+  sPath = os.environ.get("PATH", "")
+  asArgv = sys.argv
+  oBZ = FakeBugzilla(iLatencyMs / 1000.0, iFailurePercent / 100.0)
+  try:
+    sRepo = os.path.join(sDir, "repo")
+    aasPushes = make_repo(sRepo, iCommits, iRefs)
+    (sBinDir, sGitLog) = _make_git_counter(sDir)
+    os.environ["PATH"] = sBinDir + os.pathsep + sPath
+    os.chdir(sRepo)
+
+    # a new wrapper (and login) per hook run, as in separate processes
+    def bz_wrap(sBZUrl, sBZUser, sBZPasswd):
+      return BugzillaWrapper(sBZUrl, sBZUser, sBZPasswd)
+
+    def run_update():
+      for (sOldRev, sNewRev, sRefName) in aasPushes:
+        sys.argv = ["update", sRefName, sOldRev, sNewRev]
+        gitzilla.hooks.update(asAllowedStatuses=["NEW"], sBZUrl=oBZ.url, sBZUser="bench",
+                              sBZPasswd="bench", bz_wrap=bz_wrap, bRequireBugNumber=False)
+
+    dResults = {
+      "gitzilla_version": gitzilla.__version__,
+      "python_version": sys.version.split()[0],
+      "commits": iCommits,
+      "refs": iRefs,
+      "latency_ms": iLatencyMs,
+      "failure_percent": iFailurePercent,
+    }
+    dResults["update"] = _measure(run_update, oBZ, sGitLog)
+    dResults["pre_receive"] = _measure(
+        lambda: gitzilla.hooks.pre_receive(asAllowedStatuses=["NEW"], sBZUrl=oBZ.url, sBZUser="bench",
+                                           sBZPasswd="bench", bz_wrap=bz_wrap, bRequireBugNumber=False,
+                                           aasPushes=aasPushes),
+        oBZ, sGitLog)
+    dResults["post_receive"] = _measure(
+        lambda: gitzilla.hooks.post_receive(oBZ.url, "bench", "bench", bz_wrap=bz_wrap,
+                                            aasPushes=aasPushes),
+        oBZ, sGitLog)
+    return dResults
+  finally:
+    sys.argv = asArgv
+    os.chdir(sCwd)
+    os.environ["PATH"] = sPath
+    oBZ.close()
+    shutil.rmtree(sDir)
+
+
+def main(asArgs=None):
+  if asArgs is None:
+    asArgs = sys.argv[1:]
+
+  bJSON = "--json" in asArgs
+  asArgs = [x for x in asArgs if x != "--json"]
+  if not asArgs or asArgs[0] not in dBenchmarks:
+    print("usage: gitzilla-bench [--json] {%s} [args...]" % ("|".join(sorted(dBenchmarks)),))
+    sys.exit(1)
+
+  dResult = dBenchmarks[asArgs[0]](*[int(x) for x in asArgs[1:]])
+  if bJSON:
+    print(json.dumps({"benchmark": asArgs[0], "time": time.time(), "results": dResult},
+                     indent=2, sort_keys=True))
+    return
+
+  for (sName, oValue) in sorted(dResult.items()):
+    print("%-24s %s" % (sName, oValue))
+
+
+dBenchmarks = {
+  "scanner": bench_scanner,
+  "startup": bench_startup,
+  "settings": bench_settings,
+  "pipeline": bench_pipeline,
+}
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,130 @@
+
+"""
+breaker - a circuit breaker shared by the hook processes.
+
+When Bugzilla is down, every hook run would otherwise wait for its own
+requests to time out. The Bugzilla wrappers record the outcome of their
+calls in a CircuitBreaker: after iThreshold calls in a row failed to get
+an answer, the circuit opens and the calls fail at once for fCooldown
+seconds. Then a single call is let through to probe Bugzilla, closing the
+circuit again if it gets an answer.
+
+The state is kept in a small JSON file, one entry per Bugzilla URL, so
+that all the hook processes (and gitzillad's children) share it.
+
+"""
+
+import os
+import json
+import time
+import fcntl
+from gitzilla import iDefaultCircuitThreshold, fDefaultCircuitCooldown
+
+
+class CircuitBreaker(object):
+  """
+  the circuit of the Bugzilla at sKey (its URL), kept in the file sPath.
+  Errors reading or writing the file are ignored: the circuit then stays
+  closed, it never keeps Bugzilla from being used.
+  """
+
+  def __init__(self, sPath, sKey, iThreshold=None, fCooldown=None):
+    if iThreshold is None:
+      iThreshold = iDefaultCircuitThreshold
+
+    if fCooldown is None:
+      fCooldown = fDefaultCircuitCooldown
+
+    self._sPath = sPath
+    self._sKey = sKey
+    self._iThreshold = iThreshold
+    self._fCooldown = fCooldown
+
+
+  def _read(self):
+    try:
+      with open(self._sPath) as oFile:
+        return json.load(oFile)
+    except (IOError, OSError, ValueError):
+      return {}
+
+
+  def _update(self, fnChange):
+    """
+    calls fnChange(dEntry) on the entry of the circuit, under a lock, and
+    stores the entry it returns (removing it if None). Returns what
+    fnChange returned.
+    """
+    try:
+      with open(self._sPath + ".lock", "a") as oLockFile:
+        fcntl.flock(oLockFile, fcntl.LOCK_EX)
+        dState = self._read()
+        dEntry = fnChange(dState.get(self._sKey))
+        if dEntry is None:
+          if self._sKey not in dState:
+            return dEntry
+          del dState[self._sKey]
+        else:
+          dState[self._sKey] = dEntry
+        sTmpPath = "%s.%d" % (self._sPath, os.getpid())
+        with open(sTmpPath, "w") as oFile:
+          json.dump(dState, oFile)
+        os.rename(sTmpPath, self._sPath)
+        return dEntry
+    except (IOError, OSError):
+      return None
+
+
+  def is_open(self):
+    """
+    tells whether calls are currently refused.
+    """
+    dEntry = self._read().get(self._sKey)
+    return (dEntry is not None and dEntry["failures"] >= self._iThreshold
+            and dEntry["open_until"] > time.time())
+
+
+  def allow(self):
+    """
+    tells whether a call may be made now. Once the cooldown is over, only
+    the first caller is allowed (as a probe); the others keep being
+    refused until its outcome is known or another cooldown is over.
+    """
+    dEntry = self._read().get(self._sKey)
+    if dEntry is None or dEntry["failures"] < self._iThreshold:
+      return True
+    if dEntry["open_until"] > time.time():
+      return False
+
+    atProbe = []
+    def claim(dEntry):
+      fNow = time.time()
+      if dEntry is not None and dEntry["failures"] >= self._iThreshold and dEntry["open_until"] <= fNow:
+        dEntry["open_until"] = fNow + self._fCooldown
+        atProbe.append(True)
+      return dEntry
+    self._update(claim)
+    return bool(atProbe)
+
+
+  def success(self):
+    """
+    records a call which got an answer, closing the circuit.
+    """
+    if self._sKey in self._read():
+      self._update(lambda dEntry: None)
+
+
+  def failure(self):
+    """
+    records a call which got no answer, opening the circuit after
+    iThreshold of them in a row.
+    """
+    def count(dEntry):
+      if dEntry is None:
+        dEntry = {"failures": 0, "open_until": 0}
+      dEntry["failures"] += 1
+      if dEntry["failures"] >= self._iThreshold:
+        dEntry["open_until"] = time.time() + self._fCooldown
+      return dEntry
+    self._update(count)
@@ -0,0 +1,111 @@
+
+"""
+bugrefs - finding bug references in commit messages.
+
+"""
+
+import re
+from gitzilla import oDefaultBugRegex
+
+
+iDefaultFlags = re.MULTILINE | re.DOTALL | re.IGNORECASE
+
+oInlineFlagsRegex = re.compile(r"\(\?([aiLmsux]+)\)")
+
+dInlineFlags = {"a": re.ASCII, "i": re.IGNORECASE, "L": re.LOCALE, "m": re.MULTILINE,
+                "s": re.DOTALL, "u": re.UNICODE, "x": re.VERBOSE}
+
+
+class BugScanner(object):
+  """
+  finds the bug references in a text with a single pass.
+
+  aoPatterns is a list of regexes (strings, or compiled regexes), each of
+  which MUST provide a named group called 'bug' with the bug id. They are
+  combined into one compiled regex, so a text is scanned once, however
+  many patterns there are. String patterns are compiled with the
+  MULTILINE, DOTALL and IGNORECASE options; compiled patterns keep their
+  own options. Leading inline flags such as '(?i)' are allowed.
+  """
+
+  def __init__(self, aoPatterns):
+    iFlags = 0
+    asAlternatives = []
+    self._asGroups = []
+    for (i, oPattern) in enumerate(aoPatterns):
+      if isinstance(oPattern, str):
+        sPattern = oPattern
+        iPatternFlags = iDefaultFlags
+      else:
+        sPattern = oPattern.pattern
+        iPatternFlags = oPattern.flags
+      # leading inline flags, e.g. '(?i)', are only allowed at the start
+      # of the whole regex (those of compiled patterns are in their flags
+      # already).
+      oMatch = oInlineFlagsRegex.match(sPattern)
+      while oMatch is not None:
+        for sFlag in oMatch.group(1):
+          iPatternFlags |= dInlineFlags[sFlag]
+        sPattern = sPattern[oMatch.end():]
+        oMatch = oInlineFlagsRegex.match(sPattern)
+      # the flags which can be are scoped to the pattern, the others apply
+      # to the combined regex (UNICODE is the default for str patterns, and
+      # would conflict with ASCII).
+      sOn = "".join(x for x in "imsx" if iPatternFlags & dInlineFlags[x])
+      sOff = "".join(x for x in "imsx" if not iPatternFlags & dInlineFlags[x])
+      iFlags |= iPatternFlags & (re.ASCII | re.LOCALE)
+      # group names must be unique in the combined regex
+      sGroup = "bug%d" % (i,)
+      sPattern = sPattern.replace("(?P<bug>", "(?P<%s>" % (sGroup,))
+      sPattern = sPattern.replace("(?P=bug)", "(?P=%s)" % (sGroup,))
+      asAlternatives.append("(?%s%s:%s)" % (sOn, sOff and "-" + sOff, sPattern))
+      self._asGroups.append(sGroup)
+
+    self.pattern = "|".join(asAlternatives)
+    self.flags = iFlags
+    self._oRegex = re.compile(self.pattern, iFlags)
+
+
+  def scan(self, sText):
+    """
+    returns a list of (iBugId, iPosition) tuples, one for each bug referred
+    to in sText, at the position of its first reference.
+    """
+    aFound = []
+    aiSeen = set()
+    for oMatch in self._oRegex.finditer(sText):
+      for sGroup in self._asGroups:
+        sBugId = oMatch.group(sGroup)
+        if sBugId is not None:
+          iBugId = int(sBugId)
+          if iBugId not in aiSeen:
+            aiSeen.add(iBugId)
+            aFound.append((iBugId, oMatch.start(sGroup)))
+          break
+    return aFound
+
+
+  def bug_ids(self, sText):
+    """
+    returns the ids of the bugs referred to in sText, without duplicates,
+    in the order of their first reference.
+    """
+    return [x[0] for x in self.scan(sText)]
+
+
+
+def get_scanner(oBugRegex=None):
+  """
+  returns a BugScanner for oBugRegex, which may be None (the default bug
+  regex), a BugScanner, a single regex or a list of regexes.
+  """
+  if oBugRegex is None:
+    oBugRegex = oDefaultBugRegex
+
+  if isinstance(oBugRegex, BugScanner):
+    return oBugRegex
+
+  if isinstance(oBugRegex, (list, tuple)):
+    return BugScanner(oBugRegex)
+
+  return BugScanner([oBugRegex])
@@ -1,13 +1,123 @@
 """
-Interface to pybugz.
+Interface to the Bugzilla XMLRPC API.
 
 Attempts to abstract away the major shifts that have happened to the
-pybugz interface recently so it will work with several versions.
+pybugz interface recently so it will work with several versions. By
+default the standard library XMLRPC client is used instead of pybugz,
+as it keeps its HTTP(S) connection alive between calls.
 """
 
 _pybugz_xmlrpc = False
 
-from bugz.bugzilla import BugzillaProxy as BugzillaProxy
+import os
+import json
+import time
+import threading
+
+from gitzilla.metrics import NullMetrics
+from gitzilla import fDefaultBZTimeout, iDefaultBZRetries, fDefaultBZBackoff, fDefaultBZDeadline
+
+
+# the calls which may be made again when no answer came back: repeating
+# one which Bugzilla did carry out does no harm.
+idempotent_methods = frozenset(['User.login', 'Bug.get'])
+
+
+class BugzillaUnavailable(IOError):
+    """Bugzilla did not answer: it could not be reached, it timed out or
+    failed with a server error, even after retrying. A Fault (an error
+    returned by Bugzilla) is not such an error."""
+
+
+class CircuitOpen(BugzillaUnavailable):
+    """Bugzilla was not called, as it is known to be unavailable (see
+    breaker.CircuitBreaker)."""
+
+
+def is_transient(error):
+    """Tells whether error means that Bugzilla did not answer a call, so
+    that trying again later may work. A certificate which does not verify
+    or a TLS handshake which fails fails again: only the SSL errors of a
+    connection cut short are transient."""
+    import ssl
+    import http.client
+    import xmlrpc.client
+    if isinstance(error, xmlrpc.client.ProtocolError):
+        return error.errcode == 0 or error.errcode >= 500 or error.errcode in (408, 429)
+    if isinstance(error, ssl.SSLError):
+        return isinstance(error, (ssl.SSLEOFError, ssl.SSLZeroReturnError, ssl.SSLSyscallError,
+                                  ssl.SSLWantReadError, ssl.SSLWantWriteError))
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+
+def make_transport(url, timeout, cookies=None):
+    """Returns an XMLRPC transport for url whose connections give up
+    after timeout seconds without progress (see the timeout attribute).
+
+    If cookies, a dict, is given, the cookies Bugzilla sets are stored in
+    it, and sent back with every request: Bugzillas older than 4.4.3
+    return no login token, the login cookies keep the session instead.
+    The same dict may be shared by the transports of several threads."""
+    import xmlrpc.client
+    if url.startswith('https:'):
+        base = xmlrpc.client.SafeTransport
+    else:
+        base = xmlrpc.client.Transport
+
+    class TimeoutTransport(base):
+        def make_connection(self, host):
+            connection = base.make_connection(self, host)
+            connection.timeout = self.timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(self.timeout)
+            return connection
+
+        def send_headers(self, connection, headers):
+            if cookies:
+                headers = list(headers) + [('Cookie', '; '.join(
+                    '%s=%s' % item for item in sorted(cookies.items())))]
+            base.send_headers(self, connection, headers)
+
+        def parse_response(self, response):
+            if cookies is not None:
+                from http.cookies import SimpleCookie, CookieError
+                for header in response.msg.get_all('Set-Cookie') or []:
+                    try:
+                        cookie = SimpleCookie(header)
+                    except CookieError:
+                        continue
+                    for (name, morsel) in cookie.items():
+                        cookies[name] = morsel.value
+            return base.parse_response(self, response)
+
+    transport = TimeoutTransport()
+    transport.timeout = timeout
+    return transport
+
+
+def load_token(token_file, key):
+    """Returns the login token stored under key in token_file, if any."""
+    try:
+        with open(token_file) as f:
+            return json.load(f).get(key)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def store_token(token_file, key, token):
+    """Stores the login token under key in token_file, which only its
+    owner may read."""
+    try:
+        with open(token_file) as f:
+            tokens = json.load(f)
+    except (IOError, OSError, ValueError):
+        tokens = {}
+    tokens[key] = token
+    tmp_file = "%s.%d" % (token_file, os.getpid())
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(tokens, f)
+    os.rename(tmp_file, token_file)
 
 
 class BugzillaWrapper(object):
@@ -17,36 +127,208 @@ class BugzillaWrapper(object):
 
     If this is overridden by hook scripts, you will need to
     monkeypatch the bugz module to have your class in place of this
-    one."""
+    one.
 
-    def __init__(self, url, user, password):
+    An instance may be shared between threads: each thread talks to
+    Bugzilla through its own proxy, while the login is shared. Each
+    proxy keeps its connection to Bugzilla open for the lifetime of the
+    instance, so only the first call of a thread pays for the TCP and
+    TLS handshakes. use_pybugz=True selects the pybugz proxy instead,
+    which opens a new connection for every call.
+
+    If token_file is given, the login token is stored there (readable by
+    the owner only) and reused by later instances for the same url and
+    user, saving the User.login call. A stale token is replaced by
+    logging in again. Bugzillas older than 4.4.3 return no token: the
+    login cookies are then sent back with every call, as pybugz does.
+
+    A request gives up after timeout seconds without an answer. The
+    calls which can safely be repeated (User.login and Bug.get, not
+    Bug.add_comment) are retried up to retries times when Bugzilla does
+    not answer, waiting backoff seconds, then twice as long each time,
+    as long as the call has not taken deadline seconds in all. Calls
+    which still get no answer raise BugzillaUnavailable. The timeout does
+    not apply to the pybugz proxy.
+
+    If circuit_file is given, the calls are recorded in a
+    breaker.CircuitBreaker kept in that file, shared by all the wrappers
+    for url: once circuit_threshold calls in a row got no answer, calls
+    raise CircuitOpen without contacting Bugzilla for circuit_cooldown
+    seconds.
+
+    The requests are timed and counted in metrics (a metrics.Metrics
+    instance), which the hooks set for the length of their run."""
+
+    metrics = NullMetrics()
+
+    def __init__(self, url, user, password, token_file=None, use_pybugz=False,
+                 timeout=fDefaultBZTimeout, retries=iDefaultBZRetries,
+                 backoff=fDefaultBZBackoff, deadline=fDefaultBZDeadline,
+                 circuit_file=None, circuit_threshold=None, circuit_cooldown=None):
         self._url = url
         self._user = user
         self._password = password
-        self._bz = BugzillaProxy(url)
+        self._token_file = token_file
+        self._use_pybugz = use_pybugz
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._deadline = deadline
+        self._breaker = None
+        if circuit_file is not None:
+            from gitzilla.breaker import CircuitBreaker
+            self._breaker = CircuitBreaker(circuit_file, url, circuit_threshold, circuit_cooldown)
+        self._local = threading.local()
+        self._lock = threading.Lock()
         self._authed = False
+        self._token_cached = False
+        # the login cookies, for Bugzillas which return no token
+        self._cookies = {}
+
+    @property
+    def _bz(self):
+        bz = getattr(self._local, 'bz', None)
+        if bz is None:
+            if self._use_pybugz:
+                from bugz.bugzilla import BugzillaProxy
+                bz = BugzillaProxy(self._url)
+            else:
+                import xmlrpc.client
+                self._local.transport = make_transport(self._url, self._timeout,
+                                                       self._cookies)
+                bz = xmlrpc.client.ServerProxy(self._url, allow_none=True,
+                                               transport=self._local.transport)
+            self._local.bz = bz
+        return bz
+
+    def reset_connections(self):
+        """Forgets the open connections to Bugzilla, keeping the login.
+        Must be called in a child process after a fork."""
+        self._local = threading.local()
+
+    def _token_key(self):
+        return "%s %s" % (self._url, self._user)
+
+    def _request(self, method, params):
+        """Makes the XMLRPC call method with params, retrying it if it is
+        idempotent and Bugzilla does not answer."""
+        idempotent = method in idempotent_methods
+        if self._deadline is not None:
+            deadline = time.time() + self._deadline
+        attempt = 0
+        while True:
+            if self._breaker is not None and not self._breaker.allow():
+                self.metrics.count('circuit_open')
+                raise CircuitOpen("Bugzilla at %s is unavailable, not calling %s"
+                                  % (self._url, method))
+            function = self._bz
+            for name in method.split('.'):
+                function = getattr(function, name)
+            transport = getattr(self._local, 'transport', None)
+            if transport is not None and self._deadline is not None:
+                transport.timeout = max(min(self._timeout, deadline - time.time()), 0.001)
+
+            self.metrics.count('bugzilla_requests')
+            try:
+                with self.metrics.span('bugzilla.' + method):
+                    result = function(params)
+            except Exception as e:
+                if not is_transient(e):
+                    if self._breaker is not None:
+                        self._breaker.success()
+                    raise
+                # the connection may be broken
+                self._local.bz = None
+                wait = self._backoff * 2 ** attempt
+                if (not idempotent or attempt >= self._retries or
+                        (self._deadline is not None and time.time() + wait >= deadline)):
+                    if self._breaker is not None:
+                        self._breaker.failure()
+                    raise BugzillaUnavailable("%s on %s failed: %s" % (method, self._url, e))
+                attempt += 1
+                self.metrics.count('retries')
+                time.sleep(wait)
+                continue
+            if self._breaker is not None:
+                self._breaker.success()
+            return result
+
+    def _login(self):
+        response = self._request('User.login', {'login': self._user,
+                                                'password': self._password})
+        self._authed = True
+        self._token_cached = False
+        if 'token' in response:
+          self._bz_token = response['token']
+          if self._token_file is not None:
+              try:
+                  store_token(self._token_file, self._token_key(), self._bz_token)
+              except (IOError, OSError):
+                  pass
 
     def auth(self):
-        if not self._authed:
-            response = self._bz.User.login({'login': self._user,
-                                            'password': self._password})
-            self._authed = True
-            if 'token' in response:
-              self._bz_token = response['token']
+        with self._lock:
+            if not self._authed:
+                token = None
+                if self._token_file is not None and self._user is not None:
+                    token = load_token(self._token_file, self._token_key())
+                if token is not None:
+                    self._bz_token = token
+                    self._authed = True
+                    self._token_cached = True
+                else:
+                    self._login()
 
-    def bug_status(self, bugid):
+    def _call(self, method, params):
+        """Calls the XMLRPC method (e.g. 'Bug.get') with params, adding
+        the login token. If a token reused from the token_file is
+        refused, logs in again and retries once."""
+        import xmlrpc.client
         self.auth()
-        params = {'ids': [bugid], 'include_fields': ['status']}
-        if hasattr(self, '_bz_token'):
-          params['Bugzilla_token'] = self._bz_token
+        token = getattr(self, '_bz_token', None)
+        call_params = dict(params)
+        if token is not None:
+          call_params['Bugzilla_token'] = token
 
-        bugdat = self._bz.Bug.get(params)
-        return bugdat['bugs'][0]['status']
+        try:
+            return self._request(method, call_params)
+        except xmlrpc.client.Fault:
+            with self._lock:
+                if not self._token_cached:
+                    raise
+                if getattr(self, '_bz_token', None) == token:
+                    self._login()
+            self.metrics.count('retries')
+            return self._call(method, params)
 
-    def add_bug_comment(self, bugid, comment):
-        self.auth()
-        params = {'id': bugid, 'comment': comment}
-        if hasattr(self, '_bz_token'):
-          params['Bugzilla_token'] = self._bz_token
+    def bug_status(self, bugid):
+        return self.bug_statuses([bugid])[bugid]
+
+    def bug_statuses(self, bugids, chunk_size=200, workers=4):
+        """Returns a dict mapping each of bugids to its status, looking
+        them up with as few Bug.get calls as possible (one per chunk_size
+        ids, up to workers of them at the same time). Bugs which do not
+        exist map to None."""
+        statuses = dict((bugid, None) for bugid in bugids)
+        bugids = list(statuses)
+
+        def get_chunk(i):
+            return self._call('Bug.get', {'ids': bugids[i:i + chunk_size],
+                                          'include_fields': ['id', 'status'],
+                                          'permissive': True})
 
-        self._bz.Bug.add_comment(params)
+        chunks = range(0, len(bugids), chunk_size)
+        if len(chunks) > 1 and workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self.auth()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(get_chunk, chunks))
+        else:
+            results = [get_chunk(i) for i in chunks]
+        for bugdat in results:
+            for bug in bugdat['bugs']:
+                statuses[int(bug['id'])] = bug['status']
+        return statuses
+
+    def add_bug_comment(self, bugid, comment):
+        self._call('Bug.add_comment', {'id': bugid, 'comment': comment})
@@ -0,0 +1,218 @@
+
+"""
+cache - on-disk caches of bug statuses and bug references, shared by the
+hook processes.
+
+"""
+
+import sqlite3
+import time
+import hashlib
+from gitzilla import iDefaultStatusCacheTTL, iDefaultStatusCacheSize, iDefaultScanCacheSize
+from gitzilla import NullLogger
+
+
+def _connect(sPath):
+  oDB = sqlite3.connect(sPath, timeout=10)
+  try:
+    oDB.execute("PRAGMA journal_mode=WAL")
+  except sqlite3.Error:
+    pass
+  return oDB
+
+
+
+class StatusCache(object):
+  """
+  caches bug statuses in an SQLite database, keyed by the Bugzilla URL and
+  the bug id.
+
+  Entries older than iTTL seconds are never returned. At most iMaxEntries
+  entries are kept, the ones fetched least recently are evicted first.
+  The database can be shared between any number of concurrent hook
+  processes. A broken or locked cache is logged and treated as empty, it
+  never fails the hook.
+  """
+
+  def __init__(self, sPath, sBZUrl, iTTL=None, iMaxEntries=None, logger=None):
+    if iTTL is None:
+      iTTL = iDefaultStatusCacheTTL
+
+    if iMaxEntries is None:
+      iMaxEntries = iDefaultStatusCacheSize
+
+    if logger is None:
+      logger = NullLogger
+
+    self._sPath = sPath
+    self._sBZUrl = sBZUrl
+    self._iTTL = iTTL
+    self._iMaxEntries = iMaxEntries
+    self._logger = logger
+    self._oDB = None
+    self.iHits = 0
+    self.iMisses = 0
+
+
+  def _db(self):
+    if self._oDB is None:
+      oDB = _connect(self._sPath)
+      oDB.execute("""CREATE TABLE IF NOT EXISTS bug_status (
+                       url TEXT NOT NULL,
+                       bug INTEGER NOT NULL,
+                       status TEXT NOT NULL,
+                       fetched REAL NOT NULL,
+                       PRIMARY KEY (url, bug))""")
+      oDB.execute("""CREATE INDEX IF NOT EXISTS bug_status_fetched
+                     ON bug_status (fetched)""")
+      oDB.commit()
+      self._oDB = oDB
+    return self._oDB
+
+
+  def get(self, aiBugIds):
+    """
+    returns a dict with the fresh cached statuses of the bugs in aiBugIds.
+    Bugs which are not cached (or are stale) are left out.
+    """
+    dStatuses = {}
+    aiBugIds = list(aiBugIds)
+    fOldest = time.time() - self._iTTL
+    try:
+      oDB = self._db()
+      for i in range(0, len(aiBugIds), 500):
+        aiChunk = aiBugIds[i:i + 500]
+        sQuery = ("SELECT bug, status FROM bug_status"
+                  " WHERE url = ? AND fetched >= ? AND bug IN (%s)"
+                  % (", ".join("?" * len(aiChunk)),))
+        for (iBugId, sStatus) in oDB.execute(sQuery, [self._sBZUrl, fOldest] + aiChunk):
+          dStatuses[iBugId] = sStatus
+    except sqlite3.Error:
+      self._logger.exception("Could not read the bug status cache %s" % (self._sPath,))
+
+    self.iHits += len(dStatuses)
+    self.iMisses += len(aiBugIds) - len(dStatuses)
+    return dStatuses
+
+
+  def put(self, dStatuses):
+    """
+    stores the bug id => status pairs in dStatuses. Bugs with a None status
+    (i.e. which do not exist) are not cached.
+    """
+    fNow = time.time()
+    aRows = [(self._sBZUrl, iBugId, sStatus, fNow)
+             for (iBugId, sStatus) in dStatuses.items() if sStatus is not None]
+    if not aRows:
+      return
+
+    try:
+      oDB = self._db()
+      with oDB:
+        oDB.executemany("INSERT OR REPLACE INTO bug_status VALUES (?, ?, ?, ?)", aRows)
+        oDB.execute("DELETE FROM bug_status WHERE fetched < ?", (fNow - self._iTTL,))
+        oDB.execute("""DELETE FROM bug_status WHERE rowid IN (
+                         SELECT rowid FROM bug_status
+                         ORDER BY fetched DESC LIMIT -1 OFFSET ?)""",
+                    (self._iMaxEntries,))
+    except sqlite3.Error:
+      self._logger.exception("Could not update the bug status cache %s" % (self._sPath,))
+
+
+
+class ScanCache(object):
+  """
+  caches the bug ids found in commit messages, keyed by the commit sha and
+  the patterns of the bugrefs.BugScanner which found them. A commit never
+  changes, so the entries never go stale: when a branch is pushed again
+  (to a review ref, then merged), its commits are not scanned again.
+
+  At most iMaxEntries entries are kept, the ones added first are evicted
+  first. Like StatusCache, whose database it may share, a broken or
+  locked cache is logged and treated as empty.
+  """
+
+  def __init__(self, sPath, iMaxEntries=None, logger=None):
+    if iMaxEntries is None:
+      iMaxEntries = iDefaultScanCacheSize
+
+    if logger is None:
+      logger = NullLogger
+
+    self._sPath = sPath
+    self._iMaxEntries = iMaxEntries
+    self._logger = logger
+    self._oDB = None
+    self.iHits = 0
+    self.iMisses = 0
+
+
+  def _db(self):
+    if self._oDB is None:
+      oDB = _connect(self._sPath)
+      oDB.execute("""CREATE TABLE IF NOT EXISTS commit_bugs (
+                       scanner TEXT NOT NULL,
+                       sha TEXT NOT NULL,
+                       bugs TEXT NOT NULL,
+                       added REAL NOT NULL,
+                       PRIMARY KEY (scanner, sha))""")
+      oDB.execute("""CREATE INDEX IF NOT EXISTS commit_bugs_added
+                     ON commit_bugs (added)""")
+      oDB.commit()
+      self._oDB = oDB
+    return self._oDB
+
+
+  def _key(self, oScanner):
+    # the same shas give other bug ids with other patterns
+    sKey = "%d:%s" % (oScanner.flags, oScanner.pattern)
+    return hashlib.sha1(sKey.encode("utf-8")).hexdigest()
+
+
+  def get(self, oScanner, asShas):
+    """
+    returns a dict mapping the shas in asShas which are cached for
+    oScanner to the list of the bug ids found in their messages (possibly
+    empty).
+    """
+    dBugIds = {}
+    asShas = list(asShas)
+    sKey = self._key(oScanner)
+    try:
+      oDB = self._db()
+      for i in range(0, len(asShas), 500):
+        asChunk = asShas[i:i + 500]
+        sQuery = ("SELECT sha, bugs FROM commit_bugs"
+                  " WHERE scanner = ? AND sha IN (%s)"
+                  % (", ".join("?" * len(asChunk)),))
+        for (sSha, sBugIds) in oDB.execute(sQuery, [sKey] + asChunk):
+          dBugIds[sSha] = [int(x) for x in sBugIds.split(",") if x]
+    except sqlite3.Error:
+      self._logger.exception("Could not read the scan cache %s" % (self._sPath,))
+
+    self.iHits += len(dBugIds)
+    self.iMisses += len(asShas) - len(dBugIds)
+    return dBugIds
+
+
+  def put(self, oScanner, dBugIds):
+    """
+    stores the sha => bug ids pairs in dBugIds, as found by oScanner.
+    """
+    if not dBugIds:
+      return
+
+    fNow = time.time()
+    sKey = self._key(oScanner)
+    aRows = [(sKey, sSha, ",".join(str(x) for x in aiBugIds), fNow)
+             for (sSha, aiBugIds) in dBugIds.items()]
+    try:
+      oDB = self._db()
+      with oDB:
+        oDB.executemany("INSERT OR REPLACE INTO commit_bugs VALUES (?, ?, ?, ?)", aRows)
+        oDB.execute("""DELETE FROM commit_bugs WHERE rowid IN (
+                         SELECT rowid FROM commit_bugs
+                         ORDER BY added DESC LIMIT -1 OFFSET ?)""",
+                    (self._iMaxEntries,))
+    except sqlite3.Error:
+      self._logger.exception("Could not update the scan cache %s" % (self._sPath,))
@@ -0,0 +1,100 @@
+
+"""
+client - gitzilla-client, the hook shim talking to gitzillad.
+
+Link gitzilla-client as the update (or pre-receive) and post-receive
+hooks of a repository (the name it is run under selects the hook), or
+run it as ``gitzilla-client <hook> [args...]``. It forwards its
+arguments, standard input, working directory and environment to gitzillad, and relays the
+output and exit status of the hook. Only the standard library pieces
+needed for that are imported, so it starts in a few milliseconds.
+
+If gitzillad is not running, or does not serve the repository (when its
+user_config is not 'deny'), the hook is run in-process instead.
+
+"""
+
+import os
+import sys
+import json
+import socket
+from gitzilla import sDefaultSocketPath
+
+
+def get_socket_path(sSiteConfigFile="/etc/gitzillarc"):
+  """
+  returns the path of the gitzillad socket: $GITZILLAD_SOCKET, or the
+  daemon_socket of the DEFAULT section of sSiteConfigFile.
+  """
+  sPath = os.environ.get("GITZILLAD_SOCKET")
+  if not sPath:
+    import configparser
+    siteconfig = configparser.RawConfigParser()
+    siteconfig.read(sSiteConfigFile)
+    if siteconfig.has_option("DEFAULT", "daemon_socket"):
+      sPath = siteconfig.get("DEFAULT", "daemon_socket")
+  return sPath or sDefaultSocketPath
+
+
+def run_in_process(sHook, asArgs):
+  import gitzilla.hookscripts
+  sys.argv = [sHook] + asArgs
+  getattr(gitzilla.hookscripts, sHook.replace("-", "_"))()
+
+
+def main():
+  sHook = os.path.basename(sys.argv[0])
+  asArgs = sys.argv[1:]
+  if sHook == "gitzilla-client" and asArgs:
+    sHook = asArgs.pop(0)
+  if sHook.startswith("gitzilla-"):
+    sHook = sHook[len("gitzilla-"):]
+
+  if sHook not in ("update", "pre-receive", "post-receive"):
+    print("gitzilla-client: unknown hook %s" % (sHook,))
+    sys.exit(1)
+
+  sStdin = ""
+  if sHook != "update":
+    sStdin = sys.stdin.read()
+
+  oSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    oSocket.connect(get_socket_path())
+  except (IOError, OSError):
+    oSocket.close()
+    if sStdin:
+      import io
+      sys.stdin = io.StringIO(sStdin)
+    run_in_process(sHook, asArgs)
+    return
+
+  dRequest = {"hook": sHook, "argv": asArgs, "cwd": os.getcwd(),
+              "env": dict(os.environ), "stdin": sStdin}
+  with oSocket:
+    oSocket.sendall((json.dumps(dRequest) + "\n").encode("utf-8"))
+    with oSocket.makefile("rb") as oFile:
+      sReply = oFile.readline().decode("utf-8")
+
+  if not sReply:
+    print("gitzilla-client: no reply from gitzillad")
+    sys.exit(1)
+
+  dReply = json.loads(sReply)
+  if dReply.get("in_process"):
+    # the hook may use the ~/.gitzillarc of the pusher
+    if sStdin:
+      import io
+      sys.stdin = io.StringIO(sStdin)
+    run_in_process(sHook, asArgs)
+    return
+
+  sys.stdout.write(dReply["stdout"])
+  sys.stderr.write(dReply["stderr"])
+  sys.stdout.flush()
+  sys.stderr.flush()
+  sys.exit(dReply["status"])
+
+
+if __name__ == "__main__":
+  main()
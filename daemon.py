@@ -0,0 +1,275 @@
+
+"""
+daemon - gitzillad, a resident process running the gitzilla hooks.
+
+Starting the hook scripts for every push costs an interpreter startup,
+the imports, parsing /etc/gitzillarc, compiling the bug regexes and a
+Bugzilla login. gitzillad pays for these once: it listens on a Unix
+socket, keeps the parsed configuration, the compiled scanners and the
+logged in Bugzilla wrappers around, and forks a child for each hook run
+sent by gitzilla-client (see client.py).
+
+The protocol is a single line of JSON each way. The request holds the
+hook name, its arguments, working directory, environment and standard
+input; the reply holds the standard output and error of the hook, and
+its exit status, or asks the client to run the hook itself. Only the
+variables of the environment telling git where the pushed objects are
+used; the hook runs with the rest of the daemon's environment.
+
+"""
+
+import io
+import os
+import sys
+import pwd
+import json
+import struct
+import socket
+import traceback
+import socketserver
+import gitzilla.hookscripts
+# imported here, once, rather than by every hook run.
+import gitzilla.hooks
+import gitzilla.bugrefs
+import gitzilla.bugwrap
+import gitzilla.cache
+import gitzilla.spool
+# loaded by bugwrap when it makes its first proxy, preloaded as well
+import xmlrpc.client  # noqa: F401
+from gitzilla.client import get_socket_path
+from gitzilla.asyncbugwrap import resolve
+
+
+# hook name -> function of hookscripts running it
+dHooks = {
+  "update": "update",
+  "post-receive": "post_receive",
+  "pre-receive": "pre_receive",
+}
+
+# the only variables of the hook's environment passed on to the hook run,
+# telling git where the pushed objects are; everything else (PATH
+# included) is the daemon's own.
+asForwardedEnvironment = ["GIT_DIR", "GIT_OBJECT_DIRECTORY",
+                          "GIT_ALTERNATE_OBJECT_DIRECTORIES", "GIT_QUARANTINE_PATH"]
+asForwardedPrefixes = ["GIT_PUSH_OPTION_"]
+
+
+def is_forwarded(sName):
+  return (sName in asForwardedEnvironment or
+          [x for x in asForwardedPrefixes if sName.startswith(x)] != [])
+
+
+def get_peer(oSocket):
+  """
+  returns the (pid, uid, gid) of the process at the other end of the Unix
+  socket oSocket.
+  """
+  sCredentials = struct.calcsize("3i")
+  return struct.unpack("3i", oSocket.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, sCredentials))
+
+
+def is_allowed_peer(iUid, iGid):
+  """
+  tells whether a process of uid iUid and gid iGid may have hooks run: it
+  must run as the user running gitzillad, or be in its group.
+  """
+  if iUid == os.getuid():
+    return True
+  if iGid == os.getgid():
+    return True
+  try:
+    sUser = pwd.getpwuid(iUid).pw_name
+    return os.getgid() in os.getgrouplist(sUser, iGid)
+  except (KeyError, OSError):
+    return False
+
+
+def get_peer_cwd(iPid):
+  """
+  returns the working directory of the process iPid, as the kernel knows
+  it, or None.
+  """
+  try:
+    return os.path.realpath(os.readlink("/proc/%d/cwd" % (iPid,)))
+  except (IOError, OSError):
+    return None
+
+
+def uses_user_config(sRepo):
+  """
+  tells whether the hooks of the repository sRepo may use the
+  ~/.gitzillarc of the pusher (user_config is not 'deny'), in which case
+  they have to run as the pusher rather than in gitzillad.
+  """
+  (siteconfig, userconfig) = gitzilla.hookscripts.get_configs()
+  return gitzilla.hookscripts.get_or_default(siteconfig, sRepo, "user_config", "allow") != "deny"
+
+
+def warm_up(logger=None):
+  """
+  (re)loads the configuration, compiles the bug regexes and the comment
+  templates and logs in to Bugzilla for every repository section of
+  /etc/gitzillarc, so that the forked children start with all of it
+  ready.
+  """
+  (siteconfig, userconfig) = gitzilla.hookscripts.get_configs()
+  for sRepo in [gitzilla.hookscripts.DEFAULT] + siteconfig.sections():
+    if uses_user_config(sRepo):
+      # run by gitzilla-client itself, see run_hook
+      continue
+    try:
+      gitzilla.hookscripts.get_bug_regex(siteconfig, sRepo)
+      gitzilla.hookscripts.get_template(siteconfig, sRepo)
+      (sBZUrl, sBZUser, sBZPasswd) = gitzilla.hookscripts.get_bz_data(siteconfig, userconfig, sRepo)
+      oBZ = gitzilla.hookscripts.get_bz_wrap(siteconfig, sRepo)(sBZUrl, sBZUser, sBZPasswd)
+      resolve(oBZ.auth())
+    except (Exception, SystemExit):
+      if logger is not None:
+        logger.exception("gitzillad: could not prepare section %s" % (sRepo,))
+
+
+def run_hook(dRequest, sCwd):
+  """
+  runs the hook described by dRequest in the directory sCwd (that of the
+  client, as found by the caller, not as the client tells it) in the
+  current process, returning the reply to send back. Meant to be called
+  in a forked child, as it changes the working directory, environment and
+  standard streams.
+
+  The repositories whose hooks may use the pusher's ~/.gitzillarc are not
+  served: the reply asks gitzilla-client to run the hook itself.
+  """
+  sHook = dRequest.get("hook")
+  if sHook not in dHooks:
+    return {"stdout": "", "stderr": "gitzillad: unknown hook %r\n" % (sHook,), "status": 1}
+
+  if uses_user_config(sCwd):
+    return {"in_process": True}
+
+  # connections must not be shared with the parent.
+  for oBZ in gitzilla.hookscripts._dWrappers.values():
+    oBZ.reset_connections()
+
+  for sName in [x for x in os.environ if is_forwarded(x)]:
+    del os.environ[sName]
+  for (sName, sValue) in dRequest.get("env", {}).items():
+    if is_forwarded(sName):
+      os.environ[sName] = sValue
+  os.chdir(sCwd)
+
+  sys.argv = [sHook] + list(dRequest.get("argv", []))
+  sys.stdin = io.StringIO(dRequest.get("stdin", ""))
+  oStdout = sys.stdout = io.StringIO()
+  oStderr = sys.stderr = io.StringIO()
+
+  iStatus = 0
+  try:
+    getattr(gitzilla.hookscripts, dHooks[sHook])()
+  except SystemExit as e:
+    if e.code is None or isinstance(e.code, int):
+      iStatus = e.code or 0
+    else:
+      print(e.code, file=oStderr)
+      iStatus = 1
+  except Exception:
+    traceback.print_exc(file=oStderr)
+    iStatus = 1
+  finally:
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+
+  return {"stdout": oStdout.getvalue(), "stderr": oStderr.getvalue(), "status": iStatus}
+
+
+
+class HookRequestHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    try:
+      (iPid, iUid, iGid) = get_peer(self.connection)
+      if not is_allowed_peer(iUid, iGid):
+        raise PermissionError("gitzillad: uid %d may not run hooks" % (iUid,))
+      dRequest = json.loads(self.rfile.readline().decode("utf-8"))
+      sCwd = get_peer_cwd(iPid)
+      if sCwd is None or sCwd != os.path.realpath(dRequest.get("cwd", "")):
+        raise PermissionError("gitzillad: the working directory of the client is not %r" % (dRequest.get("cwd"),))
+      dReply = run_hook(dRequest, sCwd)
+    except Exception:
+      dReply = {"stdout": "", "stderr": traceback.format_exc(), "status": 1}
+    self.wfile.write((json.dumps(dReply) + "\n").encode("utf-8"))
+
+
+
+class HookServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+  """
+  forks a child per hook run; the parent refreshes the configuration
+  between requests (it is only parsed again when it changes).
+  """
+
+  logger = None
+
+  def service_actions(self):
+    super(HookServer, self).service_actions()
+    try:
+      gitzilla.hookscripts.get_configs()
+    except Exception:
+      if self.logger is not None:
+        self.logger.exception("gitzillad: could not reload the configuration")
+
+
+
+def main():
+  """
+  The gitzillad script.
+
+    gitzillad [--socket PATH]
+
+  Serves the hook runs of gitzilla-client until killed. The socket can
+  only be used by the user running gitzillad and its group, which is
+  checked again for each connection. The hooks of repositories whose
+  user_config is not 'deny' are left to gitzilla-client.
+  """
+  import argparse
+  oParser = argparse.ArgumentParser(prog="gitzillad")
+  oParser.add_argument("--socket", default=None)
+  oArgs = oParser.parse_args()
+
+  (siteconfig, userconfig) = gitzilla.hookscripts.get_configs()
+  sSocketPath = oArgs.socket or get_socket_path(gitzilla.hookscripts.sSiteConfigFile)
+  logger = gitzilla.hookscripts.get_logger(siteconfig, gitzilla.hookscripts.DEFAULT)
+
+  warm_up(logger)
+
+  # a socket left behind by a previous run is in the way.
+  if os.path.exists(sSocketPath):
+    oProbe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      oProbe.connect(sSocketPath)
+    except (IOError, OSError):
+      os.unlink(sSocketPath)
+    else:
+      print("gitzillad is already listening on %s" % (sSocketPath,))
+      sys.exit(1)
+    finally:
+      oProbe.close()
+
+  iUMask = os.umask(0o117)
+  try:
+    oServer = HookServer(sSocketPath, HookRequestHandler)
+  finally:
+    os.umask(iUMask)
+  oServer.logger = logger
+
+  if logger is not None:
+    logger.info("gitzillad: listening on %s" % (sSocketPath,))
+  try:
+    oServer.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    oServer.server_close()
+    os.unlink(sSocketPath)
+
+
+if __name__ == "__main__":
+  main()
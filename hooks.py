@@ -4,16 +4,414 @@ hooks - git hooks provided by gitzilla.
 
 """
 
-import re
+import os
 import sys
-from .bugwrap import BugzillaWrapper
-from .utils import get_changes, notify_and_exit
-from gitzilla import sDefaultSeparator, sDefaultFormatSpec, oDefaultBugRegex, sDefaultRefPrefix
+import time
+import threading
+from collections import OrderedDict, deque
+from .bugrefs import get_scanner
+from .utils import get_changes, get_push_changes, notify_and_exit
+from gitzilla import sDefaultSeparator, sDefaultFormatSpec, sDefaultRefPrefix
+from gitzilla import iDefaultMaxCommentSize, iDefaultCommentWorkers
 from gitzilla import NullLogger
-import traceback
+from .metrics import NullMetrics
+from .template import get_template
+from .bugwrap import BugzillaUnavailable
 
 
-def post_receive(sBZUrl, sBZUser=None, sBZPasswd=None, sFormatSpec=None, oBugRegex=None, sSeparator=None, logger=None, bz_wrap=None, sRefPrefix=None, bIncludeDiffStat=True, aasPushes=None):
+class CommentBatcher(object):
+  """
+  collects the commit messages referring to each bug, combining them into
+  as few comments as possible, none longer than iMaxCommentSize characters
+  (a single longer message makes a comment of its own).
+
+  A comment is handed to fnSend(iBugId, sComment) as soon as it is full,
+  the remaining ones when flush() is called, so only the comments still
+  being filled are kept in memory.
+
+  If iMaxBugSize is given, at most that many characters are added to a
+  bug in all: once a bug has no room left for a message, its one line
+  summary (if given to add) is added instead, and when even that does
+  not fit, the message is only counted, in a note ending the last
+  comment. Room for the note is kept in every comment, so that it never
+  makes the last one too long (a comment of its own holds it otherwise).
+  """
+
+  sOmittedNote = "(%d more commit(s) left out)"
+
+  def __init__(self, iMaxCommentSize, fnSend, iMaxBugSize=None):
+    self._iMaxCommentSize = iMaxCommentSize
+    self._iRoom = iMaxCommentSize
+    if iMaxBugSize is not None:
+      # the room of the note, with a count of up to 6 digits (the note
+      # makes a comment of its own beyond)
+      self._iRoom -= 2 + len(self.sOmittedNote % (999999,))
+    self._fnSend = fnSend
+    self._iMaxBugSize = iMaxBugSize
+    # bug id => (list of messages, total size), in push order
+    self._dPending = OrderedDict()
+    # bug id => the size of all its messages
+    self._diSizes = {}
+    # bug id => the number of messages left out
+    self._diOmitted = {}
+    self.aiBugIds = set()
+    self.iComments = 0
+
+
+  def _send(self, iBugId, asMessages):
+    self.iComments += 1
+    self._fnSend(iBugId, "\n\n".join(asMessages))
+
+
+  def add(self, iBugId, sMessage, sSummary=None):
+    self.aiBugIds.add(iBugId)
+    sMessage = sMessage.strip("\n")
+    if self._iMaxBugSize is not None:
+      iBugSize = self._diSizes.get(iBugId, 0)
+      if iBugSize + len(sMessage) > self._iMaxBugSize:
+        if sSummary is None or iBugSize + len(sSummary) > self._iMaxBugSize:
+          self._diOmitted[iBugId] = self._diOmitted.get(iBugId, 0) + 1
+          return
+        sMessage = sSummary
+      self._diSizes[iBugId] = iBugSize + len(sMessage) + 2
+    (asMessages, iSize) = self._dPending.get(iBugId, ([], 0))
+    if asMessages and iSize + 2 + len(sMessage) > self._iRoom:
+      self._send(iBugId, asMessages)
+      (asMessages, iSize) = ([], 0)
+    if asMessages:
+      iSize += 2
+    asMessages.append(sMessage)
+    self._dPending[iBugId] = (asMessages, iSize + len(sMessage))
+
+
+  def flush(self):
+    for (iBugId, iOmitted) in self._diOmitted.items():
+      sNote = self.sOmittedNote % (iOmitted,)
+      (asMessages, iSize) = self._dPending.get(iBugId, ([], 0))
+      if asMessages and iSize + 2 + len(sNote) > self._iMaxCommentSize:
+        # a single message too long for the room
+        self._send(iBugId, asMessages)
+        asMessages = []
+      asMessages.append(sNote)
+      self._dPending[iBugId] = (asMessages, 0)
+    for (iBugId, (asMessages, iSize)) in self._dPending.items():
+      self._send(iBugId, asMessages)
+    self._dPending.clear()
+    self._diOmitted.clear()
+
+
+
+class CommentPoster(object):
+  """
+  adds comments to Bugzilla using at most iWorkers concurrent requests.
+  submit() blocks while twice as many comments are waiting, so that the
+  comments do not pile up in memory when Bugzilla is slower than git.
+
+  The comments of a bug are posted in order, by a single task: the
+  requests run in parallel across bugs only. When a comment fails, the
+  following ones of its bug are dropped, so that they never land out of
+  order. Failures are logged and otherwise ignored, like the post-receive
+  hook always did.
+  """
+
+  def __init__(self, oBZ, iWorkers, logger):
+    self._oBZ = oBZ
+    self._logger = logger
+    self._oSlots = threading.BoundedSemaphore(max(iWorkers, 1) * 2)
+    self._oLock = threading.Lock()
+    # bug id => the comments waiting for the task posting those of the bug
+    self._dQueues = {}
+    self.aiUpdated = set()
+    self.aiFailed = set()
+    import inspect
+    if inspect.iscoroutinefunction(oBZ.add_bug_comment):
+      # an asynchronous wrapper limits its requests in flight itself, all
+      # it needs is an event loop running next to the hook.
+      import asyncio
+      self._oPool = None
+      self._aoFutures = []
+      self._oLoop = asyncio.new_event_loop()
+      self._oLoopThread = threading.Thread(target=self._oLoop.run_forever)
+      self._oLoopThread.daemon = True
+      self._oLoopThread.start()
+    else:
+      from concurrent.futures import ThreadPoolExecutor
+      self._oPool = ThreadPoolExecutor(max_workers=max(iWorkers, 1))
+
+
+  def _next(self, iBugId):
+    # returns the next comment of the bug, or None when there is none left,
+    # which ends its task.
+    with self._oLock:
+      asQueue = self._dQueues[iBugId]
+      if not asQueue:
+        del self._dQueues[iBugId]
+        return None
+      return asQueue.popleft()
+
+
+  def _fail(self, iBugId):
+    self._logger.exception("Could not add comment to bug %d" % (iBugId,))
+    with self._oLock:
+      self.aiFailed.add(iBugId)
+      asQueue = self._dQueues[iBugId]
+      iDropped = len(asQueue)
+      asQueue.clear()
+    for i in range(iDropped):
+      self._oSlots.release()
+
+
+  def _post(self, iBugId):
+    while True:
+      sComment = self._next(iBugId)
+      if sComment is None:
+        return
+      try:
+        self._oBZ.add_bug_comment(iBugId, sComment)
+        self.aiUpdated.add(iBugId)
+      except Exception:
+        self._fail(iBugId)
+      finally:
+        self._oSlots.release()
+
+
+  async def _post_async(self, iBugId):
+    while True:
+      sComment = self._next(iBugId)
+      if sComment is None:
+        return
+      try:
+        await self._oBZ.add_bug_comment(iBugId, sComment)
+        self.aiUpdated.add(iBugId)
+      except Exception:
+        self._fail(iBugId)
+      finally:
+        self._oSlots.release()
+
+
+  def submit(self, iBugId, sComment):
+    self._oSlots.acquire()
+    with self._oLock:
+      if iBugId in self.aiFailed:
+        self._oSlots.release()
+        return
+      asQueue = self._dQueues.get(iBugId)
+      if asQueue is not None:
+        # the task of the bug posts it after the others
+        asQueue.append(sComment)
+        return
+      self._dQueues[iBugId] = deque([sComment])
+
+    if self._oPool is None:
+      import asyncio
+      self._aoFutures.append(asyncio.run_coroutine_threadsafe(
+          self._post_async(iBugId), self._oLoop))
+    else:
+      self._oPool.submit(self._post, iBugId)
+
+
+  def close(self):
+    """
+    waits for all the submitted comments, and returns the set of bug ids
+    which got all their comments.
+    """
+    if self._oPool is None:
+      for oFuture in self._aoFutures:
+        oFuture.result()
+      self._oLoop.call_soon_threadsafe(self._oLoop.stop)
+      self._oLoopThread.join()
+      self._oLoop.close()
+    else:
+      self._oPool.shutdown(wait=True)
+    return self.aiUpdated - self.aiFailed
+
+
+
+def get_bug_statuses(fnGetBZ, aiBugIds, oStatusCache=None, logger=None, oMetrics=None):
+  """
+  returns a dict mapping each bug id in aiBugIds to its status (None for
+  bugs which do not exist). Fresh statuses are taken from oStatusCache, if
+  one is given, and only the rest are looked up in Bugzilla, using the
+  wrapper returned by fnGetBZ(). fnGetBZ is not called at all when the
+  cache has all the statuses.
+  """
+  if logger is None:
+    logger = NullLogger
+
+  if oMetrics is None:
+    oMetrics = NullMetrics()
+
+  dStatuses = {}
+  if oStatusCache is not None:
+    dStatuses = oStatusCache.get(aiBugIds)
+    logger.info("bug status cache: %d hit(s), %d miss(es)" %
+                (len(dStatuses), len(aiBugIds) - len(dStatuses)))
+    oMetrics.count("status_cache_hits", len(dStatuses))
+    oMetrics.count("status_cache_misses", len(aiBugIds) - len(dStatuses))
+
+  aiMissing = [x for x in aiBugIds if x not in dStatuses]
+  if aiMissing:
+    from .asyncbugwrap import resolve
+    oBZ = fnGetBZ()
+    with oMetrics.span("bug_statuses"):
+      dFetched = resolve(oBZ.bug_statuses(aiMissing))
+    if oStatusCache is not None:
+      oStatusCache.put(dFetched)
+    dStatuses.update(dFetched)
+
+  return dStatuses
+
+
+def get_bz_getter(bz_wrap, sBZUrl, sBZUser, sBZPasswd, logger, oMetrics=None):
+  """
+  returns a function returning the logged in Bugzilla wrapper, exiting
+  with a notice if the login fails (or raising BugzillaUnavailable if
+  Bugzilla did not answer). If oMetrics is given, the requests of the
+  wrapper are recorded there.
+  """
+  if oMetrics is None:
+    oMetrics = NullMetrics()
+
+  def get_bz():
+    from .asyncbugwrap import resolve
+    oBZ = bz_wrap(sBZUrl, sBZUser, sBZPasswd)
+    oBZ.metrics = oMetrics
+    # check auth
+    try:
+      with oMetrics.span("login"):
+        resolve(oBZ.auth())
+    except BugzillaUnavailable:
+      logger.error("Could not login to Bugzilla", exc_info=1)
+      raise
+    except:
+      logger.error("Could not login to Bugzilla", exc_info=1)
+      notify_and_exit("Could not login to Bugzilla. Check your auth details and settings")
+    return oBZ
+
+  return get_bz
+
+
+def scan_commits(aoCommits, oScanner, oScanCache=None, oMetrics=None):
+  """
+  yields an (oCommit, aiBugIds) tuple for each commit in aoCommits, with
+  the ids of the bugs its message refers to. If oScanCache (a
+  cache.ScanCache) is given, the bug ids of the commits found there are
+  not scanned again, and those of the others are added to it; the cache
+  is looked up for chunks of commits rather than for each one.
+  """
+  if oMetrics is None:
+    oMetrics = NullMetrics()
+
+  aoCommits = oMetrics.timed(aoCommits, "git")
+  if oScanCache is None:
+    for oCommit in aoCommits:
+      with oMetrics.span("scan"):
+        aiBugIds = oScanner.bug_ids(oCommit.message())
+      yield (oCommit, aiBugIds)
+    return
+
+  def scan_chunk(aoChunk):
+    with oMetrics.span("scan"):
+      dBugIds = oScanCache.get(oScanner, [x.sha for x in aoChunk])
+      dScanned = {}
+      for oCommit in aoChunk:
+        if oCommit.sha not in dBugIds:
+          dScanned[oCommit.sha] = dBugIds[oCommit.sha] = oScanner.bug_ids(oCommit.message())
+      oScanCache.put(oScanner, dScanned)
+    oMetrics.count("scan_cache_hits", len(aoChunk) - len(dScanned))
+    oMetrics.count("scan_cache_misses", len(dScanned))
+    return [(x, dBugIds[x.sha]) for x in aoChunk]
+
+  aoChunk = []
+  for oCommit in aoCommits:
+    aoChunk.append(oCommit)
+    if len(aoChunk) >= 500:
+      for tCommit in scan_chunk(aoChunk):
+        yield tCommit
+      aoChunk = []
+  if aoChunk:
+    for tCommit in scan_chunk(aoChunk):
+      yield tCommit
+
+
+def check_commits(aoCommits, oScanner, asAllowedStatuses, bRequireBugNumber, fnGetBZ, oStatusCache, logger, oMetrics=None, bFailOpen=False, oScanCache=None):
+  """
+  checks the bug references of the commits in aoCommits: each commit
+  must refer to a bug if bRequireBugNumber is True, and if
+  asAllowedStatuses is not None, the bugs must exist and be in one of
+  these states.
+
+  All the commits are scanned first, so that the statuses of all the
+  bugs are looked up in one go. Returns the list of problems found, which
+  is empty if the commits are acceptable.
+
+  The time spent reading the commits from git, scanning them and looking
+  up the statuses is recorded in oMetrics, if given.
+
+  If Bugzilla is unavailable, the statuses are not checked when
+  bFailOpen is True (the push is accepted with a notice), otherwise
+  that is a problem.
+
+  The bug ids of the commits are taken from oScanCache, if given (see
+  scan_commits).
+  """
+  if oMetrics is None:
+    oMetrics = NullMetrics()
+
+  asProblems = []
+  # bug id -> the commits referring to it
+  dCommitsByBug = OrderedDict()
+  for (oCommit, aiCommitBugIds) in scan_commits(aoCommits, oScanner, oScanCache, oMetrics):
+    logger.debug("Checking for bug refs in commit:\n%s" % (oCommit.formatted,))
+    oMetrics.count("commits_scanned")
+    if not aiCommitBugIds:
+      if bRequireBugNumber:
+        logger.error("No bug ref found in commit:\n%s" % (oCommit.formatted,))
+        asProblems.append("No bug ref found in commit:\n%s" % (oCommit.formatted,))
+      else:
+        logger.debug("No bug ref found, but none required.")
+    for iBugId in aiCommitBugIds:
+      logger.debug("Found bug id %d" % (iBugId,))
+      sCommit = oCommit.sha[:12]
+      if oCommit.refs:
+        sCommit += " (%s)" % (", ".join(oCommit.refs),)
+      dCommitsByBug.setdefault(iBugId, []).append(sCommit)
+
+  oMetrics.count("bugs_referenced", len(dCommitsByBug))
+  if asAllowedStatuses is None or not dCommitsByBug:
+    return asProblems
+
+  # check all bug statuses
+  aiBugIds = list(dCommitsByBug)
+  try:
+    dStatuses = get_bug_statuses(fnGetBZ, aiBugIds, oStatusCache, logger, oMetrics)
+  except BugzillaUnavailable as e:
+    logger.error("Bugzilla is unavailable, could not get status for bugs %s: %s" % (aiBugIds, e))
+    if bFailOpen:
+      oMetrics.count("failed_open")
+      print("gitzilla: Bugzilla is unavailable, the states of bugs %s were not checked" % (aiBugIds,))
+      return asProblems
+    return asProblems + ["Bugzilla is unavailable, could not get status for bugs %s" % (aiBugIds,)]
+  except Exception:
+    logger.exception("Could not get status for bugs %s" % (aiBugIds,))
+    return asProblems + ["Could not get status for bugs %s" % (aiBugIds,)]
+
+  for iBugId in aiBugIds:
+    sStatus = dStatuses.get(iBugId)
+    if sStatus is None:
+      sProblem = "Bug %d does not exist" % (iBugId,)
+    elif sStatus not in asAllowedStatuses:
+      logger.info("Cannot accept commit for bug %d in state %s" % (iBugId, sStatus))
+      sProblem = "Bug %d['%s'] is not in %s" % (iBugId, sStatus, asAllowedStatuses)
+    else:
+      logger.debug("status for bug %d is %s" % (iBugId, sStatus))
+      continue
+    asProblems.append("%s, referred to by %s" % (sProblem, ", ".join(dCommitsByBug[iBugId])))
+
+  return asProblems
+
+
+def post_receive(sBZUrl, sBZUser=None, sBZPasswd=None, sFormatSpec=None, oBugRegex=None, sSeparator=None, logger=None, bz_wrap=None, sRefPrefix=None, bIncludeDiffStat=True, aasPushes=None, iMaxCommentSize=None, iWorkers=None, oSpool=None, oIndex=None, oMetrics=None, oBugIndex=None, oTemplate=None, iMaxBugCommentSize=None):
   """
   a post-recieve hook handler which extracts bug ids and adds the commit
   info to the comment. If multiple bug ids are found, the comment is added
@@ -25,8 +423,9 @@ def post_receive(sBZUrl, sBZUser=None, sBZPasswd=None, sFormatSpec=None, oBugReg
   None, what happens is defined by the bz_wrap function.
 
   oBugRegex specifies the regex used to search for the bug id in the commit
-  messages. It MUST provide a named group called 'bug' which contains the bug
-  id (all digits only). If oBugRegex is None, a default bug regex is used,
+  messages (subject and body only). It MUST provide a named group called 'bug' which contains the bug
+  id (all digits only). It may also be a list of such regexes, or a
+  bugrefs.BugScanner. If oBugRegex is None, a default bug regex is used,
   which is:
 
       r"bug\s*(?:#|)\s*(?P<bug>\d+)"
@@ -39,15 +438,15 @@ def post_receive(sBZUrl, sBZUser=None, sBZPasswd=None, sFormatSpec=None, oBugReg
     - bug123
 
   The format spec is appended to "--pretty=format:" and passed to
-  "git whatchanged". See the git whatchanged manpage for more info on the
+  "git log". See the git log manpage for more info on the
   format spec. Newlines are automatically converted to the "--pretty"
-  equivalent, which is '%n'.
+  equivalent, which is '%n'. The format spec must not produce NUL
+  characters (%x00).
 
   If sFormatSpec is None, a default format spec is used.
 
-  The separator is a string that would never occur in a commit message.
-  If sSeparator is None, a default separator is used, which should be
-  good enough for everyone.
+  sSeparator is no longer used, commits are read from git as
+  NUL-delimited fields. It is only accepted for compatibility.
 
   If a logger is provided, it would be used for all the logging. If logger
   is None, logging will be disabled. The logger must be a Python
@@ -60,8 +459,46 @@ def post_receive(sBZUrl, sBZUser=None, sBZPasswd=None, sFormatSpec=None, oBugReg
   sRefPrefix is the string prefix of the git reference. If a git reference
   does not start with this, its commits will be ignored. 'refs/heads/' by default.
 
+  bIncludeDiffStat tells whether the comments include the list of the
+  files changed by the commits, as git whatchanged shows it. It may also
+  be a utils.DiffStat, choosing another kind of diffstat.
+
   aasPushes is a list of (sOldRev, sNewRev, sRefName) tuples, for when these
   aren't read from stdin (gerrit integration).
+
+  The new commits of all the pushed refs are found with a single walk of
+  the history, so a commit pushed to several refs is only processed once.
+
+  The comments are grouped per bug while the push is being read, so that
+  each bug gets a single combined comment. iMaxCommentSize caps the
+  size of a combined comment; a bug with more text than that gets several
+  comments. iWorkers is the maximum number of comments posted concurrently.
+  If iWorkers is more than 1, the object returned by bz_wrap must be safe
+  to use from several threads (BugzillaWrapper is). bz_wrap may also
+  return an asyncbugwrap.AsyncBugzillaWrapper, whose own limit on the
+  requests in flight then applies.
+
+  If oSpool (a spool.Spool instance) is given, the comments are only
+  queued there, to be delivered later by spool.drain, and Bugzilla is not
+  contacted at all.
+
+  If oIndex (an index.CommitIndex instance) is given, the commits found
+  there are skipped, and the commits whose comments were all posted (or
+  queued) are added to it, so that no commit is commented twice.
+
+  If oMetrics (a metrics.Metrics instance) is given, the time spent in
+  git, scanning and talking to Bugzilla is recorded there, along with
+  counts of the commits, bugs and requests.
+
+  If oBugIndex (an index.BugIndex instance) is given, the bugs each
+  pushed commit refers to and the refs it was pushed to are recorded
+  there, including for the commits skipped because of oIndex.
+
+  The comments are rendered by oTemplate (a template.CommentTemplate),
+  which defaults to the template of sFormatSpec, fitting each comment in
+  iMaxCommentSize characters. iMaxBugCommentSize, if given, caps the size
+  of all the comments added to a bug by the push: the commits which do
+  not fit are only mentioned with their subject, or counted.
   """
   if sFormatSpec is None:
     sFormatSpec = sDefaultFormatSpec
@@ -69,19 +506,30 @@ def post_receive(sBZUrl, sBZUser=None, sBZPasswd=None, sFormatSpec=None, oBugReg
   if sSeparator is None:
     sSeparator = sDefaultSeparator
 
-  if oBugRegex is None:
-    oBugRegex = oDefaultBugRegex
+  oScanner = get_scanner(oBugRegex)
 
   if logger is None:
     logger = NullLogger
 
   if bz_wrap is None:
-    bz_wrap = BugzillaWrapper
+    from .bugwrap import BugzillaWrapper as bz_wrap
 
   if sRefPrefix is None:
     sRefPrefix = sDefaultRefPrefix
 
-  oBZ = bz_wrap(sBZUrl, sBZUser, sBZPasswd)
+  if iMaxCommentSize is None:
+    iMaxCommentSize = iDefaultMaxCommentSize
+
+  if iWorkers is None:
+    iWorkers = iDefaultCommentWorkers
+
+  if oMetrics is None:
+    oMetrics = NullMetrics()
+
+  if oTemplate is None:
+    oTemplate = get_template(sFormatSpec, iMaxSize=iMaxCommentSize)
+
+  fStart = time.time()
 
   def gPushes():
     for sLine in iter(sys.stdin.readline, ""):
@@ -90,43 +538,105 @@ def post_receive(sBZUrl, sBZUser=None, sBZPasswd=None, sFormatSpec=None, oBugReg
   if not aasPushes:
     aasPushes = gPushes()
 
-  sPrevRev = None
+  aasRefPushes = []
   for asPush in aasPushes:
     (sOldRev, sNewRev, sRefName) = asPush
     if not sRefName.startswith(sRefPrefix):
       logger.debug("ignoring ref: '%s'" % (sRefName,))
       continue
 
-    if sPrevRev is None:
-      sPrevRev = sOldRev
-    logger.debug("oldrev: '%s', newrev: '%s'" % (sOldRev, sNewRev))
-    asChangeLogs = get_changes(sOldRev, sNewRev, sFormatSpec, sSeparator, bIncludeDiffStat, sRefName, sRefPrefix)
+    logger.debug("ref: '%s', oldrev: '%s', newrev: '%s'" % (sRefName, sOldRev, sNewRev))
+    aasRefPushes.append((sOldRev, sNewRev, sRefName))
+
+  sRepo = os.getcwd()
+  oPoster = None
+  if oSpool is None:
+    oBZ = bz_wrap(sBZUrl, sBZUser, sBZPasswd)
+    oBZ.metrics = oMetrics
+    oPoster = CommentPoster(oBZ, iWorkers, logger)
+    fnSend = oPoster.submit
+  else:
+    fnSend = lambda iBugId, sComment: oSpool.put(sRepo, iBugId, sComment)
+  oBatcher = CommentBatcher(iMaxCommentSize, fnSend, iMaxBugCommentSize)
+  # (sha, bug ids) of the new commits, to be added to oIndex at the end
+  atProcessed = []
+  # (sha, bug ids, refs) of the commits, to be added to oBugIndex
+  atLinks = []
 
-    for sMessage in asChangeLogs:
-      logger.debug("Considering commit:\n%s" % (sMessage,))
-      oMatch = re.search(oBugRegex, sMessage)
-      if oMatch is None:
-        logger.info("Bug id not found in commit:\n%s" % (sMessage,))
+  try:
+    # the commits are read from git one at a time, and each full comment
+    # is sent off while the rest of the push is still being read.
+    aoCommits = get_push_changes(aasRefPushes, oTemplate.sGitFormatSpec, sSeparator, bIncludeDiffStat, sRefPrefix)
+    for oCommit in oMetrics.timed(aoCommits, "git"):
+      if oTemplate.compiled:
+        oCommit.formatted = oTemplate.render(oCommit)
+      bProcessed = oIndex is not None and oIndex.contains(oCommit.sha)
+      if bProcessed and oBugIndex is None:
+        logger.debug("Skipping already processed commit %s" % (oCommit.sha,))
+        oMetrics.count("commits_skipped")
+        continue
+      logger.debug("Considering commit on %s:\n%s" % (", ".join(oCommit.refs), oCommit.formatted))
+      oMetrics.count("commits_scanned")
+      with oMetrics.span("scan"):
+        aiBugIds = oScanner.bug_ids(oCommit.message())
+      if oBugIndex is not None and aiBugIds:
+        atLinks.append((oCommit.sha, aiBugIds, oCommit.refs))
+      if bProcessed:
+        logger.debug("Skipping already processed commit %s" % (oCommit.sha,))
+        oMetrics.count("commits_skipped")
         continue
-      for oMatch in re.finditer(oBugRegex, sMessage):
-        iBugId = int(oMatch.group("bug"))
+      if oIndex is not None:
+        atProcessed.append((oCommit.sha, aiBugIds))
+      if not aiBugIds:
+        logger.info("Bug id not found in commit:\n%s" % (oCommit.formatted,))
+        continue
+      sComment = oTemplate.comment(oCommit)
+      sSummary = oTemplate.summary(oCommit)
+      for iBugId in aiBugIds:
         logger.debug("Found bugid %d" % (iBugId,))
-        try:
-          oBZ.add_bug_comment(iBugId, sMessage)
-        except Exception as e:
-          logger.exception("Could not add comment to bug %d" % (iBugId,))
+        oBatcher.add(iBugId, sComment, sSummary)
+
+    oBatcher.flush()
+  finally:
+    if oPoster is not None:
+      # the comments still in flight
+      with oMetrics.span("post"):
+        aiUpdated = oPoster.close()
+
+  oMetrics.count("bugs_referenced", len(oBatcher.aiBugIds))
+  oMetrics.count("comments", oBatcher.iComments)
 
+  if oBugIndex is not None:
+    oBugIndex.add(atLinks)
 
+  if oIndex is not None:
+    if oPoster is None:
+      aiUpdated = oBatcher.aiBugIds
+    oIndex.add([sSha for (sSha, aiBugIds) in atProcessed if aiUpdated.issuperset(aiBugIds)])
 
-def update(oBugRegex=None, asAllowedStatuses=None, sSeparator=None, sBZUrl=None, sBZUser=None, sBZPasswd=None, logger=None, bz_wrap=None, sRefPrefix=None, bRequireBugNumber=True):
+  if not oBatcher.aiBugIds:
+    return
+
+  fElapsed = time.time() - fStart
+  if oPoster is None:
+    sReport = "gitzilla: queued %d comment(s) for %d bug(s) in %.2fs" % (oBatcher.iComments, len(oBatcher.aiBugIds), fElapsed)
+  else:
+    sReport = "gitzilla: updated %d of %d bug(s) in %.2fs" % (len(aiUpdated), len(oBatcher.aiBugIds), fElapsed)
+  logger.info(sReport)
+  print(sReport)
+
+
+
+def update(oBugRegex=None, asAllowedStatuses=None, sSeparator=None, sBZUrl=None, sBZUser=None, sBZPasswd=None, logger=None, bz_wrap=None, sRefPrefix=None, bRequireBugNumber=True, oStatusCache=None, oMetrics=None, bFailOpen=False, oScanCache=None):
   """
   an update hook handler which rejects commits without a bug reference.
   This looks at the sys.argv array, so make sure you don't modify it before
   calling this function.
 
   oBugRegex specifies the regex used to search for the bug id in the commit
-  messages. It MUST provide a named group called 'bug' which contains the bug
-  id (all digits only). If oBugRegex is None, a default bug regex is used,
+  messages (subject and body only). It MUST provide a named group called 'bug' which contains the bug
+  id (all digits only). It may also be a list of such regexes, or a
+  bugrefs.BugScanner. If oBugRegex is None, a default bug regex is used,
   which is:
 
       r"bug\s*(?:#|)\s*(?P<bug>\d+)"
@@ -142,9 +652,8 @@ def update(oBugRegex=None, asAllowedStatuses=None, sSeparator=None, sBZUrl=None,
   bugs. If a bug is not in one of these states, the commit will be rejected.
   If asAllowedStatuses is None, status checking is diabled.
 
-  The separator is a string that would never occur in a commit message.
-  If sSeparator is None, a default separator is used, which should be
-  good enough for everyone.
+  sSeparator is no longer used, commits are read from git as
+  NUL-delimited fields. It is only accepted for compatibility.
 
   sBZUrl specifies the base URL for the Bugzilla installation.  sBZUser and
   sBZPasswd are the bugzilla credentials.
@@ -162,9 +671,29 @@ def update(oBugRegex=None, asAllowedStatuses=None, sSeparator=None, sBZUrl=None,
 
   bRequireBugNumber, if True, requires that a bug number appears in the
   commit message (otherwise it will be rejected).
+
+  oStatusCache, if given, is a cache.StatusCache instance which is
+  consulted before asking Bugzilla for bug statuses.
+
+  Bugzilla is only logged in to when a bug status has to be looked up:
+  never for ignored refs, when asAllowedStatuses is None, or when all the
+  statuses are cached.
+
+  All the problems found in the pushed commits are reported together.
+
+  oMetrics, if given, is a metrics.Metrics instance recording the time
+  spent in git, scanning and talking to Bugzilla.
+
+  bFailOpen tells what happens when Bugzilla does not answer (or its
+  circuit breaker is open): if True, the push is accepted without
+  checking the bug statuses; if False, it is rejected.
+
+  oScanCache, if given, is a cache.ScanCache instance keeping the bug ids
+  found in the commits, so that the commits pushed before (e.g. to a
+  topic branch, then merged) are not scanned again. Along with
+  oStatusCache, this makes checking them nearly free.
   """
-  if oBugRegex is None:
-    oBugRegex = oDefaultBugRegex
+  oScanner = get_scanner(oBugRegex)
 
   if sSeparator is None:
     sSeparator = sDefaultSeparator
@@ -173,7 +702,7 @@ def update(oBugRegex=None, asAllowedStatuses=None, sSeparator=None, sBZUrl=None,
     logger = NullLogger
 
   if bz_wrap is None:
-    bz_wrap = BugzillaWrapper
+    from .bugwrap import BugzillaWrapper as bz_wrap
 
   if sRefPrefix is None:
     sRefPrefix = sDefaultRefPrefix
@@ -185,15 +714,6 @@ def update(oBugRegex=None, asAllowedStatuses=None, sSeparator=None, sBZUrl=None,
     if sBZUrl is None:
       raise ValueError("Bugzilla info required for status checks")
 
-  # create and cache bugzilla instance
-  oBZ = bz_wrap(sBZUrl, sBZUser, sBZPasswd)
-  # check auth
-  try:
-    oBZ.auth()
-  except:
-    logger.error("Could not login to Bugzilla", exc_info=1)
-    notify_and_exit("Could not login to Bugzilla. Check your auth details and settings")
-
   (sRefName, sOldRev, sNewRev) = sys.argv[1:4]
   if not sRefName.startswith(sRefPrefix):
     logger.debug("ignoring ref: '%s'" % (sRefName,))
@@ -201,33 +721,62 @@ def update(oBugRegex=None, asAllowedStatuses=None, sSeparator=None, sBZUrl=None,
 
   logger.debug("oldrev: '%s', newrev: '%s'" % (sOldRev, sNewRev))
 
-  asChangeLogs = get_changes(sOldRev, sNewRev, sFormatSpec, sSeparator, False, sRefName, sRefPrefix)
+  aoCommits = get_changes(sOldRev, sNewRev, sFormatSpec, sSeparator, False, sRefName, sRefPrefix)
+  asProblems = check_commits(aoCommits, oScanner, asAllowedStatuses, bRequireBugNumber,
+                             get_bz_getter(bz_wrap, sBZUrl, sBZUser, sBZPasswd, logger, oMetrics),
+                             oStatusCache, logger, oMetrics, bFailOpen, oScanCache)
+  if asProblems:
+    notify_and_exit("\n\n".join(asProblems))
 
-  for sMessage in asChangeLogs:
-    logger.debug("Checking for bug refs in commit:\n%s" % (sMessage,))
-    oMatch = re.search(oBugRegex, sMessage)
-    if oMatch is None:
-      if bRequireBugNumber:
-        logger.error("No bug ref found in commit:\n%s" % (sMessage,))
-        notify_and_exit("No bug ref found in commit:\n%s" % (sMessage,))
-      else:
-        logger.debug("No bug ref found, but none required.")
-    else:
-      if asAllowedStatuses is not None:
-        # check all bug statuses
-        for oMatch in re.finditer(oBugRegex, sMessage):
-          iBugId = int(oMatch.group("bug"))
-          logger.debug("Found bug id %d" % (iBugId,))
-          try:
-            sStatus = oBZ.bug_status(iBugId)
-            if sStatus is None:
-              notify_and_exit("Bug %d does not exist" % (iBugId,))
-          except Exception as e:
-            logger.exception("Could not get status for bug %d" % (iBugId,))
-            notify_and_exit("Could not get staus for bug %d" % (iBugId,))
-
-          logger.debug("status for bug %d is %s" % (iBugId, sStatus))
-          if sStatus not in asAllowedStatuses:
-            logger.info("Cannot accept commit for bug %d in state %s" % (iBugId, sStatus))
-            notify_and_exit("Bug %d['%s'] is not in %s" % (iBugId, sStatus, asAllowedStatuses))
 
+
+def pre_receive(oBugRegex=None, asAllowedStatuses=None, sBZUrl=None, sBZUser=None, sBZPasswd=None, logger=None, bz_wrap=None, sRefPrefix=None, bRequireBugNumber=True, oStatusCache=None, aasPushes=None, oMetrics=None, bFailOpen=False, oScanCache=None):
+  """
+  a pre-receive hook handler doing the checks of the update hook for a
+  whole push at once: the new commits of all the pushed refs are found
+  with a single walk of the history, the statuses of all the bugs they
+  refer to are looked up together, and all the problems are reported in
+  one go. Either all the refs are updated, or none.
+
+  The pushes are read from stdin, unless aasPushes, a list of (sOldRev,
+  sNewRev, sRefName) tuples, is given. The other arguments are the same
+  as for update.
+  """
+  oScanner = get_scanner(oBugRegex)
+
+  if logger is None:
+    logger = NullLogger
+
+  if bz_wrap is None:
+    from .bugwrap import BugzillaWrapper as bz_wrap
+
+  if sRefPrefix is None:
+    sRefPrefix = sDefaultRefPrefix
+
+  if asAllowedStatuses is not None:
+    # sanity checking
+    if sBZUrl is None:
+      raise ValueError("Bugzilla info required for status checks")
+
+  if aasPushes is None:
+    aasPushes = [x.strip().split(" ") for x in sys.stdin if x.strip()]
+
+  aasRefPushes = []
+  for (sOldRev, sNewRev, sRefName) in aasPushes:
+    if not sRefName.startswith(sRefPrefix):
+      logger.debug("ignoring ref: '%s'" % (sRefName,))
+      continue
+
+    logger.debug("ref: '%s', oldrev: '%s', newrev: '%s'" % (sRefName, sOldRev, sNewRev))
+    aasRefPushes.append((sOldRev, sNewRev, sRefName))
+
+  if not aasRefPushes:
+    return
+
+  # the refs only name the commits in the problems found, one is enough
+  aoCommits = get_push_changes(aasRefPushes, sDefaultFormatSpec, None, False, sRefPrefix, False, bAllRefs=False)
+  asProblems = check_commits(aoCommits, oScanner, asAllowedStatuses, bRequireBugNumber,
+                             get_bz_getter(bz_wrap, sBZUrl, sBZUser, sBZPasswd, logger, oMetrics),
+                             oStatusCache, logger, oMetrics, bFailOpen, oScanCache)
+  if asProblems:
+    notify_and_exit("\n\n".join(asProblems))
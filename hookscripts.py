@@ -7,20 +7,37 @@ These pick up configuration values from the environment.
 """
 
 import os
-import re
 import sys
-import gitzilla.hooks
-import logging
 import configparser
+from gitzilla import sDefaultRefPrefix, sDefaultFormatSpec
+
+# the rest of gitzilla (and the Bugzilla client libraries) is only imported
+# when needed, so that a hook with nothing to do returns quickly.
 
 DEFAULT = 'DEFAULT'
 
+sSiteConfigFile = "/etc/gitzillarc"
+sUserConfigFile = "~/.gitzillarc"
+# the compiled settings of each repository (see gitzilla.settings), or None
+sSettingsCacheDir = "~/.cache/gitzilla/settings"
+
+# parsed configuration files, compiled scanners and Bugzilla wrappers are
+# kept for the lifetime of the process (see gitzillad).
+_tConfigs = None
+_dScanners = {}
+_dWrappers = {}
+
 def to_bool(v):
   if isinstance(v, str):
     return v.lower() in ["yes", "true", "t", "1"]
   else:
     return bool(v)
 
+def to_int(v):
+  if v is None:
+    return None
+  return int(v)
+
 def get_or_default(conf, section, option, default=None):
   if conf.has_option(section, option):
     return conf.get(section, option)
@@ -33,6 +50,127 @@ def has_option_or_default(conf, section, option):
   return conf.has_option(section, option) or conf.has_option(DEFAULT, option)
 
 
+def _mtime(sPath):
+  try:
+    return os.stat(sPath).st_mtime
+  except OSError:
+    return None
+
+
+def get_configs():
+  """
+  returns the (siteconfig, userconfig) pair of parsed configuration files.
+  They are only parsed again when one of the files is modified.
+  """
+  global _tConfigs
+  sUserConfigPath = os.path.expanduser(sUserConfigFile)
+  tMTimes = (_mtime(sSiteConfigFile), _mtime(sUserConfigPath))
+  if _tConfigs is None or _tConfigs[0] != tMTimes:
+    siteconfig = configparser.RawConfigParser()
+    with open(sSiteConfigFile) as oFile:
+      siteconfig.read_file(oFile)
+
+    userconfig = configparser.RawConfigParser()
+    userconfig.read(sUserConfigPath)
+    _tConfigs = (tMTimes, siteconfig, userconfig)
+
+  return _tConfigs[1:]
+
+
+def split_bug_regex(sPatterns):
+  # one regex per line
+  return [x.strip() for x in sPatterns.splitlines() if x.strip()]
+
+
+def split_bug_states(sStates):
+  return [x.strip() for x in sStates.split(",")]
+
+
+def get_repo_options(config, sRepo):
+  """
+  returns the options of the repository sRepo in the parsed config, its
+  section merged over DEFAULT.
+  """
+  if config.has_section(sRepo):
+    return dict(config.items(sRepo))
+  return dict(config.defaults())
+
+
+def get_secret_options(config, sRepo):
+  """
+  returns the options of the repository sRepo which the compiled settings
+  leave out (the credentials), see settings.asSecretOptions.
+  """
+  import gitzilla.settings
+  dOptions = get_repo_options(config, sRepo)
+  return dict((x, dOptions[x]) for x in gitzilla.settings.asSecretOptions if x in dOptions)
+
+
+def compile_settings(siteconfig, userconfig, sRepo):
+  """
+  returns the settings of the repository sRepo: its options from both
+  configuration files (its section merged over DEFAULT), along with the
+  parsed bug_regex and allowed_bug_states. The result can be stored as
+  JSON, as the credentials are left out (see get_secret_options).
+  """
+  import gitzilla.settings
+  def get_options(config):
+    dOptions = get_repo_options(config, sRepo)
+    for sOption in gitzilla.settings.asSecretOptions:
+      dOptions.pop(sOption, None)
+    return dOptions
+
+  dSite = get_options(siteconfig)
+  dParsed = {}
+  if "bug_regex" in dSite:
+    dParsed["bug_regex"] = split_bug_regex(dSite["bug_regex"])
+  if "allowed_bug_states" in dSite:
+    dParsed["allowed_bug_states"] = split_bug_states(dSite["allowed_bug_states"])
+
+  return {"site": dSite, "user": get_options(userconfig), "parsed": dParsed}
+
+
+def get_repo_configs(sRepo=None):
+  """
+  returns the (siteconfig, userconfig) pair for the repository sRepo, as
+  settings.RepoConfig instances holding only its options.
+
+  The compiled settings are kept in sSettingsCacheDir, so that the
+  configuration files are only parsed again when one of them changes, or
+  when the credentials, which are not kept, are needed.
+  """
+  import gitzilla.settings
+  if sRepo is None:
+    sRepo = os.getcwd()
+
+  sStamp = gitzilla.settings.get_stamp([sSiteConfigFile, os.path.expanduser(sUserConfigFile)])
+  oCache = None
+  dSettings = None
+  if sSettingsCacheDir is not None:
+    oCache = gitzilla.settings.SettingsCache(os.path.expanduser(sSettingsCacheDir))
+    dSettings = oCache.get(sRepo, sStamp)
+
+  if dSettings is None:
+    (siteconfig, userconfig) = get_configs()
+    dSettings = compile_settings(siteconfig, userconfig, sRepo)
+    if oCache is not None:
+      oCache.put(sRepo, sStamp, dSettings)
+
+  return (gitzilla.settings.RepoConfig(dSettings["site"], dSettings["parsed"],
+                                      lambda: get_secret_options(get_configs()[0], sRepo)),
+          gitzilla.settings.RepoConfig(dSettings["user"], None,
+                                      lambda: get_secret_options(get_configs()[1], sRepo)))
+
+
+def get_parsed(config, sRepo, sOption, fnParse):
+  # compiled settings come with the option already parsed.
+  if hasattr(config, "parsed"):
+    return config.parsed(sOption)
+  if has_option_or_default(config, sRepo, sOption):
+    return fnParse(get_or_default(config, sRepo, sOption))
+  return None
+
+
 def bz_auth_from_config(config, sRepo):
   sBZUser = None
   sBZPasswd = None
@@ -45,8 +183,9 @@ def bz_auth_from_config(config, sRepo):
 
 
 
-def get_bz_data(siteconfig, userconfig):
-  sRepo = os.getcwd()
+def get_bz_data(siteconfig, userconfig, sRepo=None):
+  if sRepo is None:
+    sRepo = os.getcwd()
 
   sBZUrl = get_or_default(siteconfig, sRepo, "bugzilla_url")
   if sBZUrl is None:
@@ -81,12 +220,65 @@ def get_bz_data(siteconfig, userconfig):
   return (sBZUrl, sBZUser, sBZPasswd)
 
 
-def get_logger(siteconfig):
-  sRepo = os.getcwd()
+def get_bz_wrap(siteconfig, sRepo=None):
+  """
+  returns the bz_wrap function to pass to the hooks: a BugzillaWrapper,
+  or an AsyncBugzillaWrapper if bz_backend is 'async', reusing its login
+  token across hook runs if reuse_login_token is set.
+
+  The tokens are kept in ~/.gitzilla_tokens of the user running the hook,
+  which is user-specific state, so they are never used when user_config
+  is 'deny'.
+
+  The bz_timeout, bz_retries, bz_backoff, bz_deadline and bz_circuit_*
+  options set the timeouts, retries and circuit breaker of the wrapper.
+  """
+  if sRepo is None:
+    sRepo = os.getcwd()
+
+  dOptions = {}
+  sUserOption = get_or_default(siteconfig, sRepo, "user_config", "allow")
+  if sUserOption != "deny" and to_bool(get_or_default(siteconfig, sRepo, "reuse_login_token", False)):
+    dOptions["token_file"] = os.path.expanduser("~/.gitzilla_tokens")
+
+  bAsync = get_or_default(siteconfig, sRepo, "bz_backend", "sync") == "async"
+  if bAsync:
+    if has_option_or_default(siteconfig, sRepo, "bz_max_in_flight"):
+      dOptions["max_in_flight"] = to_int(get_or_default(siteconfig, sRepo, "bz_max_in_flight"))
+  for (sOption, sArgument, fnParse) in [("bz_timeout", "timeout", float),
+                                        ("bz_retries", "retries", to_int),
+                                        ("bz_backoff", "backoff", float),
+                                        ("bz_deadline", "deadline", float),
+                                        ("bz_circuit_file", "circuit_file", str),
+                                        ("bz_circuit_threshold", "circuit_threshold", to_int),
+                                        ("bz_circuit_cooldown", "circuit_cooldown", float)]:
+    if has_option_or_default(siteconfig, sRepo, sOption):
+      dOptions[sArgument] = fnParse(get_or_default(siteconfig, sRepo, sOption))
+
+  def bz_wrap(sBZUrl, sBZUser, sBZPasswd):
+    # a logged in wrapper is shared by everything using the same settings
+    tKey = (bAsync, tuple(sorted(dOptions.items())), sBZUrl, sBZUser, sBZPasswd)
+    if tKey not in _dWrappers:
+      if bAsync:
+        from gitzilla.asyncbugwrap import AsyncBugzillaWrapper as cWrapper
+      else:
+        from gitzilla.bugwrap import BugzillaWrapper as cWrapper
+      _dWrappers[tKey] = cWrapper(sBZUrl, sBZUser, sBZPasswd, **dOptions)
+    return _dWrappers[tKey]
+
+  return bz_wrap
+
+
+def get_logger(siteconfig, sRepo=None):
+  if sRepo is None:
+    sRepo = os.getcwd()
   logger = None
   if has_option_or_default(siteconfig, sRepo, "logfile"):
+    import logging
     logger = logging.getLogger("gitzilla")
-    logger.addHandler(logging.FileHandler(get_or_default(siteconfig, sRepo, "logfile")))
+    sLogFile = os.path.abspath(get_or_default(siteconfig, sRepo, "logfile"))
+    if sLogFile not in [getattr(x, "baseFilename", None) for x in logger.handlers]:
+      logger.addHandler(logging.FileHandler(sLogFile))
     # default to debug, but switch to info if asked.
     sLogLevel = get_or_default(siteconfig, sRepo, "loglevel", "debug")
     logger.setLevel({"info": logging.INFO}.get(sLogLevel, logging.DEBUG))
@@ -94,16 +286,116 @@ def get_logger(siteconfig):
   return logger
 
 
-def get_bug_regex(siteconfig):
-  sRepo = os.getcwd()
+def get_bug_regex(siteconfig, sRepo=None):
+  if sRepo is None:
+    sRepo = os.getcwd()
   oBugRegex = None
-  if has_option_or_default(siteconfig, sRepo, "bug_regex"):
-    oBugRegex = re.compile(get_or_default(siteconfig, sRepo, "bug_regex"),
-                           re.MULTILINE | re.DOTALL | re.IGNORECASE)
+  asPatterns = get_parsed(siteconfig, sRepo, "bug_regex", split_bug_regex)
+  if asPatterns is not None:
+    # all the regexes are combined into a single scanner.
+    tPatterns = tuple(asPatterns)
+    if tPatterns not in _dScanners:
+      import gitzilla.bugrefs
+      _dScanners[tPatterns] = gitzilla.bugrefs.BugScanner(asPatterns)
+    oBugRegex = _dScanners[tPatterns]
 
   return oBugRegex
 
 
+def get_status_cache(siteconfig, sBZUrl, logger=None):
+  sRepo = os.getcwd()
+  oStatusCache = None
+  if has_option_or_default(siteconfig, sRepo, "status_cache"):
+    import gitzilla.cache
+    oStatusCache = gitzilla.cache.StatusCache(
+        get_or_default(siteconfig, sRepo, "status_cache"), sBZUrl,
+        to_int(get_or_default(siteconfig, sRepo, "status_cache_ttl")),
+        to_int(get_or_default(siteconfig, sRepo, "status_cache_size")),
+        logger)
+
+  return oStatusCache
+
+
+def get_scan_cache(siteconfig, logger=None):
+  """
+  returns the cache.ScanCache keeping the bug ids of the checked commits
+  in the status_cache database, or None if status_cache is not set or
+  scan_cache_size is 0.
+  """
+  sRepo = os.getcwd()
+  oScanCache = None
+  iMaxEntries = to_int(get_or_default(siteconfig, sRepo, "scan_cache_size"))
+  if has_option_or_default(siteconfig, sRepo, "status_cache") and iMaxEntries != 0:
+    import gitzilla.cache
+    oScanCache = gitzilla.cache.ScanCache(
+        get_or_default(siteconfig, sRepo, "status_cache"), iMaxEntries, logger)
+
+  return oScanCache
+
+
+def get_metrics(siteconfig, sHook, logger=None):
+  """
+  returns the metrics.Metrics instance recording the run of sHook, or a
+  metrics.NullMetrics if metrics_file is not set.
+  """
+  sRepo = os.getcwd()
+  import gitzilla.metrics
+  if not has_option_or_default(siteconfig, sRepo, "metrics_file"):
+    return gitzilla.metrics.NullMetrics()
+  return gitzilla.metrics.Metrics(
+      sHook, sRepo, get_or_default(siteconfig, sRepo, "metrics_file"),
+      get_or_default(siteconfig, sRepo, "metrics_format", "json"), logger)
+
+
+def get_bug_index(siteconfig, logger=None):
+  """
+  returns the index.BugIndex of the repository if bug_index is set, or
+  None.
+  """
+  sRepo = os.getcwd()
+  if not to_bool(get_or_default(siteconfig, sRepo, "bug_index", False)):
+    return None
+  import gitzilla.index
+  return gitzilla.index.BugIndex(gitzilla.index.get_index_path(), logger)
+
+
+def get_diffstat(siteconfig, sRepo):
+  """
+  returns the utils.DiffStat producing the diffstats of the comments, or
+  False if they have none.
+  """
+  bIncludeDiffStat = to_bool(get_or_default(siteconfig, sRepo, "include_diffstat", True))
+  sDiffStatMode = get_or_default(siteconfig, sRepo, "diffstat")
+  if sDiffStatMode is None and bIncludeDiffStat:
+    sDiffStatMode = "raw"
+  if sDiffStatMode in (None, "none"):
+    return False
+
+  import gitzilla.utils
+  fTimeout = get_or_default(siteconfig, sRepo, "diffstat_timeout")
+  return gitzilla.utils.DiffStat(
+      sDiffStatMode, to_int(get_or_default(siteconfig, sRepo, "diffstat_max_files")),
+      fTimeout is not None and float(fTimeout) or None)
+
+
+def get_template(siteconfig, sRepo=None):
+  """
+  returns the template.CommentTemplate rendering the comments of sRepo,
+  compiled once per process.
+  """
+  if sRepo is None:
+    sRepo = os.getcwd()
+  import gitzilla.template
+  sFormatSpec = get_or_default(siteconfig, sRepo, "formatspec", sDefaultFormatSpec)
+  sGitwebUrl = get_or_default(siteconfig, sRepo, "gitweb_url")
+  sProject = get_or_default(siteconfig, sRepo, "gitweb_project")
+  if sProject is None and sGitwebUrl is not None:
+    sProject = os.path.basename(sRepo.rstrip("/"))
+  return gitzilla.template.get_template(
+      sFormatSpec, sGitwebUrl, sProject,
+      to_int(get_or_default(siteconfig, sRepo, "max_comment_size")))
+
+
 def post_receive(aasPushes=None):
   """
   The gitzilla-post-receive hook script.
@@ -115,26 +407,47 @@ def post_receive(aasPushes=None):
 
   aasPushes is a list of (sOldRev, sNewRev, sRefName) tuples, for when these
   aren't read from stdin (gerrit integration).
+
+  Nothing else is done when none of the pushed refs is to be processed.
   """
-  siteconfig = configparser.RawConfigParser()
-  siteconfig.readfp(open("/etc/gitzillarc"))
   sRepo = os.getcwd()
+  (siteconfig, userconfig) = get_repo_configs(sRepo)
 
-  userconfig = configparser.RawConfigParser()
-  userconfig.read(os.path.expanduser("~/.gitzillarc"))
+  sRefPrefix = get_or_default(siteconfig, sRepo, "git_ref_prefix", sDefaultRefPrefix)
+  if aasPushes is None:
+    aasPushes = [x.strip().split(" ") for x in sys.stdin if x.strip()]
+  if not [x for x in aasPushes if x[2].startswith(sRefPrefix)]:
+    return
 
   (sBZUrl, sBZUser, sBZPasswd) = get_bz_data(siteconfig, userconfig)
 
   logger = get_logger(siteconfig)
   oBugRegex = get_bug_regex(siteconfig)
-  sRefPrefix = get_or_default(siteconfig, sRepo, "git_ref_prefix")
   sSeparator = get_or_default(siteconfig, sRepo, "separator")
   sFormatSpec = get_or_default(siteconfig, sRepo, "formatspec")
-  bIncludeDiffStat = to_bool(get_or_default(siteconfig, sRepo, "include_diffstat", True))
-
-  gitzilla.hooks.post_receive(sBZUrl, sBZUser, sBZPasswd, sFormatSpec,
-                              oBugRegex, sSeparator, logger, None,
-                              sRefPrefix, bIncludeDiffStat, aasPushes)
+  bIncludeDiffStat = get_diffstat(siteconfig, sRepo)
+  iMaxCommentSize = to_int(get_or_default(siteconfig, sRepo, "max_comment_size"))
+  iWorkers = to_int(get_or_default(siteconfig, sRepo, "comment_workers"))
+  oSpool = None
+  if has_option_or_default(siteconfig, sRepo, "spool_dir"):
+    import gitzilla.spool
+    oSpool = gitzilla.spool.Spool(get_or_default(siteconfig, sRepo, "spool_dir"))
+  oIndex = None
+  if to_bool(get_or_default(siteconfig, sRepo, "commit_index", False)):
+    import gitzilla.index
+    oIndex = gitzilla.index.CommitIndex(gitzilla.index.get_index_path(), logger)
+  oBugIndex = get_bug_index(siteconfig, logger)
+
+  oMetrics = get_metrics(siteconfig, "post-receive", logger)
+
+  import gitzilla.hooks
+  with oMetrics.run():
+    gitzilla.hooks.post_receive(sBZUrl, sBZUser, sBZPasswd, sFormatSpec,
+                                oBugRegex, sSeparator, logger, get_bz_wrap(siteconfig),
+                                sRefPrefix, bIncludeDiffStat, aasPushes,
+                                iMaxCommentSize, iWorkers, oSpool, oIndex, oMetrics,
+                                oBugIndex, get_template(siteconfig, sRepo),
+                                to_int(get_or_default(siteconfig, sRepo, "max_bug_comment_size")))
 
 
 
@@ -146,28 +459,212 @@ def update():
 
   The user specific configuration is allowed to override the bugzilla
   username and password.
+
+  Nothing else is done when the updated ref is not to be processed.
   """
-  siteconfig = configparser.RawConfigParser()
-  siteconfig.readfp(open("/etc/gitzillarc"))
   sRepo = os.getcwd()
+  (siteconfig, userconfig) = get_repo_configs(sRepo)
+
+  sRefPrefix = get_or_default(siteconfig, sRepo, "git_ref_prefix", sDefaultRefPrefix)
+  if len(sys.argv) > 1 and not sys.argv[1].startswith(sRefPrefix):
+    return
 
   logger = get_logger(siteconfig)
   oBugRegex = get_bug_regex(siteconfig)
-  sRefPrefix = get_or_default(siteconfig, sRepo, "git_ref_prefix")
   sSeparator = get_or_default(siteconfig, sRepo, "separator")
 
   bRequireBugNumber = to_bool(get_or_default(siteconfig, sRepo, "require_bug_ref", True))
-  asAllowedStatuses = None
-  if has_option_or_default(siteconfig, sRepo, "allowed_bug_states"):
-    asAllowedStatuses = [x.strip() for x in get_or_default(siteconfig, sRepo, "allowed_bug_states").split(",")]
+  asAllowedStatuses = get_parsed(siteconfig, sRepo, "allowed_bug_states", split_bug_states)
 
   # and the bugzilla info.
-  userconfig = configparser.RawConfigParser()
-  userconfig.read(os.path.expanduser("~/.gitzillarc"))
   (sBZUrl, sBZUser, sBZPasswd) = get_bz_data(siteconfig, userconfig)
 
-  gitzilla.hooks.update(oBugRegex, asAllowedStatuses, sSeparator, sBZUrl,
-                        sBZUser, sBZPasswd, logger, None, sRefPrefix,
-                        bRequireBugNumber)
+  oStatusCache = get_status_cache(siteconfig, sBZUrl, logger)
+  oScanCache = get_scan_cache(siteconfig, logger)
+  bFailOpen = get_or_default(siteconfig, sRepo, "bz_failure_policy", "closed") == "open"
+
+  oMetrics = get_metrics(siteconfig, "update", logger)
+
+  import gitzilla.hooks
+  with oMetrics.run():
+    gitzilla.hooks.update(oBugRegex, asAllowedStatuses, sSeparator, sBZUrl,
+                          sBZUser, sBZPasswd, logger, get_bz_wrap(siteconfig), sRefPrefix,
+                          bRequireBugNumber, oStatusCache, oMetrics, bFailOpen, oScanCache)
 
 
+
+
+def pre_receive(aasPushes=None):
+  """
+  The gitzilla-pre-receive hook script, checking a whole push at once
+  like gitzilla-update does for each ref. Use one or the other.
+
+  The configuration is picked up from /etc/gitzillarc and ~/.gitzillarc
+
+  The user specific configuration is allowed to override the bugzilla
+  username and password.
+
+  aasPushes is a list of (sOldRev, sNewRev, sRefName) tuples, for when these
+  aren't read from stdin.
+  """
+  sRepo = os.getcwd()
+  (siteconfig, userconfig) = get_repo_configs(sRepo)
+
+  sRefPrefix = get_or_default(siteconfig, sRepo, "git_ref_prefix", sDefaultRefPrefix)
+  if aasPushes is None:
+    aasPushes = [x.strip().split(" ") for x in sys.stdin if x.strip()]
+  if not [x for x in aasPushes if x[2].startswith(sRefPrefix)]:
+    return
+
+  logger = get_logger(siteconfig)
+  oBugRegex = get_bug_regex(siteconfig)
+  bRequireBugNumber = to_bool(get_or_default(siteconfig, sRepo, "require_bug_ref", True))
+  asAllowedStatuses = get_parsed(siteconfig, sRepo, "allowed_bug_states", split_bug_states)
+
+  (sBZUrl, sBZUser, sBZPasswd) = get_bz_data(siteconfig, userconfig)
+
+  oStatusCache = get_status_cache(siteconfig, sBZUrl, logger)
+  oScanCache = get_scan_cache(siteconfig, logger)
+  bFailOpen = get_or_default(siteconfig, sRepo, "bz_failure_policy", "closed") == "open"
+
+  oMetrics = get_metrics(siteconfig, "pre-receive", logger)
+
+  import gitzilla.hooks
+  with oMetrics.run():
+    gitzilla.hooks.pre_receive(oBugRegex, asAllowedStatuses, sBZUrl, sBZUser,
+                               sBZPasswd, logger, get_bz_wrap(siteconfig), sRefPrefix,
+                               bRequireBugNumber, oStatusCache, aasPushes, oMetrics, bFailOpen,
+                               oScanCache)
+
+
+
+
+def drain():
+  """
+  The gitzilla-drain script, delivering the comments spooled by
+  gitzilla-post-receive when spool_dir is set.
+
+    gitzilla-drain [--interval SECONDS] [spool_dir]
+
+  The spool directory defaults to the spool_dir of the DEFAULT section of
+  /etc/gitzillarc. Each spooled comment is posted using the Bugzilla
+  settings of the repository it came from, as resolved for the user
+  running gitzilla-drain. With --interval, the spool is drained again
+  every SECONDS seconds, forever.
+
+  With a spool_dir shared by all the repositories of a host, it is the
+  only process talking to Bugzilla for them: drain_workers and drain_rate
+  (requests per second) then bound the load on Bugzilla, the comments for
+  the same bug are combined across repositories, and the repositories
+  using the same Bugzilla URL and credentials share a single login. The
+  other Bugzilla settings (bz_timeout, ...) are those of the DEFAULT
+  section.
+  """
+  import argparse
+  import time
+  import gitzilla.spool
+  oParser = argparse.ArgumentParser(prog="gitzilla-drain")
+  oParser.add_argument("--interval", type=float, default=None)
+  oParser.add_argument("spool_dir", nargs="?", default=None)
+  oArgs = oParser.parse_args()
+
+  (siteconfig, userconfig) = get_configs()
+
+  sSpoolDir = oArgs.spool_dir or get_or_default(siteconfig, DEFAULT, "spool_dir")
+  if not sSpoolDir:
+    print("no spool directory given, and no spool_dir configured")
+    sys.exit(1)
+
+  logger = get_logger(siteconfig, DEFAULT)
+  iWorkers = to_int(get_or_default(siteconfig, DEFAULT, "drain_workers"))
+  iMaxAttempts = to_int(get_or_default(siteconfig, DEFAULT, "drain_retries"))
+  iBackoff = to_int(get_or_default(siteconfig, DEFAULT, "drain_backoff"))
+  fRate = get_or_default(siteconfig, DEFAULT, "drain_rate")
+  fRate = fRate is not None and float(fRate) or None
+  iMaxCommentSize = to_int(get_or_default(siteconfig, DEFAULT, "max_comment_size"))
+
+  def bz_for_repo(sRepo):
+    try:
+      (sBZUrl, sBZUser, sBZPasswd) = get_bz_data(siteconfig, userconfig, sRepo)
+    except SystemExit:
+      raise ValueError("no bugzilla_url configured for %s" % (sRepo,))
+    # the wrappers are made with the settings of the DEFAULT section,
+    # so there is one per Bugzilla URL and credentials.
+    return bz_wrap(sBZUrl, sBZUser, sBZPasswd)
+
+  bz_wrap = get_bz_wrap(siteconfig, DEFAULT)
+  oSpool = gitzilla.spool.Spool(sSpoolDir)
+  while True:
+    tResult = gitzilla.spool.drain(oSpool, bz_for_repo, iWorkers,
+                                   iMaxAttempts, iBackoff, logger,
+                                   fRate, iMaxCommentSize)
+    if tResult is not None and logger is not None:
+      logger.info("drained %s: %d delivered, %d failed" % ((sSpoolDir,) + tResult))
+    if oArgs.interval is None:
+      break
+    time.sleep(oArgs.interval)
+
+
+
+def backfill():
+  """
+  The gitzilla-backfill script, commenting the bugs referred to by the
+  commits already in a repository (see gitzilla.backfill).
+
+    gitzilla-backfill [--workers N] [--rate N] [--batch-size N] [--dry-run] [revision...]
+
+  Run it in the repository, like the hooks, with the same configuration.
+  The revisions (as passed to git log) default to all the refs under
+  git_ref_prefix. The progress is kept in the commit index of the
+  repository, so an interrupted run resumes where it stopped.
+  """
+  import argparse
+  oParser = argparse.ArgumentParser(prog="gitzilla-backfill")
+  oParser.add_argument("--workers", type=int, default=None)
+  oParser.add_argument("--rate", type=float, default=None,
+                       help="the maximum number of comments posted per second")
+  oParser.add_argument("--batch-size", type=int, default=None)
+  oParser.add_argument("--dry-run", action="store_true")
+  oParser.add_argument("revisions", nargs="*")
+  oArgs = oParser.parse_args()
+
+  sRepo = os.getcwd()
+  (siteconfig, userconfig) = get_repo_configs(sRepo)
+
+  asRevArgs = oArgs.revisions
+  if not asRevArgs:
+    sRefPrefix = get_or_default(siteconfig, sRepo, "git_ref_prefix", sDefaultRefPrefix)
+    asRevArgs = sRefPrefix and ["--glob=%s*" % (sRefPrefix,)] or ["--all"]
+
+  (sBZUrl, sBZUser, sBZPasswd) = get_bz_data(siteconfig, userconfig)
+
+  logger = get_logger(siteconfig)
+  iWorkers = oArgs.workers or to_int(get_or_default(siteconfig, sRepo, "comment_workers"))
+  oMetrics = get_metrics(siteconfig, "backfill", logger)
+
+  import gitzilla.hooks
+  import gitzilla.index
+  import gitzilla.backfill
+  from gitzilla import NullLogger
+  oIndex = gitzilla.index.CommitIndex(gitzilla.index.get_index_path(), logger)
+  fnGetBZ = gitzilla.hooks.get_bz_getter(get_bz_wrap(siteconfig), sBZUrl, sBZUser, sBZPasswd,
+                                         logger or NullLogger, oMetrics)
+
+  with oMetrics.run():
+    tResult = gitzilla.backfill.backfill(
+        asRevArgs, fnGetBZ, oIndex, get_bug_regex(siteconfig),
+        get_or_default(siteconfig, sRepo, "formatspec"), get_diffstat(siteconfig, sRepo),
+        to_int(get_or_default(siteconfig, sRepo, "max_comment_size")), iWorkers,
+        oArgs.rate, oArgs.batch_size, logger, oMetrics, oArgs.dry_run,
+        get_bug_index(siteconfig, logger), get_template(siteconfig, sRepo))
+
+    if tResult is None:
+      print("gitzilla-backfill: another backfill of this repository is running")
+      sys.exit(1)
+
+    if oArgs.dry_run:
+      print("gitzilla-backfill: %d commit(s) to process, %d comment(s) to post" % tResult[:2])
+    else:
+      print("gitzilla-backfill: %d commit(s) processed, %d comment(s) posted, %d failed" % tResult)
+    if tResult[2]:
+      sys.exit(1)
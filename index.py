@@ -0,0 +1,252 @@
+
+"""
+index - what gitzilla knows about the commits of a repository.
+
+Both indexes live in the same SQLite database, gitzilla.db in the git
+directory: CommitIndex holds the commits already processed, BugIndex the
+bugs each commit refers to and the refs it was pushed to.
+
+"""
+
+import os
+import time
+import sqlite3
+from gitzilla import NullLogger
+
+
+class _Index(object):
+  """
+  an SQLite database at sPath, opened on first use, with the tables and
+  indexes created by the statements of asSchema.
+  """
+
+  asSchema = []
+
+  def __init__(self, sPath, logger=None):
+    if logger is None:
+      logger = NullLogger
+
+    self.sPath = sPath
+    self._logger = logger
+    self._oDB = None
+
+
+  def _db(self):
+    if self._oDB is None:
+      oDB = sqlite3.connect(self.sPath, timeout=10)
+      try:
+        oDB.execute("PRAGMA journal_mode=WAL")
+      except sqlite3.Error:
+        pass
+      for sStatement in self.asSchema:
+        oDB.execute(sStatement)
+      oDB.commit()
+      self._oDB = oDB
+    return self._oDB
+
+
+
+class CommitIndex(_Index):
+  """
+  records the commits whose comments have been posted to Bugzilla (or
+  spooled), in an SQLite database holding one row per commit, keyed by
+  its binary sha. The post-receive hook skips the commits found there, so
+  a commit pushed again after a force-push, a rebase or a branch being
+  deleted and recreated is not commented a second time.
+
+  Like the status cache, a broken or locked index is logged and treated
+  as empty, it never fails the hook.
+
+  The bugs already commented for a commit which is not fully processed
+  yet can be recorded as well (see add_posted), so that a backfill
+  interrupted or failing half-way through a commit's bugs does not
+  comment any of them twice.
+  """
+
+  asSchema = [
+    """CREATE TABLE IF NOT EXISTS commits (
+         sha BLOB PRIMARY KEY,
+         processed REAL NOT NULL) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS posted (
+         sha BLOB NOT NULL,
+         bug INTEGER NOT NULL,
+         PRIMARY KEY (sha, bug)) WITHOUT ROWID""",
+  ]
+
+
+  def contains(self, sSha):
+    """
+    tells whether the commit sSha (in hex) was already processed.
+    """
+    try:
+      oRow = self._db().execute("SELECT 1 FROM commits WHERE sha = ?",
+                                (bytes.fromhex(sSha),)).fetchone()
+    except sqlite3.Error:
+      self._logger.exception("Could not read the commit index %s" % (self.sPath,))
+      return False
+    return oRow is not None
+
+
+  def add(self, asShas):
+    """
+    records the commits asShas (in hex) as processed.
+    """
+    fNow = time.time()
+    aRows = [(bytes.fromhex(x), fNow) for x in asShas]
+    if not aRows:
+      return
+
+    try:
+      oDB = self._db()
+      with oDB:
+        oDB.executemany("INSERT OR IGNORE INTO commits VALUES (?, ?)", aRows)
+        oDB.executemany("DELETE FROM posted WHERE sha = ?", [x[:1] for x in aRows])
+    except sqlite3.Error:
+      self._logger.exception("Could not update the commit index %s" % (self.sPath,))
+
+
+  def posted(self, sSha):
+    """
+    returns the set of the bugs already commented for the commit sSha,
+    which is not processed yet.
+    """
+    try:
+      aRows = self._db().execute("SELECT bug FROM posted WHERE sha = ?",
+                                 (bytes.fromhex(sSha),)).fetchall()
+    except sqlite3.Error:
+      self._logger.exception("Could not read the commit index %s" % (self.sPath,))
+      return set()
+    return set(x[0] for x in aRows)
+
+
+  def add_posted(self, atShaBugs):
+    """
+    records that the bugs of the (sSha, iBugId) tuples of atShaBugs were
+    commented for these commits.
+    """
+    aRows = [(bytes.fromhex(x), y) for (x, y) in atShaBugs]
+    if not aRows:
+      return
+
+    try:
+      oDB = self._db()
+      with oDB:
+        oDB.executemany("INSERT OR IGNORE INTO posted VALUES (?, ?)", aRows)
+    except sqlite3.Error:
+      self._logger.exception("Could not update the commit index %s" % (self.sPath,))
+
+
+  def __len__(self):
+    try:
+      return self._db().execute("SELECT COUNT(*) FROM commits").fetchone()[0]
+    except sqlite3.Error:
+      return 0
+
+
+
+class BugIndex(_Index):
+  """
+  the bugs referred to by the commits of a repository, and the refs these
+  commits were first pushed to, maintained by the post-receive hook (and
+  gitzilla-backfill) when bug_index is set. Answers "which commits refer
+  to bug 123?" and "which bugs does this commit refer to?" without
+  looking at the history or at Bugzilla.
+
+  Like CommitIndex, errors are logged and never fail the hook; a lookup
+  which fails finds nothing.
+  """
+
+  # bug -> commits, and through the second index commit -> bugs
+  asSchema = [
+    """CREATE TABLE IF NOT EXISTS links (
+         bug INTEGER NOT NULL,
+         sha BLOB NOT NULL,
+         added REAL NOT NULL,
+         PRIMARY KEY (bug, sha)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS links_by_sha ON links (sha, bug)",
+    """CREATE TABLE IF NOT EXISTS refs (
+         sha BLOB NOT NULL,
+         ref TEXT NOT NULL,
+         PRIMARY KEY (sha, ref)) WITHOUT ROWID""",
+  ]
+
+
+  def add(self, atCommits):
+    """
+    records the (sSha, aiBugIds, asRefs) tuples of atCommits: the commit
+    sSha (in hex) refers to the bugs aiBugIds and was pushed to the refs
+    asRefs. Commits referring to no bug are not recorded.
+    """
+    fNow = time.time()
+    aLinks = []
+    aRefs = []
+    for (i, (sSha, aiBugIds, asRefs)) in enumerate(atCommits):
+      if not aiBugIds:
+        continue
+      bSha = bytes.fromhex(sSha)
+      # a microsecond apart, so that the commits keep their order
+      aLinks.extend((x, bSha, fNow + i * 1e-6) for x in aiBugIds)
+      aRefs.extend((bSha, x) for x in asRefs)
+    if not aLinks:
+      return
+
+    try:
+      oDB = self._db()
+      with oDB:
+        oDB.executemany("INSERT OR IGNORE INTO links VALUES (?, ?, ?)", aLinks)
+        oDB.executemany("INSERT OR IGNORE INTO refs VALUES (?, ?)", aRefs)
+    except sqlite3.Error:
+      self._logger.exception("Could not update the bug index %s" % (self.sPath,))
+
+
+  def _refs(self, oDB, bSha):
+    return [x[0] for x in oDB.execute("SELECT ref FROM refs WHERE sha = ? ORDER BY ref", (bSha,))]
+
+
+  def commits(self, iBugId):
+    """
+    returns the commits referring to the bug iBugId, as a list of (sSha,
+    asRefs) tuples, in the order they were recorded.
+    """
+    try:
+      oDB = self._db()
+      aRows = oDB.execute("SELECT sha FROM links WHERE bug = ? ORDER BY added, sha",
+                          (iBugId,)).fetchall()
+      return [(x[0].hex(), self._refs(oDB, x[0])) for x in aRows]
+    except sqlite3.Error:
+      self._logger.exception("Could not read the bug index %s" % (self.sPath,))
+      return []
+
+
+  def bugs(self, sSha):
+    """
+    returns the bugs referred to by the commits whose sha starts with
+    sSha (in hex, at least 4 digits), as a list of (sSha, aiBugIds,
+    asRefs) tuples. Only known commits referring to bugs are listed.
+    """
+    sSha = sSha.lower()
+    if len(sSha) < 4 or len(sSha) > 40:
+      raise ValueError("'%s' is not an abbreviated commit sha" % (sSha,))
+    bLow = bytes.fromhex((sSha + "0" * (40 - len(sSha))))
+    bHigh = bytes.fromhex((sSha + "f" * (40 - len(sSha))))
+    try:
+      oDB = self._db()
+      dBugs = {}
+      for (bFound, iBugId) in oDB.execute("SELECT sha, bug FROM links WHERE sha BETWEEN ? AND ? ORDER BY sha, bug",
+                                          (bLow, bHigh)):
+        dBugs.setdefault(bFound, []).append(iBugId)
+      return [(x.hex(), y, self._refs(oDB, x)) for (x, y) in sorted(dBugs.items())]
+    except sqlite3.Error:
+      self._logger.exception("Could not read the bug index %s" % (self.sPath,))
+      return []
+
+
+
+def get_index_path(sGitDir=None):
+  """
+  returns the path of the commit index of the repository at sGitDir, by
+  default the one the hook runs for ($GIT_DIR, or the current directory).
+  """
+  if sGitDir is None:
+    sGitDir = os.environ.get("GIT_DIR", ".")
+  return os.path.join(os.path.abspath(sGitDir), "gitzilla.db")
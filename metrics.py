@@ -0,0 +1,280 @@
+
+"""
+metrics - timings and counters of the hook runs.
+
+A Metrics instance is passed through a hook run. It collects timing spans
+(how often and how long each phase or external call took) and counters
+(commits scanned, bugs referenced, requests issued, ...), and is
+exported at the end of the run, either as a JSON record appended to a
+file, or to a Prometheus textfile (for the node exporter's textfile
+collector) holding totals over all the runs.
+
+When metrics are disabled, NullMetrics is used instead: its methods do
+nothing, so the instrumented code costs a method call per span.
+
+"""
+
+import os
+import json
+import time
+import fcntl
+import threading
+
+
+class _Span(object):
+  __slots__ = ("_oMetrics", "_sName", "_fStart")
+
+  def __init__(self, oMetrics, sName):
+    self._oMetrics = oMetrics
+    self._sName = sName
+
+
+  def __enter__(self):
+    self._fStart = time.perf_counter()
+    return self
+
+
+  def __exit__(self, oType, oValue, oTraceback):
+    self._oMetrics.add_time(self._sName, time.perf_counter() - self._fStart)
+    return False
+
+
+
+class Metrics(object):
+  """
+  the metrics of a run of the hook sHook for the repository sRepo, to be
+  exported to sPath in sFormat ('json' or 'prometheus') by run(). May be
+  used from several threads.
+  """
+
+  asFormats = ["json", "prometheus"]
+
+  def __init__(self, sHook, sRepo=None, sPath=None, sFormat="json", logger=None):
+    if sFormat not in self.asFormats:
+      raise ValueError("unknown metrics format '%s', must be one of %s" % (sFormat, ", ".join(self.asFormats)))
+
+    self.sHook = sHook
+    self.sRepo = sRepo
+    self.sPath = sPath
+    self.sFormat = sFormat
+    self._logger = logger
+    self._oLock = threading.Lock()
+    self.fStart = time.time()
+    self.fDuration = None
+    self.iStatus = None
+    # name -> count
+    self.dCounters = {}
+    # name -> [count, total seconds, longest]
+    self.dSpans = {}
+
+
+  def span(self, sName):
+    """
+    returns a context manager timing a span called sName.
+    """
+    return _Span(self, sName)
+
+
+  def add_time(self, sName, fSeconds):
+    with self._oLock:
+      afSpan = self.dSpans.get(sName)
+      if afSpan is None:
+        self.dSpans[sName] = [1, fSeconds, fSeconds]
+      else:
+        afSpan[0] += 1
+        afSpan[1] += fSeconds
+        afSpan[2] = max(afSpan[2], fSeconds)
+
+
+  def count(self, sName, iValue=1):
+    with self._oLock:
+      self.dCounters[sName] = self.dCounters.get(sName, 0) + iValue
+
+
+  def timed(self, aoItems, sName):
+    """
+    yields the items of the iterable aoItems, adding the time spent
+    waiting for each of them (e.g. for git to produce a commit) to the
+    span sName.
+    """
+    oIterator = iter(aoItems)
+    while True:
+      fStart = time.perf_counter()
+      try:
+        oItem = next(oIterator)
+      except StopIteration:
+        self.add_time(sName, time.perf_counter() - fStart)
+        return
+      self.add_time(sName, time.perf_counter() - fStart)
+      yield oItem
+
+
+  def run(self):
+    """
+    returns a context manager for the whole hook run: it records the
+    duration and the exit status, then exports the metrics.
+    """
+    return _Run(self)
+
+
+  def record(self):
+    """
+    returns the metrics as a dict, which can be stored as JSON.
+    """
+    with self._oLock:
+      return {
+        "hook": self.sHook,
+        "repo": self.sRepo,
+        "start": self.fStart,
+        "duration": self.fDuration,
+        "status": self.iStatus,
+        "counters": dict(self.dCounters),
+        "spans": dict((x, {"count": y[0], "seconds": y[1], "max": y[2]})
+                      for (x, y) in self.dSpans.items()),
+      }
+
+
+  def export(self):
+    """
+    writes the metrics to sPath. Failures are logged, they never fail
+    the hook.
+    """
+    if self.sPath is None:
+      return
+    try:
+      if self.sFormat == "json":
+        write_json(self.record(), self.sPath)
+      else:
+        write_prometheus(self.record(), self.sPath)
+    except (IOError, OSError, ValueError):
+      if self._logger is not None:
+        self._logger.exception("Could not write the metrics to %s" % (self.sPath,))
+
+
+
+class _Run(object):
+  def __init__(self, oMetrics):
+    self._oMetrics = oMetrics
+
+
+  def __enter__(self):
+    self._fStart = time.perf_counter()
+    return self._oMetrics
+
+
+  def __exit__(self, oType, oValue, oTraceback):
+    oMetrics = self._oMetrics
+    oMetrics.fDuration = time.perf_counter() - self._fStart
+    if oType is None:
+      oMetrics.iStatus = 0
+    elif issubclass(oType, SystemExit):
+      oMetrics.iStatus = oValue.code if isinstance(oValue.code, int) else 1
+    else:
+      oMetrics.iStatus = 1
+    oMetrics.export()
+    return False
+
+
+
+class _NullContext(object):
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, oType, oValue, oTraceback):
+    return False
+
+
+
+class NullMetrics(object):
+  """
+  metrics which are not collected.
+  """
+
+  _oContext = _NullContext()
+
+  def span(self, sName):
+    return self._oContext
+
+
+  def add_time(self, sName, fSeconds):
+    pass
+
+
+  def count(self, sName, iValue=1):
+    pass
+
+
+  def timed(self, aoItems, sName):
+    return aoItems
+
+
+  def run(self):
+    return self._oContext
+
+
+
+def write_json(dRecord, sPath):
+  """
+  appends dRecord to sPath, as a line of JSON.
+  """
+  sLine = json.dumps(dRecord, sort_keys=True) + "\n"
+  iFd = os.open(sPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  try:
+    # a single write, so that concurrent hooks do not mix their lines
+    os.write(iFd, sLine.encode("utf-8"))
+  finally:
+    os.close(iFd)
+
+
+def _prometheus_samples(dRecord):
+  sLabels = 'hook="%s"' % (dRecord["hook"],)
+  dSamples = {
+    "gitzilla_runs_total{%s}" % (sLabels,): 1,
+    "gitzilla_failed_runs_total{%s}" % (sLabels,): dRecord["status"] and 1 or 0,
+    "gitzilla_run_seconds_total{%s}" % (sLabels,): dRecord["duration"] or 0.0,
+  }
+  for (sName, iValue) in dRecord["counters"].items():
+    dSamples["gitzilla_%s_total{%s}" % (sName, sLabels)] = iValue
+  for (sName, dSpan) in dRecord["spans"].items():
+    sSpanLabels = '%s,span="%s"' % (sLabels, sName)
+    dSamples["gitzilla_span_count_total{%s}" % (sSpanLabels,)] = dSpan["count"]
+    dSamples["gitzilla_span_seconds_total{%s}" % (sSpanLabels,)] = dSpan["seconds"]
+  return dSamples
+
+
+def write_prometheus(dRecord, sPath):
+  """
+  adds dRecord to the totals kept in the Prometheus textfile sPath. The
+  file is replaced atomically, under a lock shared by the hook processes.
+  """
+  with open(sPath + ".lock", "w") as oLockFile:
+    fcntl.flock(oLockFile, fcntl.LOCK_EX)
+    dSamples = {}
+    try:
+      with open(sPath) as oFile:
+        for sLine in oFile:
+          if sLine.startswith("gitzilla_"):
+            (sKey, sValue) = sLine.rsplit(" ", 1)
+            dSamples[sKey] = float(sValue)
+    except (IOError, OSError):
+      pass
+
+    for (sKey, fValue) in _prometheus_samples(dRecord).items():
+      dSamples[sKey] = dSamples.get(sKey, 0) + fValue
+    dSamples['gitzilla_last_run_timestamp_seconds{hook="%s"}' % (dRecord["hook"],)] = dRecord["start"]
+
+    asLines = []
+    sLastName = None
+    for sKey in sorted(dSamples):
+      sName = sKey.split("{", 1)[0]
+      if sName != sLastName:
+        asLines.append("# TYPE %s %s" % (sName, sName.endswith("_total") and "counter" or "gauge"))
+        sLastName = sName
+      asLines.append("%s %r" % (sKey, dSamples[sKey]))
+
+    sTmpPath = "%s.%d" % (sPath, os.getpid())
+    with open(sTmpPath, "w") as oFile:
+      oFile.write("\n".join(asLines) + "\n")
+    os.chmod(sTmpPath, 0o644)
+    os.rename(sTmpPath, sPath)
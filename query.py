@@ -0,0 +1,87 @@
+
+"""
+query - looks up the bug index of a repository.
+
+    gitzilla-query [--git-dir DIR] [--json] bug ID...
+    gitzilla-query [--git-dir DIR] [--json] commit SHA...
+
+The first form lists the commits referring to the bugs, the second the
+bugs the commits (abbreviated to 4 digits or more) refer to, along with
+the refs they were pushed to, as tab separated "bug sha refs" lines. It
+only reads the index kept by the post-receive hook when bug_index is set
+(see index.BugIndex), never the history nor Bugzilla. The repository
+defaults to $GIT_DIR, or the current directory.
+
+commits_for_bug and bugs_for_commit do the same from Python.
+
+"""
+
+import os
+import sys
+import json
+from gitzilla.index import BugIndex, get_index_path
+
+
+def open_bug_index(sGitDir=None):
+  """
+  returns the index.BugIndex of the repository at sGitDir, raising
+  IOError if it has none.
+  """
+  sPath = get_index_path(sGitDir)
+  if not os.path.exists(sPath):
+    raise IOError("no bug index at %s" % (sPath,))
+  return BugIndex(sPath)
+
+
+def commits_for_bug(iBugId, sGitDir=None):
+  """
+  returns the commits of the repository at sGitDir referring to the bug
+  iBugId, as a list of (sSha, asRefs) tuples.
+  """
+  return open_bug_index(sGitDir).commits(iBugId)
+
+
+def bugs_for_commit(sSha, sGitDir=None):
+  """
+  returns the bugs referred to by the commits of the repository at
+  sGitDir whose sha starts with sSha, as a list of (sSha, aiBugIds,
+  asRefs) tuples.
+  """
+  return open_bug_index(sGitDir).bugs(sSha)
+
+
+def main():
+  import argparse
+  oParser = argparse.ArgumentParser(prog="gitzilla-query")
+  oParser.add_argument("--git-dir", default=None)
+  oParser.add_argument("--json", action="store_true")
+  oParser.add_argument("kind", choices=["bug", "commit"])
+  oParser.add_argument("keys", nargs="+")
+  oArgs = oParser.parse_args()
+
+  try:
+    oIndex = open_bug_index(oArgs.git_dir)
+    # (bug id, sha, refs) of the matches
+    atFound = []
+    for sKey in oArgs.keys:
+      if oArgs.kind == "bug":
+        atFound.extend((int(sKey), x, y) for (x, y) in oIndex.commits(int(sKey)))
+      else:
+        for (sSha, aiBugIds, asRefs) in oIndex.bugs(sKey):
+          atFound.extend((x, sSha, asRefs) for x in aiBugIds)
+  except (IOError, ValueError) as e:
+    print("gitzilla-query: %s" % (e,))
+    sys.exit(2)
+
+  if oArgs.json:
+    print(json.dumps([{"bug": x, "commit": y, "refs": z} for (x, y, z) in atFound], indent=2))
+  else:
+    for (iBugId, sSha, asRefs) in atFound:
+      print("%d\t%s\t%s" % (iBugId, sSha, ",".join(asRefs)))
+
+  if not atFound:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,131 @@
+
+"""
+settings - the settings of a repository, compiled from the configuration.
+
+Parsing a large /etc/gitzillarc (one section per repository) and looking
+up every option of a hook in it takes longer than the hook itself when
+there is nothing to do. The options of a repository are therefore
+resolved once (its section merged over DEFAULT, for both configuration
+files), stored in a small JSON file per repository, and loaded from
+there by the following hook runs until one of the configuration files
+changes. The credentials are never stored: they are read from the
+configuration files when they are needed.
+
+"""
+
+import os
+import json
+import hashlib
+
+
+def get_stamp(asPaths):
+  """
+  returns a string identifying the current version of the files in
+  asPaths (their modification time and size).
+  """
+  asParts = []
+  for sPath in asPaths:
+    try:
+      oStat = os.stat(sPath)
+      asParts.append("%s:%d:%d" % (sPath, oStat.st_mtime_ns, oStat.st_size))
+    except OSError:
+      asParts.append("%s:-" % (sPath,))
+  return "\n".join(asParts)
+
+
+# the options left out of the compiled settings
+asSecretOptions = ["bugzilla_password"]
+
+
+
+class RepoConfig(object):
+  """
+  the options of one repository, as a stand-in for the parsed
+  configuration file: has_option() and get() ignore the section, so the
+  hookscripts helpers can be used with it unchanged.
+
+  dParsed holds the options which were also parsed when compiling the
+  settings (e.g. the list of allowed bug states), see parsed().
+
+  The options of asSecretOptions are not in dOptions: fnSecrets returns
+  them as a dict, and is only called the first time one is asked for.
+  """
+
+  def __init__(self, dOptions, dParsed=None, fnSecrets=None):
+    self._dOptions = dOptions
+    self._dParsed = dParsed or {}
+    self._fnSecrets = fnSecrets
+
+
+  def _options(self, sOption):
+    if sOption in asSecretOptions and self._fnSecrets is not None:
+      self._dOptions = dict(self._dOptions, **self._fnSecrets())
+      self._fnSecrets = None
+    return self._dOptions
+
+
+  def has_option(self, sSection, sOption):
+    return sOption in self._options(sOption)
+
+
+  def get(self, sSection, sOption):
+    return self._options(sOption)[sOption]
+
+
+  def options(self):
+    return dict(self._options(asSecretOptions[0]))
+
+
+  def parsed(self, sOption):
+    """
+    returns the parsed value of sOption, or None if it is not set.
+    """
+    return self._dParsed.get(sOption)
+
+
+
+class SettingsCache(object):
+  """
+  the compiled settings of the repositories, one JSON file each in the
+  directory sDir. Only the user owning sDir may read them, though they
+  hold no credentials (see asSecretOptions).
+
+  Errors are never fatal: an unreadable entry is a miss, and an entry
+  which cannot be written is simply not cached.
+  """
+
+  def __init__(self, sDir):
+    self.sDir = sDir
+
+
+  def _path(self, sRepo):
+    return os.path.join(self.sDir, hashlib.sha1(sRepo.encode("utf-8")).hexdigest() + ".json")
+
+
+  def get(self, sRepo, sStamp):
+    """
+    returns the settings dict stored for sRepo, or None if there is none
+    or it was compiled from configuration files other than sStamp.
+    """
+    try:
+      with open(self._path(sRepo)) as oFile:
+        dEntry = json.load(oFile)
+    except (IOError, OSError, ValueError):
+      return None
+    if dEntry.get("repo") != sRepo or dEntry.get("stamp") != sStamp:
+      return None
+    return dEntry["settings"]
+
+
+  def put(self, sRepo, sStamp, dSettings):
+    try:
+      if not os.path.isdir(self.sDir):
+        os.makedirs(self.sDir, 0o700)
+      sPath = self._path(sRepo)
+      sTmpPath = "%s.%d" % (sPath, os.getpid())
+      iFd = os.open(sTmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(iFd, "w") as oFile:
+        json.dump({"repo": sRepo, "stamp": sStamp, "settings": dSettings}, oFile)
+      os.rename(sTmpPath, sPath)
+    except (IOError, OSError):
+      pass
@@ -12,7 +12,6 @@ args = dict(
   author_email='gera@theoldmonk.net',
   url='http://www.theoldmonk.net/gitzilla/',
   version='2.0',
-  requires=['pybugz'],
   package_dir={'gitzilla': '.'},
   packages=['gitzilla'],
   package_data={'': ['etc/*']},
@@ -21,6 +20,13 @@ args = dict(
     'console_scripts': [
       'gitzilla-post-receive = gitzilla.hookscripts:post_receive',
       'gitzilla-update = gitzilla.hookscripts:update',
+      'gitzilla-pre-receive = gitzilla.hookscripts:pre_receive',
+      'gitzilla-drain = gitzilla.hookscripts:drain',
+      'gitzilla-backfill = gitzilla.hookscripts:backfill',
+      'gitzillad = gitzilla.daemon:main',
+      'gitzilla-client = gitzilla.client:main',
+      'gitzilla-query = gitzilla.query:main',
+      'gitzilla-bench = gitzilla.benchmarks:main',
       'gitzilla-gencookie = gitzilla.utilscripts:generate_cookiefile',
     ],
   }
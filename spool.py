@@ -0,0 +1,229 @@
+
+"""
+spool - a durable local queue for the Bugzilla comments of post-receive.
+
+The post-receive hook can spool its comments instead of posting them,
+and the gitzilla-drain script delivers them later. Each work item is a
+JSON file, written to tmp/ and atomically renamed into new/ once it is
+safely on disk. Items are only removed after they have been delivered,
+which gives at-least-once delivery. Items which keep failing are moved
+to failed/ for manual inspection.
+
+"""
+
+import os
+import json
+import time
+import fcntl
+import itertools
+from collections import OrderedDict
+from gitzilla import iDefaultCommentWorkers, iDefaultDrainRetries, iDefaultDrainBackoff
+from gitzilla import iDefaultMaxCommentSize
+from gitzilla import NullLogger
+from gitzilla.utils import RateLimiter, split_comments
+
+
+class Spool(object):
+  """
+  a spool directory holding (repository, bug id, comment) work items.
+  """
+
+  _oCounter = itertools.count()
+
+  def __init__(self, sDir):
+    self.sDir = sDir
+    self._sTmpDir = os.path.join(sDir, "tmp")
+    self._sNewDir = os.path.join(sDir, "new")
+    self._sFailedDir = os.path.join(sDir, "failed")
+
+
+  def _makedirs(self):
+    for sDir in (self._sTmpDir, self._sNewDir, self._sFailedDir):
+      if not os.path.isdir(sDir):
+        os.makedirs(sDir)
+
+
+  def _write(self, sName, dItem):
+    sTmpPath = os.path.join(self._sTmpDir, sName)
+    with open(sTmpPath, "w") as oFile:
+      json.dump(dItem, oFile)
+      oFile.flush()
+      os.fsync(oFile.fileno())
+    os.rename(sTmpPath, os.path.join(self._sNewDir, sName))
+
+
+  def put(self, sRepo, iBugId, sComment):
+    """
+    queues sComment to be added to bug iBugId, on behalf of the repository
+    at sRepo (whose configuration is used to reach Bugzilla).
+    """
+    self._makedirs()
+    sName = "%.6f-%d-%d.json" % (time.time(), os.getpid(), next(self._oCounter))
+    self._write(sName, {"repo": sRepo, "bug": iBugId, "comment": sComment,
+                        "attempts": 0, "not_before": 0})
+
+
+  def lock(self):
+    """
+    takes the exclusive drain lock of the spool, so that a single drainer
+    works on it at a time. Returns the lock file, which must be kept open
+    while draining, or None if another drainer holds the lock.
+    """
+    self._makedirs()
+    oLockFile = open(os.path.join(self.sDir, "lock"), "w")
+    try:
+      fcntl.flock(oLockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+      oLockFile.close()
+      return None
+    return oLockFile
+
+
+  def pending(self):
+    """
+    returns the (sName, dItem) pairs of the items which are due for
+    delivery, oldest first.
+    """
+    if not os.path.isdir(self._sNewDir):
+      return []
+
+    fNow = time.time()
+    aItems = []
+    for sName in sorted(os.listdir(self._sNewDir)):
+      try:
+        with open(os.path.join(self._sNewDir, sName)) as oFile:
+          dItem = json.load(oFile)
+      except (IOError, OSError, ValueError):
+        continue
+      if dItem.get("not_before", 0) <= fNow:
+        aItems.append((sName, dItem))
+    return aItems
+
+
+  def done(self, sName):
+    """
+    removes a delivered item.
+    """
+    os.unlink(os.path.join(self._sNewDir, sName))
+
+
+  def retry(self, sName, dItem, iMaxAttempts, iBackoff):
+    """
+    records a failed delivery attempt of an item. The next attempt is
+    delayed exponentially; after iMaxAttempts attempts, the item is moved
+    to the failed/ directory. Returns True if the item will be retried.
+    """
+    dItem["attempts"] = dItem.get("attempts", 0) + 1
+    if dItem["attempts"] >= iMaxAttempts:
+      os.rename(os.path.join(self._sNewDir, sName),
+                os.path.join(self._sFailedDir, sName))
+      return False
+
+    dItem["not_before"] = time.time() + iBackoff * 2 ** (dItem["attempts"] - 1)
+    self._write(sName, dItem)
+    return True
+
+
+
+def drain(oSpool, bz_for_repo, iWorkers=None, iMaxAttempts=None, iBackoff=None, logger=None, fRate=None, iMaxCommentSize=None):
+  """
+  delivers the due items of oSpool to Bugzilla, using at most iWorkers
+  concurrent requests, and at most fRate requests per second in all (no
+  limit if None). bz_for_repo(sRepo) must return the
+  bugwrap.BugzillaWrapper to use for the items of the repository sRepo.
+
+  When the spool is shared by the repositories of a host, the drainer is
+  the only process talking to Bugzilla for all of them. bz_for_repo
+  should then return the same wrapper for repositories using the same
+  Bugzilla and credentials, so that they share its login: the items of
+  the same bug with the same wrapper, whichever repository they come
+  from, are combined into as few comments as possible, none longer than
+  iMaxCommentSize characters. The comments of a bug are posted in order,
+  one at a time.
+
+  Failed items are retried on later runs, with an exponential backoff
+  starting at iBackoff seconds, up to iMaxAttempts times.
+
+  Returns a (iDelivered, iFailed) tuple counting the items, or None if
+  another drainer is already working on the spool.
+  """
+  if iWorkers is None:
+    iWorkers = iDefaultCommentWorkers
+
+  if iMaxAttempts is None:
+    iMaxAttempts = iDefaultDrainRetries
+
+  if iBackoff is None:
+    iBackoff = iDefaultDrainBackoff
+
+  if iMaxCommentSize is None:
+    iMaxCommentSize = iDefaultMaxCommentSize
+
+  if logger is None:
+    logger = NullLogger
+
+  from concurrent.futures import ThreadPoolExecutor
+  from gitzilla.asyncbugwrap import resolve
+
+  oLockFile = oSpool.lock()
+  if oLockFile is None:
+    logger.info("spool %s is being drained by another process" % (oSpool.sDir,))
+    return None
+
+  try:
+    oLimiter = RateLimiter(fRate)
+    dItems = {}
+    dWrappers = {}
+    # (wrapper, bug id) -> the names of its items, oldest first
+    dGroups = OrderedDict()
+    abResults = []
+    for (sName, dItem) in oSpool.pending():
+      sRepo = dItem["repo"]
+      try:
+        if sRepo not in dWrappers:
+          dWrappers[sRepo] = bz_for_repo(sRepo)
+      except Exception:
+        logger.exception("Could not get the Bugzilla settings of %s" % (sRepo,))
+        if not oSpool.retry(sName, dItem, iMaxAttempts, iBackoff):
+          logger.error("Giving up on spooled comment %s for bug %d" % (sName, dItem["bug"]))
+        abResults.append(False)
+        continue
+      dItems[sName] = dItem
+      dGroups.setdefault((dWrappers[sRepo], dItem["bug"]), []).append(sName)
+
+    def deliver(tGroup):
+      ((oBZ, iBugId), asNames) = tGroup
+      atComments = split_comments([(x, dItems[x]["comment"]) for x in asNames], iMaxCommentSize)
+      abDelivered = []
+      for (i, (sComment, asCommentNames)) in enumerate(atComments):
+        oLimiter.wait()
+        try:
+          resolve(oBZ.add_bug_comment(iBugId, sComment))
+        except Exception:
+          logger.exception("Could not add spooled comment(s) %s to bug %d" % (", ".join(asCommentNames), iBugId))
+          # the following comments wait, so that they stay in order
+          for (sComment, asLaterNames) in atComments[i:]:
+            for sName in asLaterNames:
+              if not oSpool.retry(sName, dItems[sName], iMaxAttempts, iBackoff):
+                logger.error("Giving up on spooled comment %s for bug %d" % (sName, iBugId))
+              abDelivered.append(False)
+          break
+
+        for sName in asCommentNames:
+          oSpool.done(sName)
+          abDelivered.append(True)
+      return abDelivered
+
+    atGroups = list(dGroups.items())
+    if iWorkers > 1 and len(atGroups) > 1:
+      with ThreadPoolExecutor(max_workers=iWorkers) as oPool:
+        for abDelivered in oPool.map(deliver, atGroups):
+          abResults.extend(abDelivered)
+    else:
+      for tGroup in atGroups:
+        abResults.extend(deliver(tGroup))
+  finally:
+    oLockFile.close()
+
+  iDelivered = len([x for x in abResults if x])
+  return (iDelivered, len(abResults) - iDelivered)
@@ -0,0 +1,229 @@
+
+"""
+template - renders the comments added to the bugs.
+
+The comments used to be rendered by git, which had to output each commit
+twice (its fields, and the formatspec), and were posted whatever their
+size. A CommentTemplate compiles the formatspec once into a Python format
+string filled from the fields git outputs anyway, and fits each comment in
+a size budget: the diffstat is cut first, then the body of the message;
+when not even the headers fit, the commit is only mentioned. A link to the commit in gitweb can be added,
+using the URL scheme of extensions/Gitzilla/Extension.pm.
+
+Formatspecs using placeholders other than those of the commit fields
+(e.g. %d or %h) are still rendered by git, and only the size budget
+applies.
+
+"""
+
+import re
+from gitzilla import iDefaultMaxCommentSize
+
+
+# the placeholders of the utils.Commit fields
+dFieldPlaceholders = {
+  "H": "sha",
+  "P": "parents",
+  "aN": "author",
+  "aE": "author_email",
+  "aD": "author_date",
+  "cN": "committer",
+  "cE": "committer_email",
+  "cD": "committer_date",
+  "s": "subject",
+  "b": "body",
+}
+
+oPlaceholderRegex = re.compile(r"%(aN|aE|aD|cN|cE|cD|[HPsbn%])|%")
+
+oDiffStatSummaryRegex = re.compile(r"\s*\d+ files? changed")
+
+# templates by their arguments, so that a process (or gitzillad) compiles
+# each one once.
+_dTemplates = {}
+
+
+def truncate(sText, iMaxSize, bKeepSummary=False):
+  """
+  returns sText cut at a line boundary to fit in iMaxSize characters,
+  along with a note telling how much was left out, or "" if not even the
+  note fits. If bKeepSummary is True, a last line summing up a diffstat
+  ('N files changed, ...') is kept.
+  """
+  if len(sText) <= iMaxSize:
+    return sText
+
+  asLines = sText.split("\n")
+  asTail = []
+  if bKeepSummary and len(asLines) > 1 and oDiffStatSummaryRegex.match(asLines[-1]):
+    asTail = [asLines.pop()]
+
+  iRoom = iMaxSize - sum(len(x) + 1 for x in asTail)
+  asKept = []
+  iSize = 0
+  for sLine in asLines:
+    sNote = "[... %d more line(s)]" % (len(asLines) - len(asKept),)
+    if iSize + len(sLine) + 1 + len(sNote) > iRoom:
+      break
+    asKept.append(sLine)
+    iSize += len(sLine) + 1
+
+  if not asKept:
+    # a single long line
+    iKept = iMaxSize - len("[... %d more character(s)]" % (len(sText),))
+    if iKept < 0:
+      return ""
+    return sText[:iKept] + "[... %d more character(s)]" % (len(sText) - iKept,)
+
+  sNote = "[... %d more line(s)]" % (len(asLines) - len(asKept),)
+  return "\n".join(asKept + [sNote] + asTail)
+
+
+
+class CommentTemplate(object):
+  """
+  renders the comments of commits (utils.Commit instances) according to
+  the git log format spec sFormatSpec, in at most iMaxSize characters (no
+  limit if None).
+
+  If sGitwebUrl is given (e.g. 'http://www.example.com/gitweb/'), the
+  comments link to the commit in the gitweb project sProject (e.g.
+  'tmp.git').
+
+  compiled tells whether the comments are rendered here; if not,
+  sGitFormatSpec is the format spec git must render the commits with.
+  """
+
+  def __init__(self, sFormatSpec, sGitwebUrl=None, sProject=None, iMaxSize=None):
+    if iMaxSize is not None and iMaxSize < 1:
+      raise ValueError("the maximum comment size must be positive, not %d" % (iMaxSize,))
+
+    self.sGitwebUrl = sGitwebUrl
+    self.sProject = sProject
+    self.iMaxSize = iMaxSize
+    sFormatSpec = sFormatSpec.strip("\n")
+
+    asFormat = []
+    self._asFields = []
+    iPos = 0
+    self.compiled = True
+    for oMatch in oPlaceholderRegex.finditer(sFormatSpec):
+      asFormat.append(sFormatSpec[iPos:oMatch.start()].replace("%", "%%"))
+      iPos = oMatch.end()
+      sPlaceholder = oMatch.group(1)
+      if sPlaceholder is None:
+        self.compiled = False
+        break
+      elif sPlaceholder == "n":
+        asFormat.append("\n")
+      elif sPlaceholder == "%":
+        asFormat.append("%%")
+      else:
+        asFormat.append("%s")
+        self._asFields.append(dFieldPlaceholders[sPlaceholder])
+    asFormat.append(sFormatSpec[iPos:].replace("%", "%%"))
+
+    if self.compiled:
+      self._sFormat = "".join(asFormat)
+      # git itself only has to output the fields
+      self.sGitFormatSpec = ""
+    else:
+      self._sFormat = None
+      self._asFields = []
+      self.sGitFormatSpec = sFormatSpec
+
+
+  def render(self, oCommit, sBody=None):
+    """
+    returns the text of oCommit according to the format spec, with sBody
+    as its body if given. Only for compiled templates.
+    """
+    atValues = []
+    for sField in self._asFields:
+      if sField == "body" and sBody is not None:
+        atValues.append(sBody)
+      elif sField == "parents":
+        atValues.append(" ".join(oCommit.parents))
+      else:
+        atValues.append(getattr(oCommit, sField))
+    return (self._sFormat % tuple(atValues)).strip("\n")
+
+
+  def link(self, oCommit):
+    """
+    returns the gitweb URL of oCommit, or None.
+    """
+    if self.sGitwebUrl is None:
+      return None
+    return "%s?p=%s;a=commit;h=%s" % (self.sGitwebUrl, self.sProject, oCommit.sha)
+
+
+  def summary(self, oCommit):
+    """
+    returns a one line mention of oCommit, for when a bug has no room
+    left for its comment. With a project, Extension.pm links it.
+    """
+    if self.sProject is not None:
+      return "%s commit %s %s" % (self.sProject, oCommit.sha, oCommit.subject)
+    return "commit %s %s" % (oCommit.sha, oCommit.subject)
+
+
+  def comment(self, oCommit):
+    """
+    returns the comment of oCommit: its formatted text (see render), its
+    gitweb link and its diffstat, cut to fit in iMaxSize characters. If
+    not even its headers fit, it is the summary of oCommit (or its start),
+    so it is never empty.
+    """
+    sText = oCommit.formatted
+    sLink = self.link(oCommit)
+    sDiffStat = oCommit.diffstat
+
+    def join(sText, sDiffStat):
+      return "\n\n".join(x for x in [sText, sLink, sDiffStat] if x)
+
+    sComment = join(sText, sDiffStat)
+    if self.iMaxSize is None or len(sComment) <= self.iMaxSize:
+      return sComment
+
+    # the diffstat goes first, though it keeps a quarter of the room when
+    # the message is long too.
+    if sDiffStat:
+      iRoom = self.iMaxSize - len(join(sText, "")) - 2
+      sDiffStat = truncate(sDiffStat, max(iRoom, self.iMaxSize // 4), True)
+      sComment = join(sText, sDiffStat)
+      if len(sComment) <= self.iMaxSize:
+        return sComment
+
+    # then the body of the message, keeping the headers and the subject,
+    # and at last the diffstat, if it is still in the way
+    for sDiffStat in [sDiffStat, ""]:
+      sBody = ""
+      if "body" in self._asFields and oCommit.body:
+        # rendered with an empty body, the text loses the blank line
+        # before it: the room is measured with a one character body.
+        iRoom = self.iMaxSize - len(join(self.render(oCommit, "x"), sDiffStat)) + 1
+        sBody = truncate(oCommit.body.strip("\n"), max(iRoom, 0))
+        sText = self.render(oCommit, sBody)
+      sComment = join(sText, sDiffStat)
+      if len(sComment) <= self.iMaxSize:
+        return sComment
+
+    # not even the headers fit (nor, maybe, a note of what was cut): the
+    # commit is only mentioned.
+    return self.summary(oCommit)[:self.iMaxSize]
+
+
+
+def get_template(sFormatSpec, sGitwebUrl=None, sProject=None, iMaxSize=None):
+  """
+  returns the CommentTemplate for these arguments, compiling it only the
+  first time. iMaxSize defaults to the default max_comment_size.
+  """
+  if iMaxSize is None:
+    iMaxSize = iDefaultMaxCommentSize
+
+  tKey = (sFormatSpec, sGitwebUrl, sProject, iMaxSize)
+  if tKey not in _dTemplates:
+    _dTemplates[tKey] = CommentTemplate(sFormatSpec, sGitwebUrl, sProject, iMaxSize)
+  return _dTemplates[tKey]
@@ -0,0 +1,44 @@
+
+"""
+tests of bugrefs - run with 'python -m unittest discover tests', with
+gitzilla installed (or on the PYTHONPATH).
+
+"""
+
+import re
+import unittest
+from gitzilla.bugrefs import BugScanner, get_scanner
+
+
+class BugScannerTest(unittest.TestCase):
+
+  def test_default_regex(self):
+    oScanner = get_scanner()
+    self.assertEqual(oScanner.bug_ids("fix Bug #12, see bug 7 and BUG12"), [12, 7])
+
+
+  def test_several_patterns(self):
+    oScanner = BugScanner([r"bug\s*(?P<bug>\d+)", r"issue-(?P<bug>\d+)"])
+    self.assertEqual(oScanner.bug_ids("issue-3 and bug 4"), [3, 4])
+
+
+  def test_leading_inline_flags(self):
+    # allowed at the start of a regex of its own, but not inside the
+    # combined one.
+    oScanner = BugScanner([r"(?i)bug\s*(?P<bug>\d+)", r"(?x) issue \s* (?P<bug>\d+)"])
+    self.assertEqual(oScanner.bug_ids("BUG 1, issue 2"), [1, 2])
+
+
+  def test_inline_flags_are_scoped(self):
+    oScanner = BugScanner([re.compile(r"(?x) id \s (?P<bug>\d+)"), re.compile(r"bug (?P<bug>\d+)")])
+    self.assertEqual(oScanner.bug_ids("bug 5 id 6"), [5, 6])
+
+
+  def test_global_inline_flags(self):
+    oScanner = BugScanner([r"(?a)bug\s*(?P<bug>\d+)", re.compile(r"id (?P<bug>\d+)")])
+    self.assertTrue(oScanner.flags & re.ASCII)
+    self.assertEqual(oScanner.bug_ids("bug 9 id 8"), [9, 8])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,78 @@
+"""
+tests of template - run with 'python -m unittest discover tests', with
+gitzilla installed (or on the PYTHONPATH).
+
+"""
+
+import unittest
+from gitzilla import sDefaultFormatSpec
+from gitzilla.utils import Commit
+from gitzilla.template import CommentTemplate, truncate
+
+
+def make_commit(sSubject="fix the frobnicator", sBody="", sDiffStat=""):
+  oCommit = Commit()
+  oCommit.sha = "0123456789abcdef0123456789abcdef01234567"
+  oCommit.parents = ["89abcdef0123456789abcdef0123456789abcdef"]
+  oCommit.author = oCommit.committer = "Tester"
+  oCommit.author_email = oCommit.committer_email = "tester@example.com"
+  oCommit.author_date = oCommit.committer_date = "Sun, 18 Oct 2026 10:29:04 +0000"
+  oCommit.subject = sSubject
+  oCommit.body = sBody
+  oCommit.diffstat = sDiffStat
+  oCommit.refs = []
+  return oCommit
+
+
+class CommentTemplateTest(unittest.TestCase):
+
+  def comment(self, oCommit, iMaxSize):
+    oTemplate = CommentTemplate(sDefaultFormatSpec, iMaxSize=iMaxSize)
+    oCommit.formatted = oTemplate.render(oCommit)
+    sComment = oTemplate.comment(oCommit)
+    self.assertTrue(0 < len(sComment) <= iMaxSize)
+    return sComment
+
+
+  def test_fits(self):
+    oCommit = make_commit(sBody="a short body", sDiffStat=":100644 100644 a b M\tf")
+    sComment = self.comment(oCommit, 2000)
+    self.assertEqual(sComment, "%s\n\n%s" % (oCommit.formatted, oCommit.diffstat))
+
+
+  def test_single_line_body(self):
+    for iMaxSize in [2000, 400]:
+      sComment = self.comment(make_commit(sBody="x" * 5000), iMaxSize)
+      self.assertTrue(sComment.startswith("commit      0123456789abcdef"))
+      self.assertIn("fix the frobnicator\n\nxxx", sComment)
+      self.assertTrue(sComment.endswith(" more character(s)]"))
+      self.assertEqual(len(sComment), iMaxSize)
+
+
+  def test_multi_line_body(self):
+    sBody = "\n".join("line %d of the body" % (i,) for i in range(500))
+    sComment = self.comment(make_commit(sBody=sBody), 1000)
+    self.assertIn("fix the frobnicator\n\nline 0 of the body\nline 1 of the body\n", sComment)
+    self.assertRegex(sComment, r"\[\.\.\. \d+ more line\(s\)\]$")
+
+
+  def test_diffstat_only(self):
+    sDiffStat = "\n".join(":100644 100644 0123456 789abcd M\tfile%d" % (i,) for i in range(200))
+    oCommit = make_commit(sBody="a short body", sDiffStat=sDiffStat)
+    sComment = self.comment(oCommit, 1000)
+    # the message is whole, only the diffstat is cut
+    self.assertTrue(sComment.startswith(oCommit.formatted + "\n\n:100644"))
+    self.assertRegex(sComment, r"\[\.\.\. \d+ more line\(s\)\]$")
+
+
+  def test_headers_too_big(self):
+    oCommit = make_commit(sSubject="s" * 500, sBody="a body")
+    sComment = self.comment(oCommit, 100)
+    self.assertTrue(sComment.startswith("commit 0123456789abcdef"))
+    self.assertEqual(len(sComment), 100)
+
+
+  def test_truncate(self):
+    self.assertEqual(truncate("short", 10), "short")
+    self.assertEqual(truncate("a\nb\nc\nd", 5), "")
+    self.assertEqual(truncate("a\nb\nc\nd\ne\nf\ng\nh\ni\nj" * 3, 30), "a\nb\nc\nd\n[... 24 more line(s)]")
@@ -6,42 +6,351 @@ utils module for gitzilla
 
 import os
 import sys
+import time
+import codecs
+import select
+import threading
 import subprocess
+from gitzilla import fDefaultDiffStatTimeout
 
 
 sNoCommitRev = "0000000000000000000000000000000000000000"
 
-def execute(asCommand, bSplitLines=False, bIgnoreErrors=False):
+def execute(asCommand, bSplitLines=False, bIgnoreErrors=False, sInput=None, bMergeErrors=True):
   """
   Utility function to execute a command and return the output.
+  sInput, if given, is written to the standard input of the command.
+  Unless bMergeErrors is False, the standard error of the command is part
+  of its output; otherwise it is only shown if the command fails.
   """
+  if bMergeErrors:
+    iStderr = subprocess.STDOUT
+  else:
+    iStderr = subprocess.PIPE
   p = subprocess.Popen(asCommand,
                        stdin=subprocess.PIPE,
                        stdout=subprocess.PIPE,
-                       stderr=subprocess.STDOUT,
+                       stderr=iStderr,
                        shell=False,
                        close_fds=True,
                        universal_newlines=True,
                        env=None)
-  if bSplitLines:
-    data = p.stdout.readlines()
-  else:
-    data = p.stdout.read()
-  iRetCode = p.wait()
-  if iRetCode and not bIgnoreErrors:
-    print('Failed to execute command: %s\n%s' % (asCommand, data), file=sys.stderr)
+  (data, sErrors) = p.communicate(sInput)
+  if p.returncode and not bIgnoreErrors:
+    print('Failed to execute command: %s\n%s' % (asCommand, sErrors or data), file=sys.stderr)
     sys.exit(-1)
 
+  if bSplitLines:
+    data = data.splitlines(True)
   return data
 
 
+def execute_records(asCommand, sSeparator, sInput=None, bIgnoreErrors=False):
+  """
+  Utility generator to execute a command and yield its output one record
+  at a time, as it is produced. Records are separated by sSeparator, and
+  anything before the first separator is skipped. Only the record being
+  read is kept in memory.
+
+  If the consumer stops early, the command is killed.
+  """
+  p = subprocess.Popen(asCommand,
+                       stdin=subprocess.PIPE,
+                       stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE,
+                       shell=False,
+                       close_fds=True,
+                       env=None)
+  try:
+    if sInput is not None:
+      p.stdin.write(sInput.encode("utf-8"))
+    p.stdin.close()
+
+    oDecoder = codecs.getincrementaldecoder("utf-8")("replace")
+    bSeenSeparator = False
+    sBuffer = ""
+    while True:
+      abChunk = p.stdout.read1(65536)
+      # only look for a separator in the text which is new, or which might
+      # complete a separator at the end of the buffer.
+      iSearchFrom = max(0, len(sBuffer) - len(sSeparator) + 1)
+      sBuffer += oDecoder.decode(abChunk, not abChunk)
+      while True:
+        iPos = sBuffer.find(sSeparator, iSearchFrom)
+        if iPos < 0:
+          break
+        if bSeenSeparator:
+          yield sBuffer[:iPos]
+        bSeenSeparator = True
+        sBuffer = sBuffer[iPos + len(sSeparator):]
+        iSearchFrom = 0
+      if not abChunk:
+        break
+
+    if bSeenSeparator:
+      yield sBuffer
+
+    sErrors = p.stderr.read().decode("utf-8", "replace")
+    iRetCode = p.wait()
+    if iRetCode and not bIgnoreErrors:
+      print('Failed to execute command: %s\n%s' % (asCommand, sErrors), file=sys.stderr)
+      sys.exit(-1)
+  finally:
+    if p.poll() is None:
+      p.kill()
+      p.wait()
+    p.stdout.close()
+    p.stderr.close()
+
+
+def get_exclusions(asRefNames, sRefPrefix):
+  """
+  returns the git rev-list arguments which exclude all the commits
+  reachable from the refs starting with sRefPrefix, apart from the refs
+  in asRefNames.
+
+  git expands the refs itself, so the command line does not grow with the
+  number of refs in the repository, and no extra git process is needed to
+  list them. The arguments must come after all the revisions to include.
+  """
+  if sRefPrefix == "":
+    sGlob = "refs/*"
+  elif sRefPrefix.startswith("refs/"):
+    sGlob = sRefPrefix
+  else:
+    # git would prepend 'refs/' to the glob, but such a prefix matches
+    # no refs at all.
+    return []
+
+  return (["--not"] +
+          ["--exclude=%s" % (x,) for x in asRefNames] +
+          ["--glob=%s" % (sGlob,)])
+
+
+class Commit(object):
+  """
+  a commit, as read from git by get_commits.
+
+  formatted is the commit rendered by git according to the format spec,
+  and diffstat the (possibly empty) list of changes to the files. refs are
+  the pushed refs which introduced the commit, if known.
+  """
+  __slots__ = ('sha', 'parents', 'author', 'author_email', 'author_date',
+               'committer', 'committer_email', 'committer_date',
+               'subject', 'body', 'formatted', 'diffstat', 'refs')
+
+  def message(self):
+    """
+    returns the commit message, which is what bug refs are looked for in.
+    """
+    return "%s\n\n%s" % (self.subject, self.body)
+
+  def comment(self):
+    """
+    returns the text to add to the bugs the commit refers to.
+    """
+    if self.diffstat:
+      return "%s\n\n%s" % (self.formatted, self.diffstat)
+    return self.formatted
+
+
+class DiffStat(object):
+  """
+  makes the diffstats of commits, as shown in their comments, with a
+  single long-lived 'git diff-tree --stdin' process.
+
+  sMode is 'raw' (the list of changed files, as git whatchanged shows it),
+  'stat' (a histogram of the changes, as git diff --stat) or 'shortstat'
+  (only the summary line). At most iMaxFiles files are listed, if given.
+  Merges get no diffstat.
+
+  A commit whose diffstat takes longer than fTimeout seconds (e.g. a huge
+  vendor import) gets a note instead, and the git process is restarted
+  for the next one, so that one commit cannot stall the push.
+  """
+
+  asModes = ["raw", "stat", "shortstat"]
+
+  # not a commit id, so git diff-tree copies it to its output once it is
+  # done with the commit before it.
+  sMarker = "--gitzilla-diffstat-end--"
+
+  def __init__(self, sMode="raw", iMaxFiles=None, fTimeout=None):
+    if sMode not in self.asModes:
+      raise ValueError("unknown diffstat mode '%s', must be one of %s" % (sMode, ", ".join(self.asModes)))
+
+    if fTimeout is None:
+      fTimeout = fDefaultDiffStatTimeout
+
+    self.sMode = sMode
+    self.iMaxFiles = iMaxFiles
+    self.fTimeout = fTimeout
+    self._p = None
+    self._abBuffer = b""
+
+
+  def _command(self):
+    # --root: a root commit is shown as adding all its files, as git
+    # whatchanged did.
+    asCommand = ["git", "diff-tree", "--stdin", "--no-commit-id", "-r", "--root"]
+    if self.sMode == "raw":
+      asCommand += ["--raw", "--abbrev"]
+    elif self.sMode == "stat":
+      asCommand += ["--stat"]
+      if self.iMaxFiles is not None:
+        asCommand += ["--stat-count=%d" % (self.iMaxFiles,)]
+    else:
+      asCommand += ["--shortstat"]
+    return asCommand
+
+
+  def get(self, oCommit):
+    """
+    returns the diffstat of the Commit oCommit.
+    """
+    if len(oCommit.parents) > 1:
+      return ""
+
+    if self._p is None:
+      self._p = subprocess.Popen(self._command(), stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 close_fds=True)
+      self._abBuffer = b""
+
+    abMarker = ("%s\n" % (self.sMarker,)).encode("ascii")
+    fDeadline = time.time() + self.fTimeout
+    try:
+      self._p.stdin.write(("%s\n" % (oCommit.sha,)).encode("ascii") + abMarker)
+      self._p.stdin.flush()
+      while True:
+        iPos = self._abBuffer.find(abMarker)
+        if iPos >= 0:
+          abOutput = self._abBuffer[:iPos]
+          self._abBuffer = self._abBuffer[iPos + len(abMarker):]
+          break
+        fLeft = fDeadline - time.time()
+        if fLeft <= 0 or not select.select([self._p.stdout], [], [], fLeft)[0]:
+          self.close()
+          return "(diffstat left out: it took more than %gs)" % (self.fTimeout,)
+        abChunk = os.read(self._p.stdout.fileno(), 65536)
+        if not abChunk:
+          raise IOError("git diff-tree exited")
+        self._abBuffer += abChunk
+    except (IOError, OSError):
+      self.close()
+      return "(diffstat not available)"
+
+    sOutput = abOutput.decode("utf-8", "replace").strip("\n")
+    if self.sMode == "raw" and self.iMaxFiles is not None:
+      asLines = sOutput.split("\n")
+      if len(asLines) > self.iMaxFiles:
+        sOutput = "\n".join(asLines[:self.iMaxFiles] +
+                            ["... and %d more file(s)" % (len(asLines) - self.iMaxFiles,)])
+    return sOutput
+
+
+  def close(self):
+    """
+    stops the git process, if any. It is started again when needed.
+    """
+    if self._p is not None:
+      try:
+        self._p.stdin.close()
+      except (IOError, OSError):
+        pass
+      if self._p.poll() is None:
+        self._p.kill()
+      self._p.wait()
+      self._p.stdout.close()
+      self._p = None
+
+
+
+def get_diffstat(bIncludeDiffStat):
+  """
+  returns the DiffStat for bIncludeDiffStat, which is either a DiffStat,
+  or a boolean (True meaning the 'raw' diffstat). Returns None for no
+  diffstat.
+  """
+  if isinstance(bIncludeDiffStat, DiffStat):
+    return bIncludeDiffStat
+  if bIncludeDiffStat:
+    return DiffStat()
+  return None
+
+
+# the git placeholders for the Commit fields, in get_commits output order.
+asCommitPlaceholders = ["%H", "%P", "%aN", "%aE", "%aD", "%cN", "%cE", "%cD", "%s", "%b"]
+
+
+def get_commits(asRevArgs, sFormatSpec, bIncludeDiffStat, sInput=None, bSource=False):
+  """
+  yields a Commit for each commit listed by 'git log asRevArgs', in
+  chronological order. sInput, if given, is fed to git (for --stdin).
+  If bSource is True, the refs of each commit are set to the revision
+  through which it was reached (see git log --source). bIncludeDiffStat
+  is a boolean or a DiffStat, see get_diffstat.
+
+  git is asked for NUL-delimited fields, so the commit messages can
+  contain anything, and the output is parsed as it is read, one field at
+  a time.
+  """
+  sFormatSpec = sFormatSpec.strip("\n").replace("\n", "%n")
+  oDiffStat = get_diffstat(bIncludeDiffStat)
+
+  asPlaceholders = list(asCommitPlaceholders)
+  if bSource:
+    asPlaceholders.append("%S")
+  asPlaceholders.append(sFormatSpec)
+
+  # each commit starts with a NUL, and each field is followed by one; the
+  # newline between commits follows the last one.
+  asCommand = (['git', "log", "--reverse",
+                "--format=format:%%x00%s%%x00" % ("%x00".join(asPlaceholders),)] +
+               asRevArgs)
+
+  iFields = len(asPlaceholders) + 1
+  asFields = []
+  try:
+    for sField in execute_records(asCommand, "\0", sInput):
+      asFields.append(sField)
+      if len(asFields) == iFields:
+        yield _make_commit(asFields, bSource, oDiffStat)
+        asFields = []
+
+    if asFields:
+      # the record of the last commit is not followed by a newline
+      asFields.append("")
+      yield _make_commit(asFields, bSource, oDiffStat)
+  finally:
+    if oDiffStat is not None:
+      oDiffStat.close()
+
+
+def _make_commit(asFields, bSource, oDiffStat):
+  oCommit = Commit()
+  (oCommit.sha, sParents, oCommit.author, oCommit.author_email,
+   oCommit.author_date, oCommit.committer, oCommit.committer_email,
+   oCommit.committer_date, oCommit.subject, oCommit.body) = asFields[:10]
+  oCommit.parents = sParents.split()
+  oCommit.refs = bSource and [asFields[10]] or []
+  oCommit.formatted = asFields[-2].strip("\n")
+  oCommit.diffstat = ""
+  if oDiffStat is not None:
+    oCommit.diffstat = oDiffStat.get(oCommit)
+  return oCommit
+
+
 def get_changes(sOldRev, sNewRev, sFormatSpec, sSeparator, bIncludeDiffStat, sRefName, sRefPrefix):
   """
-  returns an array of chronological changes, between sOldRev and sNewRev,
-  according to the format spec sFormatSpec.
+  yields the changes between sOldRev and sNewRev in chronological order,
+  as Commit objects formatted according to the format spec sFormatSpec.
+  The changes are read from git as they are produced, never all at once.
 
   Gets changes which are only on the specified ref, excluding changes
   also present on other refs starting with sRefPrefix.
+
+  sSeparator is no longer needed, and is ignored.
   """
   if sOldRev == sNoCommitRev:
     sCommitRange = sNewRev
@@ -50,36 +359,153 @@ def get_changes(sOldRev, sNewRev, sFormatSpec, sSeparator, bIncludeDiffStat, sRe
   else:
     sCommitRange = "%s..%s" % (sOldRev, sNewRev)
 
-  sFormatSpec = sFormatSpec.strip("\n").replace("\n", "%n")
-
-  if bIncludeDiffStat:
-    sCommand = "whatchanged"
-  else:
-    sCommand = "log"
-
-  asCommand = ['git', sCommand,
-               "--format=format:%s%s" % (sSeparator, sFormatSpec)]
+  asRevArgs = [sCommitRange]
 
   # exclude all changes which are also found on other refs
   # and hence have already been processed.
   if sRefName is not None:
-    asAllRefs = execute(
-        ['git', 'for-each-ref', '--format=%(refname)', sRefPrefix],
-        bSplitLines=True)
-    asAllRefs = [x.strip() for x in asAllRefs]
-    asOtherRefs = [x for x in asAllRefs if x != sRefName]
-    asNotOtherRefs = execute(
-        ['git', 'rev-parse', '--not'] + asOtherRefs,
-        bSplitLines=True)
-    asNotOtherRefs = [x.strip() for x in asNotOtherRefs]
-    asCommand += asNotOtherRefs
-
-  asCommand.append(sCommitRange)
-  sChangeLog = execute(asCommand)
-  asChangeLogs = sChangeLog.split(sSeparator)
-  asChangeLogs.reverse()
-
-  return asChangeLogs[:-1]
+    asRevArgs += get_exclusions([sRefName], sRefPrefix)
+
+  return get_commits(asRevArgs, sFormatSpec, bIncludeDiffStat)
+
+
+
+def get_push_changes(aasPushes, sFormatSpec, sSeparator, bIncludeDiffStat, sRefPrefix, bRefsUpdated=True, bAllRefs=True):
+  """
+  yields a Commit in chronological order for each commit introduced by
+  the pushes in aasPushes, which is a list of (sOldRev, sNewRev, sRefName)
+  tuples. The refs of each Commit are all the pushed refs whose new
+  revision introduced it, in push order. If bAllRefs is False, they are
+  only the refs of one of these revisions (see git log --source), which
+  costs nothing more than the walk itself.
+
+  The whole push is handled with a single walk of the history, so each
+  commit is listed exactly once, however many of the pushed refs it is
+  on. When several new revisions are pushed and bAllRefs is True, a
+  single 'git rev-list --parents' over all of them finds the refs of each
+  commit first. Commits which were already reachable from the old
+  revisions of the pushed refs, or from any other ref starting with
+  sRefPrefix, are left out.
+
+  bRefsUpdated tells whether the pushed refs already point to their new
+  revisions (post-receive) or not yet (pre-receive).
+
+  sSeparator is no longer needed, and is ignored.
+  """
+  dRefsByRev = {}
+  asRevs = []
+  asRefNames = []
+  for (sOldRev, sNewRev, sRefName) in aasPushes:
+    asRefNames.append(sRefName)
+    if sOldRev != sNoCommitRev:
+      asRevs.append("^%s" % (sOldRev,))
+    if sNewRev != sNoCommitRev:
+      if sNewRev not in dRefsByRev:
+        asRevs.append(sNewRev)
+      dRefsByRev.setdefault(sNewRev, []).append(sRefName)
+
+  if not dRefsByRev:
+    return
+
+  asRevArgs = ["--stdin"]
+  if bRefsUpdated:
+    asRevArgs += get_exclusions(asRefNames, sRefPrefix)
+  else:
+    asRevArgs += get_exclusions([], sRefPrefix)
+
+  sInput = "".join("%s\n" % (x,) for x in asRevs)
+  dRefsBySha = None
+  if bAllRefs and len(dRefsByRev) > 1:
+    dRefsBySha = get_refs_by_sha(asRevArgs, sInput, dRefsByRev)
+    dOrder = dict((y, x) for (x, y) in enumerate(asRefNames))
+
+  for oCommit in get_commits(asRevArgs, sFormatSpec, bIncludeDiffStat, sInput, dRefsBySha is None):
+    if dRefsBySha is None:
+      # the source is the new revision through which the commit was reached
+      oCommit.refs = dRefsByRev[oCommit.refs[0]]
+    else:
+      oCommit.refs = sorted(dRefsBySha.get(oCommit.sha, ()), key=dOrder.get)
+    yield oCommit
+
+
+
+def get_refs_by_sha(asRevArgs, sInput, dRefsByRev):
+  """
+  returns a dictionary mapping the sha of each commit listed by 'git
+  rev-list asRevArgs' (sInput being fed to it, for --stdin) to the set of
+  the refs reaching it, dRefsByRev mapping the listed revisions to their
+  refs. The history is walked once: the commits come children first
+  (--topo-order), and hand their refs down to their parents.
+  """
+  dRefsBySha = dict((x, frozenset(y)) for (x, y) in dRefsByRev.items())
+  asLines = execute(["git", "rev-list", "--parents", "--topo-order"] + asRevArgs,
+                    True, sInput=sInput, bMergeErrors=False)
+  for sLine in asLines:
+    asShas = sLine.split()
+    if not asShas:
+      continue
+    # (a new revision which is a tag object is only known peeled here)
+    oRefs = dRefsBySha.get(asShas[0], frozenset())
+    for sParent in asShas[1:]:
+      oParentRefs = dRefsBySha.get(sParent)
+      # linear history shares the same set
+      if oParentRefs is None or oParentRefs <= oRefs:
+        dRefsBySha[sParent] = oRefs
+      elif not oRefs <= oParentRefs:
+        dRefsBySha[sParent] = oParentRefs | oRefs
+  return dRefsBySha
+
+
+
+class RateLimiter(object):
+  """
+  lets at most fRate calls per second through wait(), on average, from
+  any number of threads. No limit if fRate is None.
+  """
+
+  def __init__(self, fRate=None):
+    self._fInterval = fRate and 1.0 / fRate or 0.0
+    self._fNext = time.time()
+    self._oLock = threading.Lock()
+
+
+  def wait(self):
+    if not self._fInterval:
+      return
+    with self._oLock:
+      fNow = time.time()
+      fAt = max(self._fNext, fNow)
+      self._fNext = fAt + self._fInterval
+    if fAt > fNow:
+      time.sleep(fAt - fNow)
+
+
+
+def split_comments(atMessages, iMaxCommentSize):
+  """
+  combines the (sKey, sMessage) tuples of atMessages into comments of at
+  most iMaxCommentSize characters (a longer message makes a comment of its
+  own), like hooks.CommentBatcher does. sKey identifies the message, e.g.
+  the commit it comes from. Returns a list of (sComment, asKeys) tuples,
+  asKeys being the keys of the messages in sComment.
+  """
+  atComments = []
+  asMessages = []
+  asKeys = []
+  iSize = 0
+  for (sKey, sMessage) in atMessages:
+    sMessage = sMessage.strip("\n")
+    if asMessages and iSize + 2 + len(sMessage) > iMaxCommentSize:
+      atComments.append(("\n\n".join(asMessages), asKeys))
+      (asMessages, asKeys, iSize) = ([], [], 0)
+    if asMessages:
+      iSize += 2
+    asMessages.append(sMessage)
+    asKeys.append(sKey)
+    iSize += len(sMessage)
+  if asMessages:
+    atComments.append(("\n\n".join(asMessages), asKeys))
+  return atComments
 
 
 